@@ -0,0 +1,177 @@
+# End-to-end benchmark of the conversion on synthetic HCP Lifespan and HCP-YA trees (see synthetic.py).
+# Each combination of dataset and transfer method is converted --repeat times into a fresh output folder. The elapsed
+# time, the time spent in each phase of the conversion (see logs.py) and the file/byte/syscall counters are printed
+# and appended as one JSON object per combination to the --results file, so that runs of different versions can be
+# compared. With --compare, the median times are compared against the latest matching results of an earlier run and the
+# benchmark exits with an error if any combination got slower by more than --threshold.
+# Usage: python benchmarks/bench_conversion.py [--subjects 10] [--methods hardlink copy] [--compare results.jsonl]
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from hcpya import run_hcpya  # noqa: E402
+from lifespan import run  # noqa: E402
+from logs import PHASES, reset_stats, setup_logging  # noqa: E402
+from sidecars import clear_sidecar_cache  # noqa: E402
+from synthetic import generate_tree  # noqa: E402
+
+METHODS = ("hardlink", "symlink", "copy", "auto", "move")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", type=str, nargs="+", choices=["lifespan", "ya"], default=["lifespan", "ya"],
+                        help="synthetic datasets to convert. (default: lifespan ya)")
+    parser.add_argument("--methods", type=str, nargs="+", choices=METHODS, default=list(METHODS),
+                        help="transfer methods to benchmark. (default: all)")
+    parser.add_argument("--subjects", type=int, default=10, help="number of synthetic subjects. (default: 10)")
+    parser.add_argument("--volumes", type=int, default=2, help="number of volumes of the fMRI images. (default: 2)")
+    parser.add_argument("--physio_rows", type=int, default=1000,
+                        help="number of rows of each physio file. (default: 1000)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of conversions of each combination. The median is reported. (default: 3)")
+    parser.add_argument("--jobs", type=int, default=1, help="--jobs of the conversion. (default: 1)")
+    parser.add_argument("--pipeline", action="store_true", help="convert with the pipelined executor.")
+    parser.add_argument("--work_dir", type=str,
+                        help="folder for the synthetic trees and outputs, e.g. on the storage to benchmark. "
+                             "(default: a temporary folder)")
+    parser.add_argument("--results", type=str, default="benchmark_results.jsonl",
+                        help="file to which the results are appended. (default: benchmark_results.jsonl)")
+    parser.add_argument("--label", type=str, help="label stored with the results (e.g. the storage backend).")
+    parser.add_argument("--compare", type=str, help="results file of an earlier run to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown of the median time that counts as a regression. (default: 0.1)")
+    return parser.parse_args()
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def convert(dataset, input_dir, output_dir, method, jobs=1, pipeline=False):
+    pipeline_options = dict() if pipeline else None
+    if dataset == "lifespan":
+        run(os.path.join(input_dir, "imagingcollection01", "HC*"), output_dir=output_dir, method=method, jobs=jobs,
+            physio_sampling_frequency=400., pipeline_options=pipeline_options)
+    else:
+        run_hcpya(input_dir, output_dir, method=method, jobs=jobs, pipeline_options=pipeline_options)
+
+
+def benchmark(dataset, method, work_dir, args):
+    source_dir = os.path.join(work_dir, "{}-{}-{}-{}".format(dataset, args.subjects, args.volumes, args.physio_rows))
+    if not os.path.exists(source_dir):
+        generate_tree(source_dir, dataset=dataset, subjects=args.subjects, volumes=args.volumes,
+                      physio_rows=args.physio_rows)
+    times = list()
+    phases = dict()
+    counters = dict()
+    for _ in range(args.repeat):
+        input_dir = source_dir
+        output_dir = os.path.join(work_dir, "output")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if method == "move":
+            # the sources are moved, so each conversion gets its own copy of the tree
+            input_dir = os.path.join(work_dir, "move_input")
+            shutil.rmtree(input_dir, ignore_errors=True)
+            shutil.copytree(source_dir, input_dir)
+        # every conversion starts without cached sidecars, like a new process
+        clear_sidecar_cache()
+        start = time.perf_counter()
+        convert(dataset, input_dir, output_dir, method, jobs=args.jobs, pipeline=args.pipeline)
+        times.append(time.perf_counter() - start)
+        stats = reset_stats()
+        for phase, values in stats["phases"].items():
+            phases.setdefault(phase, list()).append(values["seconds"])
+        counters = stats["counters"]
+    return {"dataset": dataset, "method": method, "subjects": args.subjects, "volumes": args.volumes,
+            "physio_rows": args.physio_rows, "jobs": args.jobs, "pipeline": args.pipeline, "times": times,
+            "median": statistics.median(times),
+            "phases": {phase: statistics.median(values) for phase, values in phases.items()}, "counters": counters}
+
+
+def get_key(result):
+    return (result["dataset"], result["method"], result["subjects"], result["volumes"], result["physio_rows"],
+            result["jobs"], result["pipeline"])
+
+
+def read_results(filename):
+    # the latest result of each combination
+    results = dict()
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                results[get_key(result)] = result
+    return results
+
+
+def print_results(results, baseline=None, threshold=0.1):
+    phases = [phase for phase in PHASES if any([phase in result["phases"] for result in results])]
+    print("{:<10}{:<10}{:>10}{:>10}".format("dataset", "method", "median s", "files/s")
+          + "".join(["{:>15}".format(phase) for phase in phases])
+          + ("{:>12}".format("vs baseline") if baseline else ""))
+    regressions = list()
+    for result in results:
+        line = "{:<10}{:<10}{:>10.3f}{:>10.0f}".format(result["dataset"], result["method"], result["median"],
+                                                       result["counters"].get("files", 0) / result["median"])
+        line += "".join(["{:>15.4f}".format(result["phases"].get(phase, 0.)) for phase in phases])
+        if baseline is not None:
+            previous = baseline.get(get_key(result))
+            if previous is None:
+                line += "{:>12}".format("-")
+            else:
+                ratio = result["median"] / previous["median"]
+                line += "{:>11.2f}x".format(ratio)
+                if ratio > 1 + threshold:
+                    line += "  REGRESSION"
+                    regressions.append(result)
+        print(line)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    # only warnings and errors of the conversion are printed
+    setup_logging("WARNING")
+    baseline = read_results(args.compare) if args.compare else None
+    metadata = {"date": datetime.datetime.now().isoformat(timespec="seconds"), "commit": get_commit(),
+                "label": args.label, "python": platform.python_version(), "platform": platform.platform(),
+                "cpus": os.cpu_count()}
+    work_dir = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix="hcp2bids_benchmark_")
+    results = list()
+    try:
+        for dataset in args.datasets:
+            for method in args.methods:
+                result = benchmark(dataset, method, work_dir, args)
+                result.update(metadata)
+                results.append(result)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.results, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    regressions = print_results(results, baseline=baseline, threshold=args.threshold)
+    print("Results appended to {}".format(args.results))
+    if len(regressions) > 0:
+        sys.exit("{} of {} combinations are more than {:.0%} slower than in {}.".format(
+            len(regressions), len(results), args.threshold, args.compare))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Benchmark of the physio conversion: the original single threaded gzip copy against the streaming converter in
+# physio.py, with and without parallel block compression.
+# Usage: python benchmarks/bench_physio.py [--size_mb 200] [--jobs 4]
+import argparse
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from physio import convert_physio_file  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size_mb", type=float, default=200, help="size of the synthetic physio file in MB.")
+    parser.add_argument("--jobs", type=int, default=min(4, os.cpu_count() or 1),
+                        help="number of compression threads for the parallel converter.")
+    return parser.parse_args()
+
+
+def write_synthetic_physio_file(filename, size_mb):
+    # HCP-YA style: trigger, respiration and pulse oximetry columns sampled at 400 Hz, tab separated, no header
+    line_number = 0
+    with open(filename, "w") as f:
+        while f.tell() < size_mb * 1024 * 1024:
+            lines = ["{}\t{}\t{}\n".format(int(i % 288 == 0), 2000 + i % 97, 1500 + i % 53)
+                     for i in range(line_number, line_number + 100000)]
+            f.writelines(lines)
+            line_number += 100000
+
+
+def legacy_convert(in_file, out_file):
+    with open(in_file, "rb") as f_in:
+        with gzip.open(out_file, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+
+def measure(name, function, in_file, out_file):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function(in_file, out_file)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size_mb = os.path.getsize(in_file) / 1024 / 1024
+    print("{:<24} {:8.2f} s {:8.1f} MB/s  peak python memory {:8.1f} MB  output {:8.1f} MB".format(
+        name, elapsed, size_mb / elapsed, peak / 1024 / 1024, os.path.getsize(out_file) / 1024 / 1024))
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_file = os.path.join(tmp_dir, "physio.txt")
+        write_synthetic_physio_file(in_file, args.size_mb)
+        outputs = {"legacy": os.path.join(tmp_dir, "legacy.tsv.gz"),
+                   "streaming (1 thread)": os.path.join(tmp_dir, "serial.tsv.gz"),
+                   "streaming ({} threads)".format(args.jobs): os.path.join(tmp_dir, "parallel.tsv.gz")}
+        measure("legacy", legacy_convert, in_file, outputs["legacy"])
+        measure("streaming (1 thread)", lambda i, o: convert_physio_file(i, o, jobs=1), in_file,
+                outputs["streaming (1 thread)"])
+        measure("streaming ({} threads)".format(args.jobs), lambda i, o: convert_physio_file(i, o, jobs=args.jobs),
+                in_file, outputs["streaming ({} threads)".format(args.jobs)])
+
+        # all outputs must decompress to the same content with the standard gzip module
+        with open(in_file, "rb") as f:
+            expected = f.read()
+        for name, out_file in outputs.items():
+            with gzip.open(out_file, "rb") as f:
+                if f.read() != expected:
+                    raise RuntimeError("Output of {} does not match the input.".format(name))
+        print("All outputs decompress to the original data.")
+
+
+if __name__ == "__main__":
+    main()
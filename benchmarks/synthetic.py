@@ -0,0 +1,174 @@
+# Generator of synthetic HCP Lifespan (NDA imagingcollection01) and HCP-YA trees for benchmarks.
+# The trees have the same folder and file names as the released data, with tiny NIfTI images (a valid NIfTI-1 header
+# followed by a few zero voxels), JSON sidecars with AcquisitionTime, EV files, physio files, and SpinEchoFieldMap
+# pairs, so that every code path of the conversion is exercised without the real data.
+# Usage: python benchmarks/synthetic.py --output_dir <dir> --dataset lifespan --subjects 10
+import argparse
+import gzip
+import json
+import os
+import struct
+
+LIFESPAN_FMRI = ("rfMRI_REST1_AP", "rfMRI_REST1_PA", "rfMRI_REST2_AP", "rfMRI_REST2_PA", "tfMRI_CARIT_PA",
+                 "tfMRI_FACENAME_PA", "tfMRI_VISMOTOR_PA")
+LIFESPAN_EVS = ("go", "nogo", "Sync")
+YA_FMRI = ("rfMRI_REST1_LR", "rfMRI_REST1_RL", "tfMRI_MOTOR_LR", "tfMRI_MOTOR_RL", "tfMRI_WM_LR", "tfMRI_WM_RL")
+YA_EVS = ("lf", "rf", "t", "Sync")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True, help="folder in which the tree is created.")
+    parser.add_argument("--dataset", type=str, choices=["lifespan", "ya"], default="lifespan",
+                        help="layout of the tree. (default: lifespan)")
+    parser.add_argument("--subjects", type=int, default=10, help="number of subjects. (default: 10)")
+    parser.add_argument("--volumes", type=int, default=2,
+                        help="number of volumes of the fMRI images (the images are 4x4x4 voxels). (default: 2)")
+    parser.add_argument("--physio_rows", type=int, default=1000,
+                        help="number of rows of each physio file. (default: 1000)")
+    parser.add_argument("--ev_rows", type=int, default=10, help="number of rows of each EV file. (default: 10)")
+    return parser.parse_args()
+
+
+def nifti_header(shape, repetition_time=0.8):
+    """
+    Returns a minimal NIfTI-1 header (348 bytes + 4 bytes of extension flags) for uint8 images.
+    """
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    pixdim = [1.] + [2.] * 3 + [repetition_time] + [1.] * 3
+    return (struct.pack("<i10s18sihsB", 348, b"", b"", 0, 0, b"r", 0)
+            + struct.pack("<8h", *dim)
+            + struct.pack("<3f", 0., 0., 0.)
+            + struct.pack("<4h", 0, 2, 8, 0)  # intent_code, datatype (uint8), bitpix, slice_start
+            + struct.pack("<8f", *pixdim)
+            + struct.pack("<ff", 352., 1.)  # vox_offset, scl_slope
+            + struct.pack("<fhbB", 0., 0, 10, 0)  # scl_inter, slice_end, slice_code, xyzt_units (mm and s)
+            + struct.pack("<6f", 0., 0., 0., 0., 0., 0.)
+            + struct.pack("<80s24s", b"synthetic", b"")
+            + struct.pack("<hh", 0, 1)  # qform_code, sform_code
+            + struct.pack("<6f", 0., 0., 0., 0., 0., 0.)
+            + struct.pack("<12f", 2., 0., 0., 0., 0., 2., 0., 0., 0., 0., 2., 0.)
+            + struct.pack("<16s4s", b"", b"n+1\0")
+            + b"\0" * 4)
+
+
+def write_image(filename, volumes=1, repetition_time=0.8):
+    shape = (4, 4, 4) if volumes == 1 else (4, 4, 4, volumes)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with gzip.open(filename, "wb") as f:
+        f.write(nifti_header(shape, repetition_time=repetition_time))
+        f.write(b"\0" * (64 * volumes))
+
+
+def write_json(filename, data):
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=4)
+
+
+def write_ev_files(ev_folder, names, rows, run_duration):
+    """
+    Writes EV files with interleaved events that all start within the run (volumes * repetition time), so that the
+    events pass the checks of validate.py.
+    """
+    os.makedirs(ev_folder, exist_ok=True)
+    duration = run_duration / (rows * len(names))
+    for i, name in enumerate(names):
+        with open(os.path.join(ev_folder, name + ".txt"), "w") as f:
+            f.writelines(["{:.4f}\t{:.4f}\t1\n".format((row * len(names) + i) * duration, duration)
+                          for row in range(rows)])
+
+
+def fieldmap_fields(direction):
+    # the sidecar fields that BIDS requires for spin echo fieldmaps
+    return {"PhaseEncodingDirection": "j-" if direction == "AP" else "j", "TotalReadoutTime": 0.0346}
+
+
+def generate_lifespan_subject(nda_dir, subject_id, volumes=2, physio_rows=1000, ev_rows=10):
+    unprocessed = os.path.join(nda_dir, "imagingcollection01", "{}_V1_MR".format(subject_id), "unprocessed")
+    minute = [0]
+
+    def image(folder, name, volumes=1, **fields):
+        filename = os.path.join(unprocessed, folder, "{}_V1_MR_{}.nii.gz".format(subject_id, name))
+        write_image(filename, volumes=volumes)
+        minute[0] += 1
+        write_json(filename.replace(".nii.gz", ".json"),
+                   {"AcquisitionTime": "{:02d}:{:02d}:00.000000".format(8 + minute[0] // 60, minute[0] % 60),
+                    "RepetitionTime": 0.8, **fields})
+
+    image("T1w_MPR_vNav_4e_RMS", "T1w_MPR_vNav_4e_RMS")
+    image("T1w_MPR_vNav_4e_RMS", "SpinEchoFieldMap1_AP", **fieldmap_fields("AP"))
+    image("T1w_MPR_vNav_4e_RMS", "SpinEchoFieldMap1_PA", **fieldmap_fields("PA"))
+    image("T2w_SPC_vNav", "T2w_SPC_vNav")
+    for task in LIFESPAN_FMRI:
+        direction = task.split("_")[-1]
+        image(task, "SpinEchoFieldMap2_{}".format(direction), **fieldmap_fields(direction))
+        image(task, task + "_SBRef")
+        image(task, task, volumes=volumes, TaskName=task.split("_")[1])
+        linked_data = os.path.join(unprocessed, task, "LINKED_DATA")
+        os.makedirs(os.path.join(linked_data, "PHYSIO"), exist_ok=True)
+        with open(os.path.join(linked_data, "PHYSIO", "{}_V1_MR_{}_physio.csv".format(subject_id, task)), "w") as f:
+            f.write("trigger,resp,pulse\n")
+            f.writelines(["{},{},{}\n".format(int(row % 100 == 0), 2000 + row % 97, 1500 + row % 53)
+                          for row in range(physio_rows)])
+        if task.startswith("tfMRI"):
+            write_ev_files(os.path.join(linked_data, "PSYCHOPY", "EVs"), LIFESPAN_EVS, ev_rows, volumes * 0.8)
+            with open(os.path.join(linked_data, "PSYCHOPY", "{}_V1_MR_{}.mp4".format(subject_id, task)), "wb") as f:
+                f.write(b"\0" * 16)
+    for direction in ("AP", "PA"):
+        for run in ("dir98", "dir99"):
+            name = "dMRI_{}_{}".format(run, direction)
+            image("Diffusion", name, volumes=volumes)
+            with open(os.path.join(unprocessed, "Diffusion", "{}_V1_MR_{}.bval".format(subject_id, name)), "w") as f:
+                f.write(" ".join(["0"] + ["1500"] * (volumes - 1)) + "\n")
+            with open(os.path.join(unprocessed, "Diffusion", "{}_V1_MR_{}.bvec".format(subject_id, name)), "w") as f:
+                f.writelines([" ".join(["0"] * volumes) + "\n"] * 3)
+    image("mbPCASLhr_PA", "mbPCASLhr_PA", volumes=volumes)
+    image("OTHER_FILES", "T1w_MPR_vNav_4e_e1")
+
+
+def generate_ya_subject(hcp_dir, subject_id, volumes=2, physio_rows=1000, ev_rows=10):
+    subject_folder = os.path.join(hcp_dir, subject_id)
+    unprocessed = os.path.join(subject_folder, "unprocessed", "3T")
+    write_image(os.path.join(subject_folder, "T1w", "T1w_acpc_dc.nii.gz"))
+    write_image(os.path.join(subject_folder, "T1w", "T2w_acpc_dc.nii.gz"))
+    for folder in ("T1w_MPR1", "T2w_SPC1"):
+        write_image(os.path.join(unprocessed, folder, "{}_3T_{}.nii.gz".format(subject_id, folder)))
+    write_image(os.path.join(unprocessed, "T1w_MPR1", "{}_3T_AFI.nii.gz".format(subject_id)))
+    for task in YA_FMRI:
+        for name in (task, task + "_SBRef", "SpinEchoFieldMap_LR", "SpinEchoFieldMap_RL"):
+            write_image(os.path.join(unprocessed, task, "{}_3T_{}.nii.gz".format(subject_id, name)),
+                        volumes=volumes if name == task else 1, repetition_time=0.72)
+        linked_data = os.path.join(unprocessed, task, "LINKED_DATA")
+        os.makedirs(os.path.join(linked_data, "PHYSIO"), exist_ok=True)
+        with open(os.path.join(linked_data, "PHYSIO", "{}_3T_{}_Physio_log.txt".format(subject_id, task)), "w") as f:
+            f.writelines(["{}\t{}\t{}\n".format(int(row % 100 == 0), 2000 + row % 97, 1500 + row % 53)
+                          for row in range(physio_rows)])
+        if task.startswith("tfMRI"):
+            write_ev_files(os.path.join(linked_data, "EPRIME", "EVs"), YA_EVS, ev_rows, volumes * 0.72)
+    write_image(os.path.join(unprocessed, "Diffusion", "{}_3T_DWI_dir95_LR.nii.gz".format(subject_id)),
+                volumes=volumes)
+
+
+def generate_tree(output_dir, dataset="lifespan", subjects=10, volumes=2, physio_rows=1000, ev_rows=10):
+    """
+    Creates a synthetic tree.
+    :return: the input folder for lifespan.py (--nda_dir) or hcpya.py (--hcp_dir).
+    """
+    for i in range(subjects):
+        if dataset == "lifespan":
+            generate_lifespan_subject(output_dir, "HCA{}".format(6000000 + i), volumes=volumes,
+                                      physio_rows=physio_rows, ev_rows=ev_rows)
+        else:
+            generate_ya_subject(output_dir, str(100000 + i), volumes=volumes, physio_rows=physio_rows,
+                                ev_rows=ev_rows)
+    return output_dir
+
+
+def main():
+    args = parse_args()
+    generate_tree(args.output_dir, dataset=args.dataset, subjects=args.subjects, volumes=args.volumes,
+                  physio_rows=args.physio_rows, ev_rows=args.ev_rows)
+
+
+if __name__ == "__main__":
+    main()
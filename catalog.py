@@ -0,0 +1,218 @@
+# SQLite catalog of the converted dataset (bids_catalog.db in the BIDS directory).
+# The catalog has one row per output file with its BIDS entities, the source file it was created from, its size, and
+# the AcquisitionTime, TaskName and IntendedFor fields of its sidecar. The IntendedFor fields are also stored as one
+# row per target, so that fieldmaps and the images they correct can be joined. The conversion updates the catalog as
+# the outputs of each source image are written, so queries do not need to walk the BIDS directory or read sidecars:
+#   python catalog.py --bids_dir <output_dir> --suffix bold --task rest --fieldmap_dir AP
+# lists all the rest bold runs that have an AP spin echo fieldmap.
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+from entities import parse_bids_filename
+from logs import count, logger, setup_logging
+from manifest import load_manifest
+
+CATALOG_FILENAME = "bids_catalog.db"
+# catalog columns of the BIDS entities
+ENTITY_COLUMNS = {"sub": "subject", "ses": "session", "task": "task", "acq": "acq", "ce": "ce", "rec": "rec",
+                  "dir": "dir", "run": "run", "recording": "recording", "echo": "echo", "part": "part"}
+COLUMNS = (("path", "TEXT PRIMARY KEY"),) + tuple([(column, "TEXT") for column in ENTITY_COLUMNS.values()]) + (
+    ("suffix", "TEXT"), ("datatype", "TEXT"), ("extension", "TEXT"), ("source", "TEXT"), ("size", "INTEGER"),
+    ("acquisition_time", "TEXT"), ("task_name", "TEXT"), ("intended_for", "TEXT"))
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files ({columns});
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject);
+CREATE INDEX IF NOT EXISTS files_suffix_task ON files (suffix, task);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_run ON files (run);
+CREATE INDEX IF NOT EXISTS files_source ON files (source);
+CREATE TABLE IF NOT EXISTS intended_for (path TEXT NOT NULL, target TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS intended_for_path ON intended_for (path);
+CREATE INDEX IF NOT EXISTS intended_for_target ON intended_for (target);
+""".format(columns=", ".join(["{} {}".format(name, column_type) for name, column_type in COLUMNS]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bids_dir", type=str, required=True, help="path to the BIDS directory.")
+    for entity, column in ENTITY_COLUMNS.items():
+        parser.add_argument("--" + column, type=str, help="only list files with this {} entity.".format(entity))
+    parser.add_argument("--suffix", type=str, help="only list files with this suffix (e.g. bold).")
+    parser.add_argument("--datatype", type=str, help="only list files in this folder (e.g. func).")
+    parser.add_argument("--extension", type=str, default=".nii.gz",
+                        help="only list files with this extension. (default: .nii.gz)")
+    parser.add_argument("--fieldmap_dir", type=str,
+                        help="only list files that are an IntendedFor target of a spin echo fieldmap with this "
+                             "phase encoding direction (e.g. AP).")
+    parser.add_argument("--columns", type=str, nargs="+", default=["path"],
+                        help="columns to print. (default: path)")
+    parser.add_argument("--sql", type=str, help="run this SQL query on the catalog instead.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild the catalog from the manifest of the BIDS directory before querying it.")
+    return parser.parse_args()
+
+
+def resolve_intended_for(target, subject):
+    # IntendedFor targets are relative to the subject folder or BIDS URIs
+    if target.startswith("bids::"):
+        return target[len("bids::"):]
+    return "sub-{}/{}".format(subject, target)
+
+
+def read_sidecar_fields(sidecar_file):
+    try:
+        with open(sidecar_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def catalog_rows(source, entry, bids_dir):
+    """
+    Creates the catalog rows of the outputs of a manifest entry.
+    :return: the rows of the files table and the (path, target) rows of the intended_for table.
+    """
+    rows = list()
+    intended_for_rows = list()
+    copied_from = entry.get("copied_from", dict())
+    sidecars = dict()
+    for output in entry["outputs"]:
+        name = parse_bids_filename(os.path.basename(output))
+        row = {column: name.get(entity) for entity, column in ENTITY_COLUMNS.items()}
+        row.update(path=output, suffix=name["suffix"], datatype=os.path.basename(os.path.dirname(output)),
+                   extension=name["extension"], source=copied_from.get(output, source))
+        if output in entry.get("stats", dict()):
+            row["size"] = entry["stats"][output][0]
+        else:
+            count("stat")
+            row["size"] = os.lstat(os.path.join(bids_dir, output)).st_size
+        sidecar = output[:-len(name["extension"])] + ".json"
+        if sidecar not in sidecars:
+            sidecars[sidecar] = read_sidecar_fields(os.path.join(bids_dir, sidecar))
+        fields = sidecars[sidecar]
+        intended_for = fields.get("IntendedFor")
+        row.update(acquisition_time=fields.get("AcquisitionTime"), task_name=fields.get("TaskName"),
+                   intended_for=None if intended_for is None else json.dumps(intended_for))
+        if intended_for is not None and output == sidecar:
+            for target in intended_for if isinstance(intended_for, list) else [intended_for]:
+                intended_for_rows.append((output, resolve_intended_for(target, row["subject"])))
+        rows.append(row)
+    return rows, intended_for_rows
+
+
+class Catalog(object):
+    """
+    Connection to the catalog of a BIDS directory. The catalog can be updated from several threads and worker
+    processes: each process opens its own connection and SQLite serializes the writes.
+    """
+    def __init__(self, bids_dir):
+        self.bids_dir = bids_dir
+        self.filename = os.path.join(bids_dir, CATALOG_FILENAME)
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(self.bids_dir, exist_ok=True)
+            # the writes of the worker processes wait for each other (up to the timeout)
+            self._connection = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def update_source(self, source, entry, removed=()):
+        """
+        Replaces the rows of the previous outputs of a source image with the rows of its current outputs.
+        """
+        rows, intended_for_rows = catalog_rows(source, entry, self.bids_dir)
+        paths = [(path,) for path in list(removed) + entry["outputs"]]
+        with self._lock, self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", paths)
+            self.connection.executemany("DELETE FROM intended_for WHERE path = ?", paths)
+            self.connection.executemany("INSERT INTO files ({}) VALUES ({})".format(
+                ", ".join([name for name, _ in COLUMNS]), ", ".join(["?"] * len(COLUMNS))),
+                [tuple([row.get(name) for name, _ in COLUMNS]) for row in rows])
+            self.connection.executemany("INSERT INTO intended_for VALUES (?, ?)", intended_for_rows)
+
+    def rebuild(self, manifest, subject_ids=None):
+        """
+        Rebuilds the rows of the subjects (default: all subjects) from the manifest.
+        """
+        for subject_id, subject in manifest["subjects"].items():
+            if subject_ids is not None and subject_id not in subject_ids:
+                continue
+            prefix = "sub-{}/%".format(subject_id)
+            with self._lock, self.connection:
+                self.connection.execute("DELETE FROM files WHERE path LIKE ?", (prefix,))
+                self.connection.execute("DELETE FROM intended_for WHERE path LIKE ?", (prefix,))
+            for source, entry in subject["sources"].items():
+                self.update_source(source, entry)
+
+    def query(self, fieldmap_dir=None, **filters):
+        """
+        Finds the files with the given column values (e.g. suffix="bold", task="rest").
+        :param fieldmap_dir: only files that are an IntendedFor target of a spin echo fieldmap with this direction.
+        :return: list of the rows as dictionaries.
+        """
+        columns = {name for name, _ in COLUMNS}
+        conditions = list()
+        values = list()
+        for column, value in filters.items():
+            if column not in columns:
+                raise ValueError("Unknown catalog column: {}".format(column))
+            if value is not None:
+                conditions.append("files.{} = ?".format(column))
+                values.append(value)
+        if fieldmap_dir is not None:
+            conditions.append("files.path IN (SELECT intended_for.target FROM intended_for JOIN files AS fieldmaps "
+                              "ON fieldmaps.path = intended_for.path WHERE fieldmaps.suffix = 'epi' "
+                              "AND fieldmaps.dir = ?)")
+            values.append(fieldmap_dir)
+        sql = "SELECT * FROM files" + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY path"
+        return self.execute(sql, values)
+
+    def execute(self, sql, values=()):
+        with self._lock:
+            cursor = self.connection.execute(sql, values)
+            names = [description[0] for description in cursor.description or ()]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __getstate__(self):
+        # worker processes open their own connection
+        return {"bids_dir": self.bids_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["bids_dir"])
+
+
+def main():
+    args = parse_args()
+    setup_logging()
+    catalog = Catalog(args.bids_dir)
+    if args.rebuild:
+        catalog.rebuild(load_manifest(args.bids_dir))
+        logger.info("Rebuilt %s", catalog.filename)
+    if args.sql:
+        rows = catalog.execute(args.sql)
+        columns = list(rows[0]) if len(rows) > 0 else list()
+    else:
+        filters = {column: getattr(args, column) for column in ENTITY_COLUMNS.values()}
+        rows = catalog.query(fieldmap_dir=args.fieldmap_dir, suffix=args.suffix, datatype=args.datatype,
+                             extension=args.extension, **filters)
+        columns = args.columns
+    for row in rows:
+        print("\t".join(["" if row[column] is None else str(row[column]) for column in columns]))
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
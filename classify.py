@@ -0,0 +1,282 @@
+# Classification of the HCP image files into BIDS modalities, folders and entities.
+# The rules are data (classification_rules.json) rather than code, so that new HCP variants (e.g. 7T scans or new task
+# names) only need new rules. The rules of a table are tried in order and the first rule whose keyword occurs in the
+# path wins. All the keywords of a table are compiled into a single regular expression, so each path is searched once
+# no matter how many rules there are.
+#
+# Each rule can extract BIDS entities from the path. An entity rule reads its "source" (the "path", the "folder" that
+# contains the image, the "basename" of the image, or an entity extracted before) and sets the entity to:
+#   * the "value" group of "pattern" (a regular expression that is searched in the source), lower cased with "lower" and
+#     without the characters in "remove". Without a match the entity is set to the "source" (as is) or the
+#     "source_lower" (lower cased) when "default" is given and left unset otherwise.
+#   * the constant "value" (if "pattern" is given, only when it matches).
+#   * the value of the first key of "map" that occurs in the source.
+import functools
+import json
+import os
+import re
+
+from logs import count
+
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "classification_rules.json")
+
+
+class KeywordMatcher(object):
+    """
+    Finds all the keywords that occur in a text with a single regular expression search.
+    """
+    def __init__(self, keywords):
+        keywords = sorted(set(keywords), key=lambda keyword: (-len(keyword), keyword))
+        # the lookahead finds the longest keyword that starts at each position of the text. The shorter keywords that
+        # are a prefix of that keyword occur at the same position.
+        self.pattern = None
+        if len(keywords) > 0:
+            self.pattern = re.compile("(?=({}))".format("|".join([re.escape(keyword) for keyword in keywords])))
+        self.implied = {keyword: [other for other in keywords if keyword.startswith(other)] for keyword in keywords}
+
+    def find(self, text):
+        found = set()
+        if self.pattern is None:
+            return found
+        for keyword in self.pattern.findall(text):
+            found.update(self.implied[keyword])
+        return found
+
+
+def compile_entity_rule(rule):
+    rule = dict(rule)
+    if "pattern" in rule:
+        rule["pattern"] = re.compile(rule["pattern"])
+    return rule
+
+
+def extract_entity(rule, sources):
+    """
+    :return: the value of the entity or None if the rule does not apply.
+    """
+    if "source" not in rule:
+        return rule["value"]
+    source = sources.get(rule["source"])
+    if source is None:
+        return None
+    if "map" in rule:
+        for key, value in rule["map"].items():
+            if key in source:
+                return value
+        return None
+    match = rule["pattern"].search(source)
+    if match is None:
+        if rule.get("default") == "source":
+            return source
+        elif rule.get("default") == "source_lower":
+            return source.lower()
+        return None
+    if "value" in rule:
+        return rule["value"]
+    value = match.group("value")
+    if rule.get("lower"):
+        value = value.lower()
+    for character in rule.get("remove", ""):
+        value = value.replace(character, "")
+    return value
+
+
+class RuleTable(object):
+    """
+    Ordered rules that are matched against a text by their "contains" keyword.
+    """
+    def __init__(self, rules):
+        self.rules = list()
+        for rule in rules:
+            rule = dict(rule)
+            rule["entities"] = [compile_entity_rule(entity) for entity in rule.get("entities", list())]
+            self.rules.append(rule)
+        self.matcher = KeywordMatcher([rule["contains"] for rule in self.rules])
+        # the first rule of each keyword has the highest priority
+        self.priority = dict()
+        for i, rule in enumerate(self.rules):
+            self.priority.setdefault(rule["contains"], i)
+
+    def match(self, text, found=None):
+        """
+        :param found: the keywords found in the text, if these are already known.
+        :return: the first rule whose keyword occurs in the text or None.
+        """
+        if found is None:
+            found = self.matcher.find(text)
+        indices = [self.priority[keyword] for keyword in found if keyword in self.priority]
+        if len(indices) == 0:
+            return None
+        return self.rules[min(indices)]
+
+
+def get_relative_path(path, root=None):
+    """
+    :param root: folder of the subject's images (e.g. the unprocessed folder). The parent folders of the root are not
+    part of the classification, so a project folder named e.g. SBRef_proj does not change the BIDS names.
+    :return: the path relative to the root or the path itself if the root is None.
+    """
+    if root is None:
+        return path
+    return os.path.relpath(path, root)
+
+
+def get_sources(image_file, entities):
+    sources = dict(entities)
+    sources.update(path=image_file, folder=os.path.basename(os.path.dirname(image_file)),
+                   basename=os.path.basename(image_file))
+    return sources
+
+
+def apply_entity_rules(rules, sources, entities):
+    sources = dict(sources)
+    for rule in rules:
+        value = extract_entity(rule, sources)
+        if value is not None:
+            entities[rule["entity"]] = value
+            sources[rule["entity"]] = value
+    return entities
+
+
+def get_source_path(source, image_file):
+    if "replace" in source:
+        return image_file.replace(*source["replace"])
+    return os.path.join(image_file.split(source["root"])[0], *source["path"])
+
+
+class SourceResolver(object):
+    """
+    Replaces the image files with their preprocessed/derived versions (e.g. the gradunwarp outputs or the
+    T1w_acpc_dc.nii.gz of HCP-YA) when the option of the source rule is enabled. Each preprocessed/derived file is
+    checked once: all the T1w runs of a subject resolve to the same derived file.
+    """
+    def __init__(self):
+        self.exists = dict()
+
+    def check(self, source, image_file, options):
+        """
+        :return: the file to convert and whether it exists.
+        """
+        if source is None or not options.get(source["option"]):
+            return image_file, True
+        resolved = get_source_path(source, image_file)
+        if resolved not in self.exists:
+            count("stat")
+            self.exists[resolved] = os.path.exists(resolved)
+        return resolved, self.exists[resolved]
+
+    def resolve(self, source, image_file, options):
+        resolved, exists = self.check(source, image_file, options)
+        if not exists:
+            raise ValueError(source["error"].format(resolved))
+        return resolved
+
+
+class Classifier(object):
+    def __init__(self, rules):
+        self.images = RuleTable(rules["images"])
+        self.modifiers = rules.get("modifiers", list())
+        self.exclude = rules.get("exclude", list())
+        self.fieldmap_targets = RuleTable(rules.get("fieldmap_targets", list()))
+        # a single search of each path finds the keywords of the image rules, modifiers and exclusions
+        self.matcher = KeywordMatcher([rule["contains"] for rule in self.images.rules + self.modifiers + self.exclude
+                                       if "contains" in rule])
+
+    def excluded(self, image_file, options=None, found=None, root=None):
+        if options is None:
+            options = dict()
+        image_file = get_relative_path(image_file, root)
+        if found is None:
+            found = self.matcher.find(image_file)
+        for rule in self.exclude:
+            if "option" in rule and not options.get(rule["option"]):
+                continue
+            if "folder_suffix" in rule and os.path.dirname(image_file).endswith(rule["folder_suffix"]):
+                return True
+            if "contains" in rule and rule["contains"] in found:
+                return True
+        return False
+
+    def excluded_folder(self, directory, options=None):
+        """
+        Returns True if all the images in the folder are excluded (e.g. OTHER_FILES), so it does not need to be walked.
+        """
+        if options is None:
+            options = dict()
+        for rule in self.exclude:
+            if "option" in rule and not options.get(rule["option"]):
+                continue
+            if "folder_suffix" in rule and directory.endswith(rule["folder_suffix"]):
+                return True
+        return False
+
+    def classify(self, image_file, entities=None, options=None, resolver=None, root=None):
+        """
+        Classifies an image file.
+        :param entities: entities that are already known (e.g. the phase encoding direction).
+        :param options: the conversion options that the rules depend on (grad_unwarp, t1w_use_derived, ...).
+        :param resolver: SourceResolver of the subject, which checks each preprocessed/derived file once.
+        :param root: only the part of the path below this folder is classified (see get_relative_path).
+        :return: dictionary with the "image_file" to convert (which can be a preprocessed version of the image), the
+        BIDS "modality", "folder" and "entities", and which "intended_for" field the sidecar needs: "fieldmap" for the
+        spin echo fieldmaps, "image" for images that belong to the image of "image_modality" (e.g. SBRef), or None.
+        Images that do not match any rule have the modality and folder None.
+        """
+        entities = dict() if entities is None else dict(entities)
+        options = dict() if options is None else options
+        text = get_relative_path(image_file, root)
+        found = self.matcher.find(text)
+        rule = self.images.match(text, found=found)
+        result = {"image_file": image_file, "modality": None, "folder": None, "entities": entities,
+                  "intended_for": None, "rule": None}
+        if rule is not None:
+            if resolver is None:
+                resolver = SourceResolver()
+            resolved = resolver.resolve(rule.get("source"), image_file, options)
+            if resolved != image_file:
+                found = self.matcher.find(get_relative_path(resolved, root))
+            apply_entity_rules(rule["entities"], get_sources(get_relative_path(resolved, root), entities), entities)
+            result.update(image_file=resolved, modality=rule["modality"], folder=rule["folder"],
+                          intended_for=rule.get("intended_for"), rule=rule["name"])
+        for modifier in self.modifiers:
+            if modifier["contains"] in found:
+                result["image_modality"] = result["modality"]
+                result["modality"] = modifier["modality"]
+                result["intended_for"] = modifier.get("intended_for", result["intended_for"])
+        return result
+
+    def resolve(self, image_file, resolver, options=None, root=None):
+        """
+        Finds the file that would be converted for an image file without classifying it.
+        :return: the file to convert (the image file or its preprocessed/derived version) and whether it exists.
+        """
+        rule = self.images.match(get_relative_path(image_file, root))
+        if rule is None:
+            return image_file, True
+        return resolver.check(rule.get("source"), image_file, dict() if options is None else options)
+
+    def classify_fieldmap_target(self, folder_name):
+        """
+        Finds the modality and entities of the images that a spin echo fieldmap is intended for from the name of the
+        folder that contains the fieldmap.
+        :return: dictionary with the "modality", "folder" and "entities" or None if no rule matches.
+        """
+        rule = self.fieldmap_targets.match(folder_name)
+        if rule is None:
+            return None
+        entities = apply_entity_rules(rule["entities"], {"path": folder_name, "folder": folder_name}, dict())
+        return {"modality": rule["modality"], "folder": rule["folder"], "entities": entities}
+
+
+def load_rules(rules_file=DEFAULT_RULES_FILE):
+    with open(rules_file, "r") as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def get_classifier(rules_file=None):
+    """
+    Returns the compiled classifier of the rules file (by default classification_rules.json). The classifier is
+    compiled once per process.
+    """
+    return Classifier(load_rules(DEFAULT_RULES_FILE if rules_file is None else rules_file))
@@ -0,0 +1,112 @@
+# Finding the subject folders and the images to convert.
+# The subject folders are listed lazily: with --participant_label (or --subject_list) the folders of the selected
+# subjects are looked up by name, so converting a handful of subjects does not list the whole collection unless a
+# label has to be matched against folder names with a visit suffix (e.g. HCA6000000 -> HCA6000000_V1_MR). The
+# session, modality and task filters are applied before the images are planned, and the folders that are never
+# converted (e.g. OTHER_FILES or the skipped 7T/Diffusion folders of HCP-YA) are pruned while the subject folder is
+# walked instead of being filtered out afterwards.
+import fnmatch
+import glob
+import os
+
+from classify import get_relative_path
+from logs import count
+
+
+def get_subject_id(subject_folder):
+    return os.path.basename(subject_folder).split("_")[0]
+
+
+def get_session(subject_folder):
+    # the NDA subject folders are named <subject id>_<visit>_MR (e.g. HCA6000000_V1_MR)
+    parts = os.path.basename(subject_folder).split("_")
+    return parts[1] if len(parts) > 2 else None
+
+
+def iter_folders(parent, pattern):
+    """
+    Yields the subfolders of parent whose name matches the pattern without a stat of the other entries.
+    """
+    count("scandir")
+    with os.scandir(parent) as it:
+        for entry in it:
+            if fnmatch.fnmatchcase(entry.name, pattern) and not entry.name.startswith(".") and entry.is_dir():
+                yield entry.path
+
+
+def iter_subject_folders(wildcard, labels=None):
+    """
+    Yields the subject folders that match the wildcard.
+    :param labels: only yield the folders of these subject ids or subject folder names. The folders are looked up by
+    name, and the parent folder is only listed if a label is not the name of a folder.
+    """
+    parent, pattern = os.path.split(wildcard)
+    if glob.has_magic(parent):
+        for subject_folder in glob.iglob(wildcard):
+            if labels is None or get_subject_id(subject_folder) in labels or \
+                    os.path.basename(subject_folder) in labels:
+                yield subject_folder
+        return
+    if labels is None:
+        yield from iter_folders(parent, pattern)
+        return
+    unmatched = set()
+    for label in labels:
+        subject_folder = os.path.join(parent, label)
+        count("stat")
+        if fnmatch.fnmatchcase(label, pattern) and os.path.isdir(subject_folder):
+            yield subject_folder
+        else:
+            unmatched.add(label)
+    if len(unmatched) > 0:
+        for subject_folder in iter_folders(parent, pattern):
+            if get_subject_id(subject_folder) in unmatched and os.path.basename(subject_folder) not in labels:
+                yield subject_folder
+
+
+def find_subject_folders(wildcard, labels=None, sessions=None):
+    """
+    :param labels: only find the folders of these subject ids or subject folder names.
+    :param sessions: only find the folders of these sessions (visits, e.g. V1).
+    :return: sorted list of the subject folders.
+    """
+    return sorted([subject_folder for subject_folder in iter_subject_folders(wildcard, labels=labels)
+                   if sessions is None or get_session(subject_folder) in sessions])
+
+
+def get_prune_function(classifier, skip=(), options=None, root=None):
+    """
+    Returns a function that tells if a folder can be skipped while walking the subject folder: the folders excluded
+    by the classification rules (e.g. OTHER_FILES) and the folders of the skip strings that end with a '/'.
+    :param root: the walked folder. The skip strings are only matched against the part of the path below it.
+    """
+    folder_skips = [skip_str for skip_str in skip if skip_str.endswith("/")]
+
+    def prune(directory):
+        return classifier.excluded_folder(directory, options=options) or \
+            any([skip_str in get_relative_path(directory, root) + "/" for skip_str in folder_skips])
+    return prune
+
+
+def image_skipped(image_file, skip=(), root=None):
+    """
+    :return: True if the path of the image below the root contains one of the skip strings.
+    """
+    image_file = get_relative_path(image_file, root)
+    return any([skip_str in image_file for skip_str in skip])
+
+
+def image_selected(classification, modalities=None, exclude_modalities=None, tasks=None):
+    """
+    Applies the modality and task filters to a classified image. The task filter only applies to the images that have
+    a task entity, so the anatomical images and fieldmaps are kept unless they are filtered by their modality.
+    """
+    modality = classification["modality"]
+    if modalities is not None and modality not in modalities:
+        return False
+    if exclude_modalities is not None and modality in exclude_modalities:
+        return False
+    task = classification["entities"].get("task")
+    if tasks is not None and task is not None and task not in tasks:
+        return False
+    return True
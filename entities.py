@@ -0,0 +1,131 @@
+# BIDS file names.
+# A BIDSName holds the subject, modality, folder, extension and entities of an output file. It is immutable and
+# interned (equal names are the same object), and its renderings (file name, path relative to the subject folder,
+# path in the BIDS directory, and BIDS URI) are computed once. The same name is rendered many times during planning
+# (the output image, its sidecar, events and physio files, and the IntendedFor fields that point to it), and can be
+# shared between threads.
+import functools
+import os
+
+# the order of the entities in the file names
+ENTITY_ORDER = ("ses", "task", "acq", "ce", "rec", "dir", "run", "recording", "echo", "part")
+
+# HCP runs that were split in two parts (e.g. rfMRI_REST1a) are numbered consecutively
+RUN_ALIASES = {"1a": 1, "1b": 2, "2a": 3, "2b": 4}
+
+
+class BIDSName(object):
+    __slots__ = ("subject_id", "modality", "folder", "extension", "entities", "_key", "_hash", "_filename",
+                 "_relative_path", "_uri", "_full_paths")
+
+    def __init__(self, subject_id, modality, folder, extension, entities):
+        """
+        Use bids_name() to create names, so that equal names are interned.
+        :param entities: tuple of (key, value) pairs in the order of ENTITY_ORDER.
+        """
+        key = (subject_id, modality, folder, extension, entities)
+        for name, value in zip(("subject_id", "modality", "folder", "extension", "entities", "_key", "_hash"),
+                               key + (key, hash(key))):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_filename", None)
+        object.__setattr__(self, "_relative_path", None)
+        object.__setattr__(self, "_uri", None)
+        object.__setattr__(self, "_full_paths", dict())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BIDSName is immutable. Use replace() to create a modified name.")
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, BIDSName) and self._key == other._key
+
+    def __repr__(self):
+        return "BIDSName({!r})".format(self.relative_path)
+
+    def __reduce__(self):
+        # unpickled names are interned again
+        return _intern, self._key
+
+    @property
+    def filename(self):
+        if self._filename is None:
+            parts = ["sub-{}".format(self.subject_id)]
+            parts.extend(["{}-{}".format(key, value) for key, value in self.entities])
+            parts.append(self.modality)
+            object.__setattr__(self, "_filename", "_".join(parts) + self.extension)
+        return self._filename
+
+    @property
+    def relative_path(self):
+        """
+        The path relative to the subject folder (e.g. func/sub-01_task-rest_bold.nii.gz).
+        """
+        if self._relative_path is None:
+            object.__setattr__(self, "_relative_path", os.path.join(self.folder, self.filename))
+        return self._relative_path
+
+    @property
+    def uri(self):
+        """
+        The BIDS URI (e.g. bids::sub-01/func/sub-01_task-rest_bold.nii.gz).
+        """
+        if self._uri is None:
+            object.__setattr__(self, "_uri", "bids::sub-{}/{}".format(self.subject_id, self.relative_path))
+        return self._uri
+
+    def full_path(self, bids_dir):
+        full_path = self._full_paths.get(bids_dir)
+        if full_path is None:
+            full_path = os.path.join(bids_dir, "sub-{}".format(self.subject_id), self.relative_path)
+            self._full_paths[bids_dir] = full_path
+        return full_path
+
+    def intended_for(self, bids_uris=False):
+        return self.uri if bids_uris else self.relative_path
+
+    def replace(self, modality=None, folder=None, extension=None, **entities):
+        """
+        Returns the name with a different modality, folder, extension, or entities.
+        An entity set to None is removed.
+        """
+        values = dict(self.entities)
+        values.update(entities)
+        return bids_name(self.subject_id, self.modality if modality is None else modality,
+                         self.folder if folder is None else folder,
+                         extension=self.extension if extension is None else extension,
+                         **{key: value for key, value in values.items() if value is not None})
+
+
+def parse_bids_filename(filename):
+    """
+    Splits a BIDS file name (e.g. sub-01_task-rest_run-1_bold.nii.gz) into its entities, "suffix" and "extension".
+    """
+    name, dot, extension = filename.partition(".")
+    parts = name.split("_")
+    result = {"suffix": parts[-1], "extension": dot + extension}
+    for part in parts[:-1]:
+        key, _, value = part.partition("-")
+        result[key] = value
+    return result
+
+
+def format_entity(key, value):
+    if key == "run":
+        value = RUN_ALIASES.get(value, value)
+    return str(value)
+
+
+@functools.lru_cache(maxsize=65536)
+def _intern(subject_id, modality, folder, extension, entities):
+    return BIDSName(subject_id, modality, folder, extension, entities)
+
+
+def bids_name(subject_id, modality, folder, extension=".nii.gz", **entities):
+    """
+    Returns the (interned) BIDS name. Entities that are not in ENTITY_ORDER are not part of BIDS file names and are
+    ignored.
+    """
+    return _intern(subject_id, modality, folder, extension,
+                   tuple([(key, format_entity(key, entities[key])) for key in ENTITY_ORDER if key in entities]))
@@ -0,0 +1,93 @@
+# Builds the BIDS events tsv files from the HCP EV files.
+# Each EV file holds one trial type with one "onset duration value" row per trial. The EV files are read as streams
+# and merged by onset with a k-way merge, so a run never needs more than one row per EV file in memory (unless an EV
+# file itself is out of order, in which case only that file is sorted).
+import heapq
+import os
+import warnings
+
+from journal import atomic_write
+from logs import logger
+
+TSV_HEADER = ("onset", "duration", "value", "trial_type")
+
+
+def split_ev_line(line):
+    line = line.strip()
+    if "\t" in line:
+        return line.split("\t")
+    return line.split(" ")
+
+
+def parse_ev_row(columns):
+    """
+    Returns the onset and duration of an EV row as floats.
+    Raises ValueError if the row does not start with a numeric onset and duration.
+    """
+    if len(columns) < 2:
+        raise ValueError("expected at least onset and duration, got {} column(s)".format(len(columns)))
+    return float(columns[0]), float(columns[1])
+
+
+def read_ev_file(events_file):
+    """
+    Yields (onset, columns) for each valid row of an EV file in file order.
+    The columns are kept as the original strings so the values are written without any change in precision.
+    Malformed rows are reported and skipped.
+    """
+    trial_type = os.path.basename(events_file).replace(".txt", "")
+    with open(events_file, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip() == "":
+                continue
+            columns = split_ev_line(line)
+            try:
+                onset, _ = parse_ev_row(columns)
+            except ValueError as error:
+                warnings.warn("Skipping malformed line {} in {}: {!r} ({})".format(line_number, events_file,
+                                                                                   line.strip(), error))
+                continue
+            yield onset, columns + [trial_type]
+
+
+class UnsortedEVFileError(ValueError):
+    pass
+
+
+def stream_ev_rows(events_file):
+    """
+    Yields the rows of an EV file, checking that they are ordered by onset.
+    :raises UnsortedEVFileError: if a row has an earlier onset than the row before it.
+    """
+    previous_onset = None
+    for onset, columns in read_ev_file(events_file):
+        if previous_onset is not None and onset < previous_onset:
+            raise UnsortedEVFileError("EV file is not sorted by onset: {}".format(events_file))
+        previous_onset = onset
+        yield onset, columns
+
+
+def merge_sorted_rows(streams):
+    # heapq.merge is stable, so rows with the same onset keep the order of the EV files
+    return heapq.merge(*streams, key=lambda x: x[0])
+
+
+def _write_rows(tsv_output_file, rows, buffer_size):
+    with atomic_write(tsv_output_file, "w", buffering=buffer_size) as output_file:
+        output_file.write("\t".join(TSV_HEADER) + "\n")
+        output_file.writelines("\t".join(columns) + "\n" for _, columns in rows)
+
+
+def write_events_file(events_files, tsv_output_file, buffer_size=1024 * 1024):
+    """
+    Combines the EV files of a task run into a single events tsv file sorted by onset.
+    The EV files are streamed and merged. HCP EV files are already sorted by onset; if one is not, the EV files are
+    read again and sorted in memory.
+    """
+    logger.debug("Combining events files into %s", tsv_output_file)
+    try:
+        _write_rows(tsv_output_file, merge_sorted_rows([stream_ev_rows(f) for f in events_files]), buffer_size)
+    except UnsortedEVFileError as error:
+        warnings.warn("{}. Sorting the EV files in memory.".format(error))
+        streams = [sorted(read_ev_file(f), key=lambda x: x[0]) for f in events_files]
+        _write_rows(tsv_output_file, merge_sorted_rows(streams), buffer_size)
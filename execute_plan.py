@@ -0,0 +1,84 @@
+# Applies a conversion plan written by lifespan.py or hcpya.py with --save_plan.
+# The plan can be reviewed or edited before it is executed, and --participant_label can be used to execute only part
+# of the plan (e.g. to split the plan across several nodes).
+import argparse
+import time
+
+from catalog import Catalog
+from lifespan import (execute_subject_plan, run_subjects_in_parallel, setup_logging_from_args,
+                      write_bids_dataset_metadata_files)
+from logs import LOG_LEVELS, log_summary, logger, reset_stats
+from manifest import load_manifest, save_manifest
+from plan import read_plan
+from transfer import format_transfer_stats, merge_transfer_stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plan", type=str, required=True, help="path to the JSON conversion plan.")
+    parser.add_argument("--participant_label", type=str, nargs="+",
+                        help="only execute the plan for these subjects. (default: all subjects in the plan)")
+    parser.add_argument("--dry_run", action="store_true", help="do not write files, just print what would be done.")
+    parser.add_argument("--overwrite", action="store_true", help="overwrite existing files.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of subjects to convert in parallel. (default: 1)")
+    parser.add_argument("--log_level", type=str, choices=LOG_LEVELS,
+                        help="minimum level of the printed messages. (default: DEBUG with --dry_run, INFO otherwise)")
+    parser.add_argument("--log_json", type=str,
+                        help="append every log message as a JSON object (one per line) to this file.")
+    return parser.parse_args()
+
+
+def execute_subject_plan_worker(subject_folder, subject_plan, **kwargs):
+    # module level function so that it can be sent to the worker processes
+    return execute_subject_plan(subject_plan, **kwargs)
+
+
+def execute_plan(plan, participant_label=None, overwrite=False, dry_run=False, jobs=1):
+    output_dir = plan["output_dir"]
+    subject_plans = {subject_plan["subject_folder"]: subject_plan for subject_plan in plan["subjects"]
+                     if participant_label is None or subject_plan["subject_id"] in participant_label}
+    start = time.perf_counter()
+    reset_stats()
+    logger.info("Executing the plan for %d subjects.", len(subject_plans))
+    # the catalog (bids_catalog.db) is updated as the outputs of each image are written
+    catalog = None if dry_run else Catalog(output_dir)
+    failed = list()
+    if jobs > 1:
+        entries, failed = run_subjects_in_parallel(
+            execute_subject_plan_worker, list(subject_plans), jobs,
+            subject_kwargs={folder: {"subject_plan": subject_plan} for folder, subject_plan in subject_plans.items()},
+            output_dir=output_dir, overwrite=overwrite, dry_run=dry_run, catalog=catalog)
+    else:
+        entries = {folder: execute_subject_plan(subject_plan, output_dir=output_dir, overwrite=overwrite,
+                                                dry_run=dry_run, catalog=catalog)
+                   for folder, subject_plan in subject_plans.items()}
+    if catalog is not None:
+        catalog.close()
+
+    if not dry_run:
+        write_bids_dataset_metadata_files(output_dir, name=plan["name"])
+        manifest = load_manifest(output_dir)
+        transfer_totals = dict()
+        for subject_folder, entry in entries.items():
+            merge_transfer_stats(transfer_totals, entry.pop("transfers"))
+            manifest["subjects"][subject_plans[subject_folder]["subject_id"]] = entry
+        logger.info("Transfers: %s", format_transfer_stats(transfer_totals))
+        save_manifest(output_dir, manifest)
+    log_summary(elapsed=time.perf_counter() - start)
+
+    if len(failed) > 0:
+        raise RuntimeError("Failed to convert {} of {} subjects:\n{}".format(len(failed), len(subject_plans),
+                                                                            "\n".join(sorted(failed))))
+
+
+def main():
+    args = parse_args()
+    setup_logging_from_args(args)
+    plan = read_plan(args.plan)
+    execute_plan(plan, participant_label=args.participant_label, overwrite=args.overwrite, dry_run=args.dry_run,
+                 jobs=args.jobs)
+
+
+if __name__ == "__main__":
+    main()
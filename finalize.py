@@ -0,0 +1,68 @@
+# Merges the shard reports written by lifespan.py/hcpya.py with --shard_index/--shard_count and writes the dataset
+# level files once all shards are done. The validation results of the shards (--validate) are written to the
+# validation database here, so that the shards never write to the same database. The catalog of the subjects of the
+# shards is built from the merged manifest.
+import argparse
+
+from catalog import Catalog
+from lifespan import write_bids_dataset_metadata_files
+from logs import logger, setup_logging
+from manifest import load_manifest, save_manifest
+from shards import read_shard_reports
+from validate import log_validation_results, write_validation_results
+from verify import write_checksums_file
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True,
+                        help="path to output BIDS directory that the shards were written to.")
+    parser.add_argument("--allow_incomplete", action="store_true",
+                        help="write the dataset level files even if some shards are missing or had failed subjects.")
+    return parser.parse_args()
+
+
+def finalize(output_dir, allow_incomplete=False):
+    reports = read_shard_reports(output_dir)
+    if len(reports) == 0:
+        raise ValueError("No shard reports found in {}".format(output_dir))
+
+    shard_count = reports[0]["shard_count"]
+    found = {report["shard_index"] for report in reports if report["shard_count"] == shard_count}
+    if len(found) != len(reports):
+        raise ValueError("Found shard reports for different shard counts in {}".format(output_dir))
+    missing = sorted(set(range(shard_count)) - found)
+    failed = sorted([subject_folder for report in reports for subject_folder in report["failed"]])
+    logger.info("Found %d of %d shard reports (%d subjects converted, %d failed).", len(found), shard_count,
+                sum([len(report["subjects"]) for report in reports]), len(failed))
+
+    manifest = load_manifest(output_dir)
+    for report in reports:
+        manifest["subjects"].update(report["subjects"])
+    save_manifest(output_dir, manifest)
+    catalog = Catalog(output_dir)
+    catalog.rebuild(manifest, subject_ids={subject_id for report in reports for subject_id in report["subjects"]})
+    catalog.close()
+    validation_results = [result for report in reports for result in report.get("validation", list())]
+    if len(validation_results) > 0:
+        write_validation_results(output_dir, validation_results)
+        log_validation_results(validation_results)
+
+    if (len(missing) > 0 or len(failed) > 0) and not allow_incomplete:
+        raise RuntimeError("Not writing the dataset level files. Missing shards: {}. Failed subjects:\n{}".format(
+            missing, "\n".join(failed)))
+    write_bids_dataset_metadata_files(output_dir, name=reports[0]["name"])
+    if any(["checksums" in entry for subject in manifest["subjects"].values()
+            for entry in subject["sources"].values()]):
+        # the shards were converted with --verify
+        write_checksums_file(output_dir, manifest)
+
+
+def main():
+    args = parse_args()
+    setup_logging()
+    finalize(args.output_dir, allow_incomplete=args.allow_incomplete)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# In-memory index of a subject folder.
+# On network filesystems (Lustre/NFS) every directory listing is a metadata round trip to the server, so the subject
+# folder is walked once with os.scandir and the helpers that look for auxiliary files query the index instead of
+# calling glob.glob for every image.
+import fnmatch
+import glob
+import os
+
+from logs import count
+
+
+class SubjectIndex(object):
+    def __init__(self, root, prune=None):
+        """
+        :param prune: function that returns True for the directories that do not need to be walked (e.g. folders that
+        are never converted). The pruned directories are listed in their parent but their contents are not indexed.
+        """
+        self.root = os.path.abspath(root)
+        self.names = dict()  # directory -> list of entry names in the order returned by os.scandir
+        self.dirs = dict()  # directory -> list of subdirectory names
+        self.counters = {"scandir": 0, "entries": 0, "queries": 0, "listdir_saved": 0, "fallback_glob": 0,
+                         "pruned": 0}
+        self.prune = prune
+        self._scan(self.root)
+
+    def _scan(self, directory):
+        # iterative walk so that deep trees do not hit the recursion limit
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            names = list()
+            dirs = list()
+            self.counters["scandir"] += 1
+            count("scandir")
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        self.counters["entries"] += 1
+                        names.append(entry.name)
+                        if entry.is_dir(follow_symlinks=True):
+                            dirs.append(entry.name)
+                            if self.prune is not None and self.prune(entry.path):
+                                self.counters["pruned"] += 1
+                                continue
+                            stack.append(entry.path)
+            except FileNotFoundError:
+                pass
+            self.names[directory] = names
+            self.dirs[directory] = dirs
+
+    def _relative_parts(self, path):
+        path = os.path.abspath(path)
+        if path == self.root:
+            return list()
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path[len(self.root) + 1:].split(os.sep)
+
+    def glob(self, pattern):
+        """
+        Equivalent of glob.glob(pattern) (without support for '**') answered from the index.
+        Patterns outside the indexed folder fall back to glob.glob.
+        """
+        parts = self._relative_parts(pattern)
+        if parts is None or "**" in parts:
+            self.counters["fallback_glob"] += 1
+            return glob.glob(pattern)
+        self.counters["queries"] += 1
+        candidates = [self.root]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            matches = list()
+            for directory in candidates:
+                if directory not in self.dirs:
+                    continue
+                self.counters["listdir_saved"] += 1
+                names = self.names[directory] if last else self.dirs[directory]
+                if glob.has_magic(part):
+                    names = [name for name in names if not name.startswith(".")]
+                    matches.extend([os.path.join(directory, name) for name in fnmatch.filter(names, part)])
+                elif part in names:
+                    matches.append(os.path.join(directory, part))
+            candidates = matches
+        return candidates
+
+    def find(self, suffix, directory=None):
+        """
+        Returns all files under the directory (default: the indexed folder) that end with the suffix.
+        This replaces the recursive glob.glob(os.path.join(directory, "**", "*" + suffix), recursive=True).
+        """
+        directory = self.root if directory is None else os.path.abspath(directory)
+        self.counters["queries"] += 1
+        found = list()
+        for folder, names in self.names.items():
+            if folder == directory or folder.startswith(directory + os.sep):
+                self.counters["listdir_saved"] += 1
+                subdirs = set(self.dirs[folder])
+                found.extend([os.path.join(folder, name) for name in names
+                              if name.endswith(suffix) and not name.startswith(".") and name not in subdirs])
+        return found
+
+    def exists(self, path):
+        parts = self._relative_parts(path)
+        if parts is None:
+            return os.path.exists(path)
+        self.counters["queries"] += 1
+        if len(parts) == 0:
+            return True
+        directory = os.path.join(self.root, *parts[:-1])
+        return directory in self.names and parts[-1] in self.names[directory]
+
+    def summary(self):
+        return ("{scandir} directories scanned ({entries} entries, {pruned} directories pruned), {queries} lookups "
+                "answered from memory (saving {listdir_saved} directory listings), {fallback_glob} fallback "
+                "globs").format(**self.counters)
+
+
+def glob_files(pattern, index=None):
+    if index is None:
+        return glob.glob(pattern)
+    return index.glob(pattern)
+
+
+def file_exists(path, index=None):
+    if index is None:
+        return os.path.exists(path)
+    return index.exists(path)
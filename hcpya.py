@@ -3,7 +3,7 @@
 # shared by the NDA.
 # The dataset is shared by the CCF (Connectome Coordination Facility) which used a slightly different
 # convention for the file names and folder structure.
-from lifespan import create_parser, run
+from lifespan import create_parser, get_pipeline_options, run, setup_logging_from_args
 import os
 
 # T1w images - get from T1w/t1w_acpc_dc.nii.gz
@@ -14,24 +14,52 @@ import os
 # The spinecho fieldmaps and sbref files also need to be preprocessed using the gradunwarp tool
 # fMRI images - get from gradunwarp/tfMRI/tfMRI*/tfMRI*.nii.gz
 
+# files that are not converted
+SKIP = ("AFI.nii.gz", "FieldMap_Magnitude.nii.gz", "FieldMap_Phase.nii.gz", "7T/", "3T/Diffusion/", "3T_.nii.gz")
+DIFFUSION_SKIP = "3T/Diffusion/"
+
 
 def parse_args():
     parser = create_parser()
     parser.add_argument("--hcp_dir", type=str, help="Path to the HCP-Young Adult dataset", required=True)
     parser.add_argument("--grad_unwarp", action="store_true",
-                        help="Whether to use gradient unwarped data. This data must be computed beforehand.")
-    # TODO: add gradient unwarped data for diffusion as well
+                        help="Whether to use gradient unwarped data. This data must be computed beforehand. "
+                             "The gradunwarp outputs of all the subjects are checked before any subject is "
+                             "converted.")
+    parser.add_argument("--diffusion", action="store_true",
+                        help="also convert the 3T diffusion images. With --grad_unwarp, the gradient unwarped "
+                             "images are taken from gradunwarp/Diffusion/ and the bval/bvec files from the "
+                             "unprocessed data.")
     return parser.parse_args()
 
 
+def run_hcpya(hcp_dir, output_dir, grad_unwarp=False, diffusion=False, **kwargs):
+    """
+    Converts the HCP-YA subjects in hcp_dir.
+    :param diffusion: also convert the 3T diffusion images (gradient unwarped with grad_unwarp).
+    :param kwargs: other arguments passed to lifespan.run (method, overwrite, dry_run, jobs, ...).
+    """
+    wildcard = os.path.join(hcp_dir, "*")
+    skip = tuple([skip_str for skip_str in SKIP if not (diffusion and skip_str == DIFFUSION_SKIP)])
+    # the gradient unwarped files are resolved through the source rules of classification_rules.json, and all of them
+    # are checked before the conversion starts
+    run(wildcard=wildcard, pe_dirs=("LR", "RL"), output_dir=output_dir, name="HCPYoungAdult",
+        grad_unwarp=grad_unwarp, t1w_use_derived=True, t2w_use_derived=True, skip=skip,
+        use_precompiled_sidecars=True, sort_by_run_name=True, check_sources_first=grad_unwarp, **kwargs)
+
+
 def main():
     args = parse_args()
-    wildcard = os.path.join(args.hcp_dir, "*")
-    run(wildcard=wildcard, use_bids_uris=args.use_bids_uris, pe_dirs=("LR", "RL"),  output_dir=args.output_dir,
-        method=args.method, overwrite=args.overwrite, dry_run=args.dry_run, name="HCPYoungAdult",
-        grad_unwarp=args.grad_unwarp, t1w_use_derived=True, t2w_use_derived=True,
-        skip=("AFI.nii.gz", "FieldMap_Magnitude.nii.gz", "FieldMap_Phase.nii.gz", "7T/", "3T/Diffusion/", "3T_.nii.gz"),
-        use_precompiled_sidecars=True, sort_by_run_name=True)
+    setup_logging_from_args(args)
+    run_hcpya(args.hcp_dir, args.output_dir, grad_unwarp=args.grad_unwarp, diffusion=args.diffusion,
+              use_bids_uris=args.use_bids_uris,
+              method=args.method, overwrite=args.overwrite, dry_run=args.dry_run, jobs=args.jobs,
+              plan_file=args.save_plan, subject_list=args.subject_list, shard_index=args.shard_index,
+              shard_count=args.shard_count, pipeline_options=get_pipeline_options(args),
+              rules_file=args.classification_rules, match_acquisition_time=args.intended_for_acquisition_time,
+              resume=args.resume, verify=args.verify, validate=args.validate,
+              participant_label=args.participant_label, sessions=args.session, modalities=args.modality,
+              exclude_modalities=args.exclude_modality, tasks=args.task)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+# Crash safety of the conversion.
+# Every output is written to a temporary file next to it and renamed into place with os.replace, so an interrupted
+# conversion never leaves a partially written file behind. The journal is an append-only file in the output directory
+# with one JSON record per completed operation and per completed source image, so that a conversion that was stopped
+# (e.g. a preempted batch job) can be resumed with --resume where it stopped. The records store the size and
+# modification time of the outputs, so resuming only needs a stat of each output and no hashing. Once the manifest is
+# saved at the end of the conversion, the journal is removed.
+import contextlib
+import json
+import os
+import threading
+
+from logs import count, logger
+
+JOURNAL_FILENAME = ".hcp2bids_journal.jsonl"
+TMP_SUFFIX = ".hcp2bids-tmp"
+
+
+def temporary_filename(filename):
+    return filename + TMP_SUFFIX
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="w", **kwargs):
+    """
+    Opens a temporary file that replaces filename once it has been written completely.
+    """
+    tmp_file = temporary_filename(filename)
+    try:
+        with open(tmp_file, mode, **kwargs) as f:
+            yield f
+    except BaseException:
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, filename)
+
+
+def remove_temporary_files(folder):
+    """
+    Removes the temporary files left behind by an interrupted conversion.
+    """
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            if filename.endswith(TMP_SUFFIX):
+                logger.debug("Removing temporary file: %s", os.path.join(root, filename))
+                os.remove(os.path.join(root, filename))
+
+
+def stat_output(output_file):
+    # outputs can be symlinks to the source files, so the link itself is checked
+    count("stat")
+    stat = os.lstat(output_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def output_verified(output_file, output_stat):
+    """
+    Returns True if the output exists with the recorded size and modification time.
+    """
+    try:
+        return stat_output(output_file) == list(output_stat)
+    except OSError:
+        return False
+
+
+def get_journal_filename(bids_dir, shard_index=None, shard_count=None):
+    # each shard has its own journal, so that shards that finish early do not remove the records of the others
+    if shard_count is None:
+        return os.path.join(bids_dir, JOURNAL_FILENAME)
+    return os.path.join(bids_dir, JOURNAL_FILENAME.replace(".jsonl", "-shard-{:04d}-of-{:04d}.jsonl".format(
+        shard_index, shard_count)))
+
+
+class Journal(object):
+    """
+    Append-only record of the completed operations. Each record is appended with a single write to a file opened with
+    O_APPEND, so the records of several threads or worker processes do not get interleaved. The records are not synced
+    to disk: they survive a killed process but, like the outputs that were not synced either, not necessarily a crash
+    of the machine. Records of outputs that were lost fail the stat check when resuming and are converted again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def record(self, event, **fields):
+        fields["event"] = event
+        line = (json.dumps(fields, sort_keys=True) + "\n").encode("utf-8")
+        with self._lock:
+            if self._fd is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+                self._fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._fd, line)
+
+    def read(self):
+        """
+        :return: list of the records. A truncated last record (from a process that was killed while writing it) is
+        ignored.
+        """
+        records = list()
+        if not os.path.exists(self.filename):
+            return records
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Ignoring incomplete journal record in %s", self.filename)
+        return records
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def __getstate__(self):
+        # worker processes open the journal themselves
+        return {"filename": self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"])
+
+
+def verify_journal(records, bids_dir):
+    """
+    Checks the records of a journal against the files on disk with a stat of each output.
+    :return: dictionary mapping the subject ids to the "sources" whose conversion was completed (manifest entries)
+    and the "operations" whose outputs were written completely (relative output paths).
+    """
+    subjects = dict()
+    for record in records:
+        subject = subjects.setdefault(record["subject"], {"sources": dict(), "operations": list()})
+        if record["event"] == "source":
+            entry = record["entry"]
+            if all([output_verified(os.path.join(bids_dir, output_file), output_stat)
+                    for output_file, output_stat in entry["stats"].items()]):
+                subject["sources"][record["source"]] = entry
+        elif record["event"] == "operation":
+            if output_verified(os.path.join(bids_dir, record["output"]), record["stat"]):
+                subject["operations"].append(record["output"])
+    n_sources = sum([len(subject["sources"]) for subject in subjects.values()])
+    n_operations = sum([len(subject["operations"]) for subject in subjects.values()])
+    logger.info("Verified %d completed images and %d completed operations of %d subjects in the journal.",
+                n_sources, n_operations, len(subjects))
+    return subjects
@@ -1,12 +1,38 @@
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import io
 import os
-import glob
+import time
+import traceback
 import warnings
 import json
 
 __version__ = "0.1.0"
 
-from utils import fix_epi_runs, generate_intended_for, move_to_bids, spin_echo_intended_for
+from catalog import CATALOG_FILENAME, Catalog
+from classify import SourceResolver, get_classifier
+from discovery import find_subject_folders, get_prune_function, get_subject_id, image_selected, image_skipped
+from fsindex import SubjectIndex
+from journal import (Journal, atomic_write, get_journal_filename, remove_temporary_files, stat_output,
+                     verify_journal)
+from logs import (LOG_LEVELS, add_time, get_logging_config, log_event, log_summary, logger, merge_stats,
+                  reset_stats, setup_logging, setup_worker_logging, timed)
+from manifest import (create_source_entry, load_manifest, outputs_exist, remove_outputs, save_manifest,
+                      source_changed, stat_inputs, stat_source)
+from pipeline import run_pipeline
+from plan import PLAN_VERSION, find_outdated_intended_for, number_epi_runs, resolve_intended_for, write_plan
+from shards import read_subject_list, select_shard, write_shard_report
+from transfer import format_transfer_stats, merge_transfer_stats, reset_transfer_stats
+from sidecars import write_sidecars
+from utils import (execute_operations, generate_intended_for, get_input_files, get_output_files, get_pending_sidecars,
+                   plan_move_to_bids, prepare_outputs, spin_echo_intended_for)
+from validate import log_validation_results, validate_subject, write_validation_results
+from verify import verify_manifest, write_checksums_file
+
+# number of subject folders that are walked at once by check_sources
+CHECK_SOURCES_THREADS = 16
 
 
 def create_parser():
@@ -14,15 +40,83 @@ def create_parser():
     parser.add_argument("--output_dir", type=str, required=True,
                         help="path to output BIDS directory.")
     parser.add_argument("--dry_run", action="store_true", help="do not write files, just print what would be done.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="scan the next subjects while the files of the current subject are transferred and "
+                             "run the transfers in a thread pool. This helps on high latency network storage.")
+    parser.add_argument("--metadata_concurrency", type=int, default=16,
+                        help="with --pipeline, the maximum number of images with only metadata operations "
+                             "(hardlinks, symlinks, sidecars) that are converted at once. (default: 16)")
+    parser.add_argument("--transfer_concurrency", type=int, default=4,
+                        help="with --pipeline, the maximum number of images that are copied/moved/compressed at "
+                             "once. (default: 4)")
+    parser.add_argument("--max_in_flight", type=int, default=64,
+                        help="with --pipeline, the maximum number of images that are queued for conversion. "
+                             "(default: 64)")
+    parser.add_argument("--subject_list", type=str,
+                        help="text file with one subject id per line. Only these subjects are converted.")
+    parser.add_argument("--participant_label", type=str, nargs="+",
+                        help="only convert these subjects (subject ids or subject folder names). The subject folders "
+                             "are looked up by name instead of listing the whole dataset.")
+    parser.add_argument("--session", type=str, nargs="+",
+                        help="only convert the subject folders of these sessions/visits (e.g. V1 for "
+                             "HCA6000000_V1_MR).")
+    parser.add_argument("--modality", type=str, nargs="+",
+                        help="only convert the images of these BIDS modalities (e.g. bold sbref epi).")
+    parser.add_argument("--exclude_modality", type=str, nargs="+",
+                        help="do not convert the images of these BIDS modalities (e.g. dwi asl).")
+    parser.add_argument("--task", type=str, nargs="+",
+                        help="only convert the images of these tasks (e.g. rest carit). Images without a task "
+                             "(anatomical images, fieldmaps, ...) are not affected; use --modality to filter those.")
+    parser.add_argument("--shard_index", type=int,
+                        help="index of the shard of subjects to convert (0 to shard_count - 1), e.g. the SLURM array "
+                             "task id. Each shard writes a completion report instead of the dataset level files. "
+                             "Run finalize.py once all shards are done.")
+    parser.add_argument("--shard_count", type=int, help="total number of shards. Required with --shard_index.")
+    parser.add_argument("--save_plan", type=str,
+                        help="write the conversion plan (all the planned file operations with their final BIDS names) "
+                             "to this JSON file. Combine with --dry_run to only create the plan. The plan can be "
+                             "applied later using execute_plan.py.")
     parser.add_argument("--overwrite", action="store_true", help="overwrite existing files.")
-    parser.add_argument("--method", type=str, default="hardlink", choices=["hardlink", "symlink", "copy", "move"],
-                        help="method to use for linking files. (default: hardlink). "
+    parser.add_argument("--verify", action="store_true",
+                        help="after the conversion, compare the outputs with their sources (outputs that are "
+                             "hardlinks or symlinks of the sources are checked by their inode, copies are hashed) and "
+                             "record their checksums in the manifest and in .hcp2bids_b2sums. See verify.py.")
+    parser.add_argument("--validate", action="store_true",
+                        help="validate the outputs of each subject as soon as it is converted: NIfTI headers (read "
+                             "from the start of the gzip stream), TR against RepetitionTime, events against the run "
+                             "length, required sidecar fields, and IntendedFor targets. The results are stored in "
+                             ".hcp2bids_validation.db (by finalize.py for sharded conversions). See validate.py.")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume an interrupted conversion into the same output directory. Rerun with the same "
+                             "options. The outputs recorded in the journal and the manifest are checked by their size "
+                             "and modification time, and only the missing or incomplete outputs are written.")
+    parser.add_argument("--method", type=str, default="hardlink",
+                        choices=["hardlink", "symlink", "copy", "move", "auto"],
+                        help="method to use for linking files. (default: hardlink). 'copy' uses a reflink or an "
+                             "in-kernel copy when the filesystem supports it. 'auto' creates a hardlink and falls "
+                             "back to 'copy' when the output is on a different filesystem. "
                              "JSON sidecars will always be copied as these are edited to comply with BIDS formatting.")
     parser.add_argument("--use_bids_uris", action="store_true",
                         help="use BIDS URIs for setting the IntendedFor field for single bad reference and spin echo "
                              "images. This is now required by BIDS, but I am not making it the default because fMRIprep"
                              " does not support it yet. "
                              "(https://bids-specification.readthedocs.io/en/stable/04-modality-specific-files/01-magnetic-resonance-imaging-data.html#using-intendedfor-metadata)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of subjects to convert in parallel. (default: 1). "
+                             "Each subject is converted by a separate worker process.")
+    parser.add_argument("--intended_for_acquisition_time", action="store_true",
+                        help="if an IntendedFor target of a spin echo fieldmap was not converted (e.g. a missing "
+                             "run), point to the converted image of the same type acquired closest in time to the "
+                             "fieldmap instead of removing the target.")
+    parser.add_argument("--classification_rules", type=str,
+                        help="JSON file with the rules that map the HCP file names to BIDS modalities and entities. "
+                             "(default: classification_rules.json in the code directory)")
+    parser.add_argument("--log_level", type=str, choices=LOG_LEVELS,
+                        help="minimum level of the printed messages. DEBUG prints every file operation. "
+                             "(default: DEBUG with --dry_run, INFO otherwise)")
+    parser.add_argument("--log_json", type=str,
+                        help="append every log message as a JSON object (one per line) to this file, including the "
+                             "summary of the time spent in each phase of the conversion.")
 
     return parser
 
@@ -35,6 +129,10 @@ def parse_args():
     parser.add_argument("--name", type=str, default="auto",
                         help="name of the dataset. (default: 'auto'). 'auto' will try to determine if the dataset is "
                              "the HCP Aging or HCP Development dataset based on the contents of the nda_dir.")
+    parser.add_argument("--physio_sampling_frequency", type=float,
+                        help="sampling frequency (Hz) of the physio csv files. If set, the physio csv files are "
+                             "converted to BIDS _physio.tsv.gz files with a JSON sidecar. Otherwise, the csv files are "
+                             "copied as is and listed in the .bidsignore file.")
     # TODO: add option to use the Siemens bias field corrected images instead of the raw images
     return parser.parse_args()
 
@@ -44,18 +142,19 @@ def write_bids_dataset_metadata_files(bids_dir, name):
     dataset_description = {"Name": name, "BIDSVersion": "1.8.0", "DatasetType": "raw",
                            "GeneratedBy": [{"Name": "HCPLifespanBIDS", "Version": __version__,
                                            "CodeURL": "https://github.com/ellisdg/HCPLifespan2BIDS"}]}
-    with open(os.path.join(bids_dir, "dataset_description.json"), "w") as f:
+    with atomic_write(os.path.join(bids_dir, "dataset_description.json")) as f:
         json.dump(dataset_description, f, indent=4, sort_keys=False)
 
     # write README
-    with open(os.path.join(bids_dir, "README"), "w") as f:
+    with atomic_write(os.path.join(bids_dir, "README")) as f:
         f.write("This is a BIDS dataset generated from the HCP Lifespan datasets using HCPLifespan2BIDS.\n")
 
     # write bidsignore
-    with open(os.path.join(bids_dir, ".bidsignore"), "w") as f:
+    with atomic_write(os.path.join(bids_dir, ".bidsignore")) as f:
         f.write("*.mp4\n")
         # TODO: convert physio files to tsv and make sure the correct columns are present
         f.write("*_physio.csv\n")
+        f.write(CATALOG_FILENAME + "\n")
         # TODO: fix metadata for ASL files so that it conforms to BIDS standard
         f.write("perf/\n")
 
@@ -86,125 +185,607 @@ def set_phase_encoding_direction(kwargs, image_file, dirs=("AP", "PA")):
         kwargs["dir"] = pe_dir
 
 
-def find_gradient_unwarped_file(image_file):
-    gradunwarp_file = image_file.replace("unprocessed/3T", "gradunwarp")
-    if not os.path.exists(gradunwarp_file):
-        raise ValueError(f"Gradient unwarped file not found: {gradunwarp_file}")
-    return gradunwarp_file
-
-
-def run(wildcard, use_bids_uris=False, pe_dirs=("AP", "PA"), output_dir=".", method="hardlink", overwrite=False,
-        dry_run=False, name="auto", grad_unwarp=False, skip_bias=True, t1w_use_derived=False, t2w_use_derived=False,
-        skip=(), use_precompiled_sidecars=False, sort_by_run_name=False):
-    print("Searching for subjects with wildcard: {}".format(wildcard))
-    subject_folders = sorted(glob.glob(wildcard))
-    print("Found {} subjects.".format(len(subject_folders)))
-    for subject_folder in subject_folders:
-        print("Processing subject: {}".format(subject_folder))
-        subject_id = os.path.basename(subject_folder).split("_")[0]
-
-        image_files = glob.glob(os.path.join(subject_folder, "unprocessed/**/*.nii.gz"), recursive=True)
-        print("Found {} image files.".format(len(image_files)))
-        for image_file in image_files:
+def plan_subject(subject_folder, use_bids_uris=False, pe_dirs=("AP", "PA"), output_dir=".", method="hardlink",
+                 overwrite=False, grad_unwarp=False, skip_bias=True, t1w_use_derived=False, t2w_use_derived=False,
+                 skip=(), use_precompiled_sidecars=False, sort_by_run_name=False, physio_sampling_frequency=None,
+                 previous=None, rules_file=None, match_acquisition_time=False, resumed=None, modalities=None,
+                 exclude_modalities=None, tasks=None):
+    """
+    Plans the conversion of a single subject without writing any files.
+    :param rules_file: JSON file with the classification rules (default: classification_rules.json).
+    :param match_acquisition_time: replace IntendedFor targets of the fieldmaps that are not converted with the
+    converted image of the same type that was acquired closest in time (see plan.resolve_intended_for).
+    :param previous: The manifest entry of the subject from a previous conversion. Source files that have not changed
+    since then are not planned again.
+    :param resumed: The sources and operations of the subject that an interrupted conversion completed (see
+    journal.verify_journal). The completed sources are not planned again, the completed operations are skipped, and
+    the outputs in the manifest are checked by their size and modification time only.
+    :param modalities: only plan the images of these BIDS modalities (default: all modalities).
+    :param exclude_modalities: do not plan the images of these BIDS modalities.
+    :param tasks: only plan the images of these tasks (images without a task entity are not filtered).
+    Images that are filtered out keep the outputs of a previous conversion.
+    :return: The subject plan with the planned operations for each new or changed image.
+    """
+    subject_id = get_subject_id(subject_folder)
+    classifier = get_classifier(rules_file)
+    options = {"grad_unwarp": grad_unwarp, "skip_bias": skip_bias, "t1w_use_derived": t1w_use_derived,
+               "t2w_use_derived": t2w_use_derived}
+    log_event("plan_subject", "Planning subject: {}".format(subject_folder), subject=subject_id)
+
+    with timed("scan"):
+        # walk the subject folder once; the auxiliary files of each image are looked up in this index
+        root = os.path.abspath(os.path.join(subject_folder, "unprocessed"))
+        index = SubjectIndex(root, prune=get_prune_function(classifier, skip=skip, options=options, root=root))
+        image_files = index.find(".nii.gz")
+        logger.info("Found %d image files.", len(image_files))
+        image_files = [image_file for image_file in image_files
+                       if not (classifier.excluded(image_file, options=options, root=root)
+                               or image_skipped(image_file, skip=skip, root=root))]
+
+        previous_sources = dict() if previous is None or overwrite else previous["sources"]
+        completed = set()
+        if resumed is not None:
+            previous_sources = dict(previous_sources, **resumed["sources"])
+            completed = {os.path.join(output_dir, output_file) for output_file in resumed["operations"]}
+        unchanged = {image_file: previous_sources[image_file] for image_file in image_files
+                     if not source_changed(previous_sources.get(image_file), image_file, output_dir,
+                                           quick=resumed is not None)}
+    changed_files = include_all_fieldmaps([image_file for image_file in image_files if image_file not in unchanged],
+                                          unchanged)
+    resolver = SourceResolver()
+    changed_files = remove_duplicate_sources(changed_files, unchanged, classifier, resolver, options, root=root)
+    subject_plan = {"subject_id": subject_id, "subject_folder": subject_folder, "unchanged": unchanged,
+                    "groups": list()}
+    if len(changed_files) == 0:
+        logger.info("No new or changed image files for subject: %s", subject_id)
+    else:
+        logger.info("Planning %d new or changed image files.", len(changed_files))
+
+    unmatched_sidecars = list()
+    classify_start = time.perf_counter()
+    planned = set()
+    while len(changed_files) > 0:
+        for image_file in changed_files:
+            planned.add(image_file)
             # keep track of the original image file
             orig_image_file = image_file
 
-            if os.path.dirname(image_file).endswith("OTHER_FILES"):
-                continue
-
-            if skip_bias and "BIAS" in image_file:
-                continue
-
-            if any([skip_str in image_file for skip_str in skip]):
-                continue
-
-            print("Processing image file: {}".format(image_file))
+            logger.debug("Processing image file: %s", image_file)
 
             kwargs = dict()
             intended_for = None
 
             set_phase_encoding_direction(kwargs, image_file, dirs=pe_dirs)
 
-            if "SpinEchoFieldMap" in image_file:
-                bids_modality = "epi"
-                folder = "fmap"
-                basename = os.path.basename(os.path.dirname(image_file))
-                run = basename.lower()
-                if "_" in run:
-                    run = "".join(run.split("_")[1:]).lower()
-                # match = re.search(r"SpinEchoFieldMap(\d+)", image_file)
-                # if match:
-                #     run = run + match.group(1)
-                kwargs["run"] = run
-                intended_for = spin_echo_intended_for(subject_id, use_bids_uris, basename, image_file)
-
-            elif "T1w" in image_file:
-                folder = "anat"
-                bids_modality = "T1w"
-                if t1w_use_derived:
-                    image_file = os.path.join(image_file.split("unprocessed")[0], "T1w", "T1w_acpc_dc.nii.gz")
-                    if not os.path.exists(image_file):
-                        raise ValueError(f"Derived T1w file not found: {image_file}")
-            elif "T2w" in image_file:
-                folder = "anat"
-                bids_modality = "T2w"
-                if t2w_use_derived:
-                    image_file = os.path.join(image_file.split("unprocessed")[0], "T1w", "T2w_acpc_dc.nii.gz")
-                    if not os.path.exists(image_file):
-                        raise ValueError(f"Derived T2w file not found: {image_file}")
-            elif "fMRI" in image_file:
-                if grad_unwarp:
-                    image_file = find_gradient_unwarped_file(image_file)
-                folder = "func"
-                bids_modality = "bold"
-                task = os.path.basename(os.path.dirname(image_file))
-                if "_" in task:
-                    task = task.split("_")[1].lower()
-                if "rest" in task:
-                    run = task.split("rest")[1]
-                    task = "rest"
-                    kwargs["run"] = run
-                kwargs["task"] = task
-            elif "Diffusion" in image_file:
-                folder = "dwi"
-                bids_modality = "dwi"
-                # dir 98 scans are acquired before dir99 scans
-                if "dir98" in image_file:
-                    kwargs["run"] = "1"
-                elif "dir99" in image_file:
-                    kwargs["run"] = "2"
-            elif "PCASL" in image_file:
-                bids_modality = "asl"
-                folder = "perf"
-            elif "HiResHp" in image_file:
-                bids_modality = "T2w"
-                folder = "anat"
-                kwargs["acq"] = "highres"
+            classification = classifier.classify(image_file, entities=kwargs, options=options, resolver=resolver,
+                                                 root=root)
+            if not image_selected(classification, modalities=modalities, exclude_modalities=exclude_modalities,
+                                  tasks=tasks):
+                logger.debug("Filtered out image file: %s", image_file)
+                if image_file in previous_sources:
+                    subject_plan["unchanged"][image_file] = previous_sources[image_file]
+                continue
+            image_file = classification["image_file"]
+            bids_modality = classification["modality"]
+            folder = classification["folder"]
+            kwargs = classification["entities"]
+            if bids_modality is None:
+                logger.warning("Unknown modality: %s", image_file)
+
+            if classification["intended_for"] == "fieldmap":
+                basename = os.path.basename(os.path.dirname(orig_image_file))
+                intended_for = spin_echo_intended_for(subject_id, use_bids_uris, basename, orig_image_file,
+                                                      classifier=classifier)
+            elif classification["intended_for"] == "image":
+                intended_for = generate_intended_for(subject_id=subject_id,
+                                                     modality=classification["image_modality"], folder=folder,
+                                                     bids_uris=use_bids_uris, **kwargs)
+
+            group = plan_move_to_bids(image_file=image_file, bids_dir=output_dir, subject_id=subject_id,
+                                      folder=folder, orig_image_file=orig_image_file, modality=bids_modality,
+                                      method=method, intended_for=intended_for,
+                                      use_precompiled_sidecars=use_precompiled_sidecars, index=index,
+                                      physio_sampling_frequency=physio_sampling_frequency,
+                                      unmatched_sidecars=unmatched_sidecars, **kwargs)
+            # the outputs from a previous conversion of this file are removed before converting it again
+            group["previous_outputs"] = [output_file for output_file in
+                                         previous_sources.get(orig_image_file, {"outputs": list()})["outputs"]
+                                         if os.path.join(output_dir, output_file) not in completed]
+            subject_plan["groups"].append(group)
+        # unchanged images (e.g. fieldmaps) whose IntendedFor targets were missing when they were converted are
+        # planned again if these targets are planned now
+        changed_files = include_all_fieldmaps(find_outdated_intended_for(subject_plan, output_dir, planned=planned),
+                                              unchanged, planned=planned)
+        if len(changed_files) > 0:
+            logger.info("Planning %d images again to complete their IntendedFor fields.", len(changed_files))
+    add_time("classify", time.perf_counter() - classify_start)
+    carry_over_missing_sources(subject_plan, dict(dict() if previous is None else previous["sources"],
+                                                  **previous_sources), output_dir, planned=planned)
+    if len(unmatched_sidecars) > 0:
+        # reported once per subject, before anything is written
+        warnings.warn("No precompiled sidecar template for {} outputs of subject {}: {}".format(
+            len(unmatched_sidecars), subject_id, ", ".join([os.path.basename(sidecar)
+                                                             for sidecar in sorted(unmatched_sidecars)])))
+
+    # the fieldmaps get their final run numbers before anything is written
+    with timed("fmap_renumber"):
+        number_epi_runs(subject_plan["groups"], pe_dirs=pe_dirs, sort_by_run_name=sort_by_run_name)
+
+    if resumed is not None:
+        for group in subject_plan["groups"]:
+            group["completed"] = [output_file for output_file in get_output_files(group) if output_file in completed]
+
+    # the IntendedFor fields only list files that the subject will actually have
+    with timed("intended_for"):
+        resolve_intended_for(subject_plan, output_dir, match_acquisition_time=match_acquisition_time)
+
+    logger.debug("Index for subject %s: %s", subject_id, index.summary())
+    subject_plan["index"] = dict(index.counters)
+    return subject_plan
+
+
+def carry_over_missing_sources(subject_plan, previous_sources, output_dir, planned=()):
+    """
+    The sources that are not found anymore (e.g. they were moved by --method move or removed from the input folder)
+    or that are skipped now keep their entry in the manifest as long as all their outputs exist.
+    :param planned: the images that are converted again.
+    """
+    missing = {source: entry for source, entry in previous_sources.items()
+               if source not in planned and source not in subject_plan["unchanged"]}
+    kept = {source: entry for source, entry in missing.items() if outputs_exist(entry, output_dir)}
+    if len(kept) > 0:
+        logger.info("Keeping the outputs of %d sources that are not converted anymore.", len(kept))
+    if len(kept) < len(missing):
+        logger.info("Dropping %d sources whose outputs are missing from the manifest.", len(missing) - len(kept))
+    subject_plan["unchanged"].update(kept)
+
+
+def is_fieldmap(image_file):
+    return "SpinEchoFieldMap" in os.path.basename(image_file)
+
+
+def include_all_fieldmaps(image_files, unchanged, planned=()):
+    """
+    The epi runs are numbered across the whole subject, so if any fieldmap is converted, all the fieldmaps are
+    converted again.
+    :param planned: the images that were already planned.
+    :return: the images to convert. They are removed from the unchanged images.
+    """
+    image_files = list(image_files)
+    if any([is_fieldmap(image_file) for image_file in image_files]):
+        image_files.extend([image_file for image_file in unchanged if is_fieldmap(image_file)
+                            and image_file not in image_files and image_file not in planned])
+    for image_file in image_files:
+        unchanged.pop(image_file, None)
+    return image_files
+
+
+def remove_duplicate_sources(image_files, unchanged, classifier, resolver, options, root=None):
+    """
+    Several images can resolve to the same preprocessed/derived file (e.g. all the T1w runs of an HCP-YA subject
+    resolve to T1w/T1w_acpc_dc.nii.gz). That file is converted once, for the first of these images, and the other images
+    are removed before anything is planned.
+    """
+    converted = {in_file for entry in unchanged.values() for in_file in entry.get("copied_from", dict()).values()}
+    duplicates = set()
+    for image_file in sorted(image_files):
+        resolved, _ = classifier.resolve(image_file, resolver, options=options, root=root)
+        if resolved == image_file:
+            continue
+        if resolved in converted:
+            logger.info("Skipping %s: %s is already converted.", image_file, resolved)
+            duplicates.add(image_file)
+        converted.add(resolved)
+    return [image_file for image_file in image_files if image_file not in duplicates]
+
+
+def check_subject_sources(subject_folder, rules_file=None, skip=(), options=None):
+    """
+    Finds the preprocessed/derived files (e.g. the gradunwarp outputs) that the images of a subject resolve to but
+    that do not exist.
+    :return: list of the missing files.
+    """
+    classifier = get_classifier(rules_file)
+    root = os.path.abspath(os.path.join(subject_folder, "unprocessed"))
+    index = SubjectIndex(root, prune=get_prune_function(classifier, skip=skip, options=options, root=root))
+    resolver = SourceResolver()
+    missing = list()
+    for image_file in index.find(".nii.gz"):
+        if (classifier.excluded(image_file, options=options, root=root)
+                or image_skipped(image_file, skip=skip, root=root)):
+            continue
+        resolved, exists = classifier.resolve(image_file, resolver, options=options, root=root)
+        if not exists and resolved not in missing:
+            missing.append(resolved)
+    return missing
+
+
+def check_sources(subject_folders, jobs=CHECK_SOURCES_THREADS, **kwargs):
+    """
+    Checks that the preprocessed/derived files of all the subjects exist before anything is converted, so that a
+    conversion with missing gradunwarp outputs fails at the start instead of when it reaches that subject. The
+    subject folders are walked in a thread pool, since the walks mostly wait for the filesystem.
+    """
+    with timed("scan"), concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        missing = dict(zip(subject_folders, executor.map(functools.partial(check_subject_sources, **kwargs),
+                                                         subject_folders)))
+    missing = {subject_folder: files for subject_folder, files in missing.items() if len(files) > 0}
+    logger.info("Checked the preprocessed/derived files of %d subjects.", len(subject_folders))
+    if len(missing) > 0:
+        raise ValueError("Missing {} preprocessed/derived files of {} subjects:\n{}".format(
+            sum([len(files) for files in missing.values()]), len(missing),
+            "\n".join([filename for files in missing.values() for filename in files])))
+
+
+def execute_subject_plan(subject_plan, output_dir=".", overwrite=False, dry_run=False, journal=None,
+                         validate=False, catalog=None):
+    """
+    Applies the planned operations of a single subject.
+    :param journal: Journal in which the completed operations are recorded (see journal.py).
+    :param catalog: Catalog that is updated with the outputs of each image once they are written (see catalog.py).
+    :param validate: validate the outputs of the subject once they are written (see validate.py).
+    :return: The manifest entry of the subject.
+    """
+    log_event("convert_subject", "Converting subject: {}".format(subject_plan["subject_folder"]),
+              subject=subject_plan["subject_id"], images=len(subject_plan["groups"]))
+    reset_transfer_stats()
+    groups = subject_plan["groups"]
+    prepared = [None] * len(groups)
+    written = set()
+    if not dry_run:
+        # the outdated outputs of all the images are removed before the sidecars of the subject are written in one
+        # batch, so that the cleanup of an image cannot remove a sidecar that was just written for another image
+        for group in groups:
+            remove_outputs(group["previous_outputs"], output_dir)
+        prepared = [prepare_outputs(group, overwrite=overwrite) for group in groups]
+        written = write_sidecars([operation for group, ready in zip(groups, prepared) if ready
+                                  for operation in get_pending_sidecars(group)])
+    results = [execute_group(group, output_dir=output_dir, overwrite=overwrite, dry_run=dry_run, journal=journal,
+                             catalog=catalog, prepared=ready, written=written)
+               for group, ready in zip(groups, prepared)]
+    # the transfer statistics and validation results are removed from the entry before it is saved in the manifest
+    entry = {"sources": collect_sources(subject_plan, results), "transfers": reset_transfer_stats()}
+    if validate and not dry_run:
+        entry["validation"] = validate_subject(output_dir, subject_plan["subject_id"])
+    return entry
+
+
+def execute_group(group, output_dir=".", overwrite=False, dry_run=False, journal=None, catalog=None, prepared=None,
+                  written=()):
+    """
+    Applies the planned operations of a single image.
+    :param journal: Journal in which the completed operations and the manifest entry are recorded.
+    :param catalog: Catalog in which the outputs are recorded.
+    :param prepared: the result of utils.prepare_outputs if the outdated outputs of the group were already removed.
+    :param written: the sidecars that were already written in a batch.
+    :return: the source image and its manifest entry (None for a dry run).
+    """
+    if prepared is None:
+        remove_outputs(group["previous_outputs"], output_dir, dryrun=dry_run)
+    source_stat = stat_source(group["source"])
+    input_stats = stat_inputs(get_input_files(group))
+    on_complete = None
+    if journal is not None:
+        subject = get_output_subject_id(group["output_file"], output_dir)
+        on_complete = functools.partial(record_operation, journal, subject, output_dir)
+    output_files = execute_operations(group, overwrite=overwrite, dryrun=dry_run, on_complete=on_complete,
+                                      prepared=prepared, written=written)
+    if dry_run:
+        return group["source"], None
+    copied_from = {operation["out_file"]: operation["in_file"] for operation in group["operations"]
+                   if operation["action"] == "transfer"}
+    entry = create_source_entry(group["source"], output_files, output_dir, source_stat=source_stat,
+                                copied_from=copied_from, input_stats=input_stats)
+    if group.get("dropped_intended_for"):
+        # the image is converted again once these IntendedFor targets are converted (see plan_subject)
+        entry["dropped_intended_for"] = group["dropped_intended_for"]
+    # the catalog is updated before the source is recorded as completed in the journal, so that a resumed conversion
+    # converts the source again (and updates the catalog) if the process is killed in between
+    if catalog is not None:
+        catalog.update_source(group["source"], entry, removed=group["previous_outputs"])
+    if journal is not None:
+        journal.record("source", subject=subject, source=group["source"], entry=entry)
+    return group["source"], entry
+
+
+def record_operation(journal, subject, output_dir, output_file):
+    journal.record("operation", subject=subject, output=os.path.relpath(output_file, output_dir),
+                   stat=stat_output(output_file))
+
+
+def get_output_subject_id(output_file, output_dir):
+    # the outputs are in output_dir/sub-<subject_id>/
+    return os.path.relpath(output_file, output_dir).split(os.sep)[0][len("sub-"):]
+
+
+def collect_sources(subject_plan, results):
+    sources = dict(subject_plan["unchanged"])
+    for source, source_entry in results:
+        if source_entry is not None:
+            sources[source] = source_entry
+    return sources
+
+
+def run_subjects_pipelined(subject_folders, previous, output_dir=".", overwrite=False, dry_run=False,
+                           pipeline_options=None, journal=None, validate=False, catalog=None, **kwargs):
+    """
+    Converts the subjects with the pipelined executor (see pipeline.py), which scans the next subjects while the
+    files of the current subject are being transferred.
+    :return: dictionary mapping the subject folders to their plan and manifest entry.
+    """
+    plan_function = functools.partial(plan_subject_with_previous, previous=previous, output_dir=output_dir,
+                                      overwrite=overwrite, **kwargs)
+    execute_function = functools.partial(execute_group, output_dir=output_dir, overwrite=overwrite, dry_run=dry_run,
+                                         journal=journal, catalog=catalog)
+    reset_transfer_stats()
+    results = run_pipeline(subject_folders, plan_function, execute_function, **(pipeline_options or dict()))
+    transfers = reset_transfer_stats()
+    converted = dict()
+    for subject_folder, (subject_plan, group_results) in results.items():
+        converted[subject_folder] = (subject_plan, {"sources": collect_sources(subject_plan, group_results),
+                                                    "transfers": dict()})
+        if validate and not dry_run:
+            converted[subject_folder][1]["validation"] = validate_subject(output_dir, subject_plan["subject_id"])
+    if len(converted) > 0:
+        # the transfers of overlapping subjects cannot be told apart, so the totals are reported with the first one
+        converted[subject_folders[0]][1]["transfers"] = transfers
+    return converted
+
+
+def plan_subject_with_previous(subject_folder, previous, **kwargs):
+    return plan_subject(subject_folder, **previous[subject_folder], **kwargs)
+
+
+def convert_subject(subject_folder, output_dir=".", overwrite=False, dry_run=False, journal=None, validate=False,
+                    catalog=None, **kwargs):
+    """
+    Plans and converts a single subject.
+    :return: The subject plan and the manifest entry of the subject.
+    """
+    subject_plan = plan_subject(subject_folder, output_dir=output_dir, overwrite=overwrite, **kwargs)
+    entry = execute_subject_plan(subject_plan, output_dir=output_dir, overwrite=overwrite, dry_run=dry_run,
+                                 journal=journal, validate=validate, catalog=catalog)
+    return subject_plan, entry
+
+
+def subject_worker(function, subject_folder, **kwargs):
+    """
+    Runs function(subject_folder, **kwargs) in a worker process and collects the printed output and warnings for that
+    subject so that the logs of different subjects do not get interleaved.
+    Exceptions are caught and returned so that a single failing subject does not stop the other workers.
+    The timers and counters of the subject (see logs.py) are returned as well.
+    """
+    reset_stats()
+    log = io.StringIO()
+    result = {"subject_folder": subject_folder, "error": None}
+    with contextlib.redirect_stdout(log), warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter("always")
+        try:
+            result["value"] = function(subject_folder, **kwargs)
+        except Exception:
+            result["error"] = traceback.format_exc()
+    result["log"] = log.getvalue()
+    result["warnings"] = [str(w.message) for w in caught_warnings]
+    result["stats"] = reset_stats()
+    return result
+
+
+def run_subjects_in_parallel(function, subject_folders, jobs, subject_kwargs=None, **kwargs):
+    """
+    Runs function(subject_folder, **kwargs) for each subject using a pool of worker processes. Each worker owns the
+    output folder of one subject. The logs and warnings of each subject are printed once the subject is finished.
+    :param subject_kwargs: optional dictionary mapping the subject folders to extra keyword arguments for that subject.
+    :return: dictionary mapping the subject folders to the values returned by the function and a list of the subject
+    folders that failed.
+    """
+    if subject_kwargs is None:
+        subject_kwargs = dict()
+    values = dict()
+    failed = list()
+    # the workers log with the same level and to the same JSON-lines file as the main process
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=setup_worker_logging,
+                                                initargs=get_logging_config()) as executor:
+        futures = [executor.submit(subject_worker, function, subject_folder,
+                                   **subject_kwargs.get(subject_folder, dict()), **kwargs)
+                   for subject_folder in subject_folders]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            print(result["log"], end="")
+            merge_stats(result["stats"])
+            for message in result["warnings"]:
+                logger.warning("Warning (%s): %s", os.path.basename(result["subject_folder"]), message)
+            if result["error"] is not None:
+                logger.error("Failed to convert subject: %s\n%s", result["subject_folder"], result["error"])
+                failed.append(result["subject_folder"])
             else:
-                folder = None
-                bids_modality = None
-                print("Unknown modality: {}".format(image_file))
+                values[result["subject_folder"]] = result["value"]
+    return values, failed
 
-            if "SBRef" in image_file:
-                intended_for = generate_intended_for(subject_id=subject_id, modality=bids_modality, folder=folder,
-                                                     bids_uris=use_bids_uris, **kwargs)
-                # overwrite the modality to be sbref
-                bids_modality = "sbref"
 
-            move_to_bids(image_file=image_file, bids_dir=output_dir, subject_id=subject_id, folder=folder,
-                         orig_image_file=orig_image_file, modality=bids_modality, method=method, overwrite=overwrite,
-                         dryrun=dry_run, intended_for=intended_for, use_precompiled_sidecars=use_precompiled_sidecars,
-                         **kwargs)
+def print_index_totals(subject_plans):
+    index_totals = dict()
+    for subject_plan in subject_plans:
+        for key, value in subject_plan["index"].items():
+            index_totals[key] = index_totals.get(key, 0) + value
+    if len(index_totals) > 0:
+        logger.info("Subject indexes: {scandir} directories scanned ({pruned} pruned), {queries} lookups answered "
+                    "from memory (saving {listdir_saved} directory listings), {fallback_glob} fallback "
+                    "globs.".format(**dict({"pruned": 0}, **index_totals)))
+
 
-    first_subject_id = os.path.basename(subject_folders[0]).split("_")[0]
-    write_bids_dataset_metadata_files(output_dir, name=get_dataset_name(name, first_subject_id))
+def run(wildcard, use_bids_uris=False, pe_dirs=("AP", "PA"), output_dir=".", method="hardlink", overwrite=False,
+        dry_run=False, name="auto", grad_unwarp=False, skip_bias=True, t1w_use_derived=False, t2w_use_derived=False,
+        skip=(), use_precompiled_sidecars=False, sort_by_run_name=False, jobs=1, plan_file=None, subject_list=None,
+        shard_index=None, shard_count=None, physio_sampling_frequency=None, pipeline_options=None, rules_file=None,
+        match_acquisition_time=False, resume=False, verify=False, validate=False, participant_label=None,
+        sessions=None, modalities=None, exclude_modalities=None, tasks=None, check_sources_first=False):
+    """
+    Converts the subjects that match the wildcard.
+    :param participant_label: only convert these subjects (subject ids or subject folder names). Combined with the
+    subjects of the subject_list file.
+    :param sessions: only convert the subject folders of these sessions (visits, e.g. V1).
+    :param modalities: only convert the images of these BIDS modalities.
+    :param exclude_modalities: do not convert the images of these BIDS modalities.
+    :param tasks: only convert the images of these tasks.
+    :param check_sources_first: check that the preprocessed/derived files of all the subjects exist before converting
+    any subject (see check_sources).
+    :param resume: resume an interrupted conversion into the same output directory with the same options. The
+    operations recorded in the journal (see journal.py) and the outputs in the manifest are checked by their size and
+    modification time, and only the missing or incomplete outputs are written.
+    :param verify: compare the converted outputs with their sources and record their checksums (see verify.py).
+    :param validate: validate the outputs of each subject once it is converted and store the results in the
+    validation database (see validate.py).
+    """
+    if resume and overwrite:
+        raise ValueError("A conversion cannot be resumed with overwrite.")
+    start = time.perf_counter()
+    reset_stats()
+    labels = None
+    if subject_list is not None or participant_label is not None:
+        labels = set(participant_label or ())
+        if subject_list is not None:
+            labels.update(read_subject_list(subject_list))
+    logger.info("Searching for subjects with wildcard: %s", wildcard)
+    with timed("scan"):
+        subject_folders = find_subject_folders(wildcard, labels=labels, sessions=sessions)
+    logger.info("Found %d subjects%s.", len(subject_folders), "" if labels is None else " of the {} selected".format(
+        len(labels)))
+    if len(subject_folders) == 0:
+        raise ValueError("No subject folders found: {}".format(wildcard))
+    # the dataset name is taken from the subjects before sharding, so that it is the same for every shard
+    dataset_name = get_dataset_name(name, get_subject_id(subject_folders[0]))
+    if (shard_index is None) != (shard_count is None):
+        raise ValueError("shard_index and shard_count must be set together.")
+    if shard_count is not None:
+        subject_folders = select_shard(subject_folders, shard_index, shard_count, get_subject_id)
+        logger.info("Converting %d subjects in shard %d of %d.", len(subject_folders), shard_index, shard_count)
+    if check_sources_first:
+        check_sources(subject_folders, rules_file=rules_file, skip=skip,
+                      options={"grad_unwarp": grad_unwarp, "skip_bias": skip_bias, "t1w_use_derived": t1w_use_derived,
+                               "t2w_use_derived": t2w_use_derived})
+    kwargs = dict(use_bids_uris=use_bids_uris, pe_dirs=pe_dirs, output_dir=output_dir, method=method,
+                  overwrite=overwrite, dry_run=dry_run, grad_unwarp=grad_unwarp, skip_bias=skip_bias,
+                  t1w_use_derived=t1w_use_derived, t2w_use_derived=t2w_use_derived, skip=skip,
+                  use_precompiled_sidecars=use_precompiled_sidecars, sort_by_run_name=sort_by_run_name,
+                  physio_sampling_frequency=physio_sampling_frequency, rules_file=rules_file,
+                  match_acquisition_time=match_acquisition_time, validate=validate, modalities=modalities,
+                  exclude_modalities=exclude_modalities, tasks=tasks)
+    manifest = load_manifest(output_dir)
+    previous = {subject_folder: {"previous": manifest["subjects"].get(get_subject_id(subject_folder))}
+                for subject_folder in subject_folders}
+    journal = None
     if not dry_run:
-        fix_epi_runs(output_dir, pe_dirs=pe_dirs, sort_by_run_name=sort_by_run_name)
+        journal = Journal(get_journal_filename(output_dir, shard_index=shard_index, shard_count=shard_count))
+        if resume:
+            resumed = verify_journal(journal.read(), output_dir)
+            for subject_folder in subject_folders:
+                subject_id = get_subject_id(subject_folder)
+                previous[subject_folder]["resumed"] = resumed.get(subject_id, {"sources": dict(), "operations": list()})
+                remove_temporary_files(os.path.join(output_dir, "sub-{}".format(subject_id)))
+        elif os.path.exists(journal.filename) and not overwrite:
+            # the outputs of the interrupted conversion are not in the manifest yet, and they would be skipped as
+            # existing files without any record of them
+            raise ValueError("Found the journal of an interrupted conversion: {}. Use --resume to continue that "
+                             "conversion or --overwrite to start over.".format(journal.filename))
+        elif os.path.exists(journal.filename):
+            logger.warning("Found the journal of an interrupted conversion: %s. Starting over with --overwrite.",
+                           journal.filename)
+            journal.remove()
+        kwargs["journal"] = journal
+        if shard_count is None:
+            # the catalog (bids_catalog.db) is updated as the outputs of each image are written. The shards do not
+            # write to it; finalize.py builds the catalog of their subjects from the merged manifest.
+            kwargs["catalog"] = Catalog(output_dir)
+    failed = list()
+    if jobs > 1 and pipeline_options is not None:
+        raise ValueError("The pipelined executor runs in a single process and cannot be combined with jobs > 1.")
+    elif jobs > 1:
+        results, failed = run_subjects_in_parallel(convert_subject, subject_folders, jobs, subject_kwargs=previous,
+                                                   **kwargs)
+    elif pipeline_options is not None:
+        results = run_subjects_pipelined(subject_folders, previous, pipeline_options=pipeline_options, **kwargs)
+    else:
+        results = dict()
+        for subject_folder in subject_folders:
+            results[subject_folder] = convert_subject(subject_folder, **previous[subject_folder], **kwargs)
+
+    subject_plans = list()
+    transfer_totals = dict()
+    validation_results = list()
+    for subject_folder in subject_folders:
+        if subject_folder in results:
+            subject_plan, entry = results[subject_folder]
+            subject_plans.append(subject_plan)
+            merge_transfer_stats(transfer_totals, entry.pop("transfers"))
+            if "validation" in entry:
+                validation_results.append(entry.pop("validation"))
+            manifest["subjects"][get_subject_id(subject_folder)] = entry
+    print_index_totals(subject_plans)
+    if len(validation_results) > 0:
+        if shard_count is None:
+            write_validation_results(output_dir, validation_results)
+        log_validation_results(validation_results)
+    problems = list()
+    if verify and not dry_run:
+        problems = verify_manifest(manifest, output_dir, subject_ids={get_subject_id(folder) for folder in results},
+                                   recheck=False)
+    if len(transfer_totals) > 0:
+        logger.info("Transfers: %s", format_transfer_stats(transfer_totals))
+
+    if plan_file is not None:
+        write_plan(plan_file, {"version": PLAN_VERSION, "output_dir": output_dir, "name": dataset_name,
+                               "subjects": subject_plans})
+    if shard_count is not None and not dry_run:
+        # the shards do not touch any shared files; finalize.py merges the reports and writes the dataset level files
+        # and the validation results
+        shard_subjects = {get_subject_id(subject_folder): manifest["subjects"][get_subject_id(subject_folder)]
+                          for subject_folder in results}
+        write_shard_report(output_dir, shard_index, shard_count,
+                           {"shard_index": shard_index, "shard_count": shard_count, "name": dataset_name,
+                            "subjects": shard_subjects, "failed": failed, "validation": validation_results})
+    elif not dry_run:
+        # the dataset level files are written once all subjects have been converted
+        write_bids_dataset_metadata_files(output_dir, name=dataset_name)
+        save_manifest(output_dir, manifest)
+        if verify:
+            write_checksums_file(output_dir, manifest)
+    if "catalog" in kwargs:
+        kwargs["catalog"].close()
+    if journal is not None and len(failed) == 0:
+        # the completed operations are recorded in the manifest or the shard report now
+        journal.remove()
+    log_summary(elapsed=time.perf_counter() - start)
+
+    if len(failed) > 0:
+        raise RuntimeError("Failed to convert {} of {} subjects:\n{}".format(len(failed), len(subject_folders),
+                                                                            "\n".join(sorted(failed))))
+    if len(problems) > 0:
+        raise RuntimeError("Verification failed for {} outputs:\n{}".format(len(problems), "\n".join(problems)))
+
+
+def get_pipeline_options(args):
+    if not args.pipeline:
+        return None
+    return {"metadata_concurrency": args.metadata_concurrency, "transfer_concurrency": args.transfer_concurrency,
+            "max_in_flight": args.max_in_flight}
+
+
+def setup_logging_from_args(args):
+    level = args.log_level
+    if level is None:
+        # a dry run prints every planned file operation
+        level = "DEBUG" if args.dry_run else "INFO"
+    setup_logging(level, json_file=args.log_json)
+
+
+def get_nda_wildcard(nda_dir):
+    return os.path.join(nda_dir, "imagingcollection01/HC*")
 
 
 def main():
     args = parse_args()
-    wildcard = os.path.join(args.nda_dir, "imagingcollection01/HC*")
+    setup_logging_from_args(args)
+    wildcard = get_nda_wildcard(args.nda_dir)
     run(wildcard,
         use_bids_uris=args.use_bids_uris,
         pe_dirs=("AP", "PA"),
@@ -212,7 +793,24 @@ def main():
         method=args.method,
         overwrite=args.overwrite,
         dry_run=args.dry_run,
-        name=args.name)
+        name=args.name,
+        jobs=args.jobs,
+        plan_file=args.save_plan,
+        subject_list=args.subject_list,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        physio_sampling_frequency=args.physio_sampling_frequency,
+        pipeline_options=get_pipeline_options(args),
+        rules_file=args.classification_rules,
+        match_acquisition_time=args.intended_for_acquisition_time,
+        resume=args.resume,
+        verify=args.verify,
+        validate=args.validate,
+        participant_label=args.participant_label,
+        sessions=args.session,
+        modalities=args.modality,
+        exclude_modalities=args.exclude_modality,
+        tasks=args.task)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+# Logging and instrumentation of the conversion.
+# Progress is reported with the standard logging module: one line per subject at INFO and one line per file at DEBUG,
+# so that the per file messages are not even formatted unless they are asked for. Optionally every record is also
+# written to a JSON-lines file (one JSON object per record) that can be loaded for analysis.
+# The time spent in each phase of the conversion and counters for the files, bytes and syscalls are accumulated in
+# STATS and printed as a summary table at the end of the run.
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+
+LOGGER_NAME = "hcp2bids"
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+# the phases in the order in which they are printed in the summary table
+PHASES = ("scan", "classify", "fmap_renumber", "intended_for", "transfer", "sidecar", "events", "physio", "verify",
+          "validate")
+
+logger = logging.getLogger(LOGGER_NAME)
+
+STATS = {"phases": dict(), "counters": dict()}
+
+# the phases can run in several threads (see pipeline.py)
+_STATS_LOCK = threading.Lock()
+
+# the logging configuration of the main process, so that it can be applied again in the worker processes
+_LOGGING_CONFIG = {"level": None, "json_file": None}
+
+
+class StdoutHandler(logging.StreamHandler):
+    """
+    Writes the log messages to sys.stdout as it is when the message is logged (not when the handler is created), so
+    that contextlib.redirect_stdout can collect the messages of each subject in the worker processes.
+    """
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        event = {"time": record.created, "level": record.levelname, "module": record.module,
+                 "process": record.process, "thread": record.threadName, "message": record.getMessage()}
+        if hasattr(record, "event"):
+            event["event"] = record.event
+        if hasattr(record, "fields"):
+            event.update(record.fields)
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+def setup_logging(level="INFO", json_file=None):
+    """
+    Configures the logger of the converter.
+    :param level: minimum level of the messages that are printed (DEBUG prints one line per file).
+    :param json_file: optional file to which each message is appended as a JSON object on its own line.
+    """
+    _LOGGING_CONFIG.update(level=level, json_file=json_file)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logger.setLevel(level)
+    logger.propagate = False
+    console = StdoutHandler()
+    console.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(console)
+    if json_file is not None:
+        # appending keeps the events of the worker processes, which open the file again, in the same file
+        json_handler = logging.FileHandler(json_file, mode="a")
+        json_handler.setFormatter(JSONLinesFormatter())
+        logger.addHandler(json_handler)
+
+
+def get_logging_config():
+    return _LOGGING_CONFIG["level"], _LOGGING_CONFIG["json_file"]
+
+
+def setup_worker_logging(level, json_file):
+    # initializer of the worker processes
+    if level is not None:
+        setup_logging(level, json_file)
+
+
+def log_event(event, message, level=logging.INFO, **fields):
+    """
+    Logs a message with an event name and extra fields that are added to the JSON-lines stream.
+    """
+    logger.log(level, message, extra={"event": event, "fields": fields}, stacklevel=2)
+
+
+def add_time(phase, seconds):
+    with _STATS_LOCK:
+        stats = STATS["phases"].setdefault(phase, {"calls": 0, "seconds": 0.})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """
+    Adds the time spent in the block to the timer of the phase.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start)
+
+
+def count(counter, value=1):
+    with _STATS_LOCK:
+        STATS["counters"][counter] = STATS["counters"].get(counter, 0) + value
+
+
+def _copy_stats():
+    return {"phases": {phase: dict(values) for phase, values in STATS["phases"].items()},
+            "counters": dict(STATS["counters"])}
+
+
+def reset_stats():
+    """
+    Clears the statistics of this process.
+    :return: the statistics collected since the last reset.
+    """
+    with _STATS_LOCK:
+        stats = _copy_stats()
+        STATS["phases"].clear()
+        STATS["counters"].clear()
+    return stats
+
+
+def merge_stats(stats, totals=None):
+    """
+    Adds the statistics collected in another process to the totals (by default the statistics of this process).
+    """
+    with _STATS_LOCK:
+        if totals is None:
+            totals = STATS
+        for phase, values in stats["phases"].items():
+            total = totals["phases"].setdefault(phase, {"calls": 0, "seconds": 0.})
+            total["calls"] += values["calls"]
+            total["seconds"] += values["seconds"]
+        for counter, value in stats["counters"].items():
+            totals["counters"][counter] = totals["counters"].get(counter, 0) + value
+    return totals
+
+
+def format_stats_table(stats, elapsed=None):
+    """
+    Formats the phase timers and counters as a table.
+    The times of the phases are summed over the threads and processes, so with --jobs or --pipeline their total can
+    be larger than the elapsed time.
+    """
+    phases = [phase for phase in PHASES if phase in stats["phases"]]
+    phases.extend(sorted([phase for phase in stats["phases"] if phase not in PHASES]))
+    total = sum([stats["phases"][phase]["seconds"] for phase in phases])
+    lines = ["{:<16}{:>10}{:>12}{:>8}".format("phase", "calls", "seconds", "share")]
+    for phase in phases:
+        values = stats["phases"][phase]
+        lines.append("{:<16}{:>10}{:>12.3f}{:>7.1f}%".format(phase, values["calls"], values["seconds"],
+                                                             100 * values["seconds"] / total if total else 0.))
+    lines.append("{:<16}{:>10}{:>12.3f}".format("total", "", total))
+    if elapsed is not None:
+        lines.append("{:<16}{:>10}{:>12.3f}".format("elapsed", "", elapsed))
+    for counter, value in sorted(stats["counters"].items()):
+        if counter == "bytes":
+            lines.append("{:<16}{:>22.3f} GB".format(counter, value / 1024 ** 3))
+        else:
+            lines.append("{:<16}{:>22}".format(counter, value))
+    return "\n".join(lines)
+
+
+def log_summary(elapsed=None):
+    """
+    Logs the summary table of the statistics of this process (including the merged statistics of the workers).
+    """
+    with _STATS_LOCK:
+        stats = _copy_stats()
+    log_event("summary", "Summary:\n" + format_stats_table(stats, elapsed=elapsed), elapsed=elapsed, **stats)
+    return stats
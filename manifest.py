@@ -0,0 +1,136 @@
+# The conversion manifest keeps track of which source files were converted into which BIDS outputs.
+# It is stored in the output directory so that rerunning the conversion only has to touch new or changed sources.
+import hashlib
+import json
+import os
+import warnings
+
+from journal import atomic_write, output_verified, stat_output
+from logs import count, logger
+
+MANIFEST_FILENAME = ".hcp2bids_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def load_manifest(bids_dir):
+    manifest_file = os.path.join(bids_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_file):
+        return {"version": MANIFEST_VERSION, "subjects": dict()}
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        warnings.warn("Ignoring manifest with unsupported version: {}".format(manifest_file))
+        return {"version": MANIFEST_VERSION, "subjects": dict()}
+    return manifest
+
+
+def save_manifest(bids_dir, manifest):
+    manifest_file = os.path.join(bids_dir, MANIFEST_FILENAME)
+    os.makedirs(bids_dir, exist_ok=True)
+    with atomic_write(manifest_file) as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def hash_file(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def stat_source(source_file):
+    count("stat")
+    stat = os.stat(source_file)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def stat_inputs(input_files):
+    return {input_file: stat_source(input_file) for input_file in input_files}
+
+
+def inputs_changed(entry):
+    # the other inputs of the image (source sidecar, EV and physio files, ...) are checked like the image itself
+    for input_file, input_stat in entry.get("inputs", dict()).items():
+        try:
+            if stat_source(input_file) != input_stat:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def create_source_entry(source_file, output_files, bids_dir, source_stat=None, copied_from=None, input_stats=None):
+    """
+    Records the stat information of a source file along with the outputs that were created from it.
+    The JSON sidecars are edited during the conversion, so their content hash is stored as well. The size and
+    modification time of each output are stored for the quick check of a resumed conversion.
+    :param source_stat: The stat information of the source file taken before the conversion (the source file no
+    longer exists after it was moved).
+    :param copied_from: dictionary mapping the outputs that are transferred unchanged to their source files (used by
+    verify.py).
+    :param input_stats: the stat information of the other input files of the image (see stat_inputs), taken before the
+    conversion as well.
+    """
+    entry = stat_source(source_file) if source_stat is None else dict(source_stat)
+    entry["outputs"] = [os.path.relpath(output_file, bids_dir) for output_file in output_files]
+    entry["sidecars"] = {os.path.relpath(output_file, bids_dir): hash_file(output_file)
+                         for output_file in output_files if output_file.endswith(".json")}
+    entry["stats"] = {os.path.relpath(output_file, bids_dir): stat_output(output_file) for output_file in output_files}
+    if copied_from:
+        entry["copied_from"] = {os.path.relpath(output_file, bids_dir): in_file
+                                for output_file, in_file in copied_from.items() if output_file in output_files}
+    if input_stats:
+        entry["inputs"] = input_stats
+    return entry
+
+
+def source_changed(entry, source_file, bids_dir, quick=False):
+    """
+    Returns True if the source file is not in the manifest, if the size, mtime, or inode of the source file or of any of
+    its other inputs changed since it was converted, or if any of its outputs are missing or have been edited.
+    :param quick: check the outputs by their size and modification time instead of hashing the sidecars.
+    """
+    if entry is None:
+        return True
+    if stat_source(source_file) != {key: entry[key] for key in ("size", "mtime", "inode")}:
+        return True
+    if inputs_changed(entry):
+        return True
+    if quick and "stats" in entry:
+        return not all([output_verified(os.path.join(bids_dir, output_file), output_stat)
+                        for output_file, output_stat in entry["stats"].items()])
+    for output_file in entry["outputs"]:
+        if not os.path.lexists(os.path.join(bids_dir, output_file)):
+            return True
+    for output_file, sidecar_hash in entry["sidecars"].items():
+        if hash_file(os.path.join(bids_dir, output_file)) != sidecar_hash:
+            return True
+    return False
+
+
+def outputs_exist(entry, bids_dir):
+    return all([os.path.lexists(os.path.join(bids_dir, output_file)) for output_file in entry["outputs"]])
+
+
+def remove_outputs(output_files, bids_dir, dryrun=False):
+    for output_file in output_files:
+        output_file = os.path.join(bids_dir, output_file)
+        if os.path.lexists(output_file):
+            logger.debug("Removing outdated output: %s", output_file)
+            if not dryrun:
+                os.remove(output_file)
+
+
+def rename_outputs(manifest, renamed_files, bids_dir):
+    """
+    Updates the outputs and sidecar hashes of the manifest after outputs were renamed (e.g. by utils.fix_epi_runs).
+    :param renamed_files: dictionary mapping the old filenames to the new filenames.
+    """
+    renamed = {os.path.relpath(old_file, bids_dir): os.path.relpath(new_file, bids_dir)
+               for old_file, new_file in renamed_files.items()}
+    for subject in manifest["subjects"].values():
+        for entry in subject["sources"].values():
+            entry["outputs"] = [renamed.get(output_file, output_file) for output_file in entry["outputs"]]
+            for key in ("sidecars", "stats", "checksums", "copied_from"):
+                if key in entry:
+                    entry[key] = {renamed.get(output_file, output_file): value
+                                  for output_file, value in entry[key].items()}
+    return manifest
@@ -0,0 +1,81 @@
+# Conversion of the physiological recordings to BIDS _physio.tsv.gz files.
+# The recordings are the largest files that are not images, so they are streamed in blocks of lines and never held in
+# memory as a whole. Large files are compressed in parallel: each block is compressed as a separate gzip member and the
+# members are written in order. A file made of several gzip members is still a valid gzip file
+# (https://datatracker.ietf.org/doc/html/rfc1952#section-2.2), so the output can be read by gzip, zcat, and python.
+import collections
+import concurrent.futures
+import gzip
+import os
+
+from journal import atomic_write
+from logs import logger
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def read_physio_header(physio_file, delimiter=","):
+    with open(physio_file, "r") as f:
+        return [column.strip() for column in f.readline().rstrip("\r\n").split(delimiter)]
+
+
+def iter_physio_blocks(physio_file, delimiter="\t", skip_header=False, block_size=BLOCK_SIZE):
+    """
+    Yields the contents of the physio file as tab separated bytes in blocks of roughly block_size bytes.
+    Blocks always end at a line break.
+    """
+    with open(physio_file, "rb") as f:
+        if skip_header:
+            f.readline()
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+            # complete the last line of the block
+            block += f.readline()
+            if delimiter != "\t":
+                block = block.replace(b"\r\n", b"\n").replace(delimiter.encode("utf-8"), b"\t")
+            yield block
+
+
+def write_gzip_blocks(blocks, out_file, jobs=None, compresslevel=6):
+    """
+    Compresses the blocks into out_file. With more than one job, the blocks are compressed in a thread pool (zlib
+    releases the GIL) with at most 2 * jobs blocks in flight, so memory use does not depend on the file size.
+    :return: the number of uncompressed bytes written.
+    """
+    if jobs is None:
+        jobs = min(4, os.cpu_count() or 1)
+    n_bytes = 0
+    with atomic_write(out_file, "wb") as f_out:
+        if jobs <= 1:
+            with gzip.GzipFile(fileobj=f_out, mode="wb", compresslevel=compresslevel, mtime=0) as gz:
+                for block in blocks:
+                    gz.write(block)
+                    n_bytes += len(block)
+        else:
+            pending = collections.deque()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                for block in blocks:
+                    n_bytes += len(block)
+                    pending.append(executor.submit(gzip.compress, block, compresslevel, mtime=0))
+                    if len(pending) >= 2 * jobs:
+                        f_out.write(pending.popleft().result())
+                while pending:
+                    f_out.write(pending.popleft().result())
+            if n_bytes == 0:
+                # always write a valid (empty) gzip file
+                f_out.write(gzip.compress(b"", compresslevel, mtime=0))
+    return n_bytes
+
+
+def convert_physio_file(in_file, out_file, delimiter="\t", skip_header=False, jobs=None, block_size=BLOCK_SIZE):
+    """
+    Converts a physio csv/txt file into a BIDS _physio.tsv.gz file (tab separated, no header).
+    Files smaller than one block are compressed in a single gzip member.
+    """
+    logger.debug("Converting physio file: %s --> %s", in_file, out_file)
+    if os.path.getsize(in_file) <= block_size:
+        jobs = 1
+    return write_gzip_blocks(iter_physio_blocks(in_file, delimiter=delimiter, skip_header=skip_header,
+                                                block_size=block_size), out_file, jobs=jobs)
@@ -0,0 +1,74 @@
+# Pipelined execution of the conversion for high latency (network) storage.
+# Planning a subject (scanning its folder and reading the sidecars) runs in a background thread pool ahead of the
+# execution, so that the next subjects are scanned while the files of the current subject are transferred.
+# The planned images are executed in a thread pool with separate concurrency limits for metadata operations
+# (hardlinks, symlinks, small JSON/events files) and for operations that copy bytes (copies, moves, physio
+# compression). A bound on the number of images in flight keeps the planning from running too far ahead.
+import collections
+import concurrent.futures
+import itertools
+import threading
+
+BYTE_COPY_METHODS = ("copy", "move", "auto")
+
+
+def is_byte_copy_group(group):
+    for operation in group["operations"]:
+        if operation["action"] == "physio":
+            return True
+        if (operation["action"] == "transfer" and operation["method"] in BYTE_COPY_METHODS
+                and not operation["in_file"].endswith(".json")):
+            return True
+    return False
+
+
+def _run_limited(function, groups, slots, in_flight):
+    try:
+        with slots:
+            return [function(group) for group in groups]
+    finally:
+        in_flight.release()
+
+
+def run_pipeline(subject_folders, plan_function, execute_function, scan_ahead=2, metadata_concurrency=16,
+                 transfer_concurrency=4, max_in_flight=64):
+    """
+    Plans and executes the subjects with overlapping scanning and transfers.
+    :param plan_function: function(subject_folder) returning the subject plan.
+    :param execute_function: function(group) executing one planned image and returning its result.
+    :param scan_ahead: number of subjects that are planned ahead of the execution.
+    :param metadata_concurrency: maximum number of images with only metadata operations executed at once.
+    :param transfer_concurrency: maximum number of images that copy bytes executed at once.
+    :param max_in_flight: maximum number of images submitted but not yet finished (back-pressure).
+    :return: dictionary mapping the subject folders to their plan and the list of results of their planned images.
+    """
+    metadata_slots = threading.BoundedSemaphore(metadata_concurrency)
+    transfer_slots = threading.BoundedSemaphore(transfer_concurrency)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    submitted = dict()
+    folders = iter(subject_folders)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=scan_ahead) as scan_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=metadata_concurrency + transfer_concurrency) as io_pool:
+        planned = collections.deque([(folder, scan_pool.submit(plan_function, folder))
+                                     for folder in itertools.islice(folders, scan_ahead)])
+        while planned:
+            subject_folder, plan_future = planned.popleft()
+            for folder in itertools.islice(folders, 1):
+                planned.append((folder, scan_pool.submit(plan_function, folder)))
+            subject_plan = plan_future.result()
+
+            # images with the same output (e.g. several T1w runs that map to the same derived image) are executed
+            # one after the other, so that only the first one is written
+            tasks = collections.OrderedDict()
+            for group in subject_plan["groups"]:
+                tasks.setdefault(group["output_file"], list()).append(group)
+
+            futures = list()
+            for groups in tasks.values():
+                in_flight.acquire()  # blocks while too many images are in flight
+                slots = transfer_slots if any([is_byte_copy_group(group) for group in groups]) else metadata_slots
+                futures.append(io_pool.submit(_run_limited, execute_function, groups, slots, in_flight))
+            submitted[subject_folder] = (subject_plan, futures)
+
+    return {subject_folder: (subject_plan, [result for future in futures for result in future.result()])
+            for subject_folder, (subject_plan, futures) in submitted.items()}
@@ -0,0 +1,189 @@
+# A conversion plan is a JSON serializable description of all the file operations needed to convert a dataset.
+# The plan is created before any files are written, so that it can be reviewed, compared between releases, or split
+# across nodes before it is executed (see execute_plan.py).
+import json
+import os
+import re
+import warnings
+
+from journal import atomic_write
+from logs import logger
+from sidecars import get_sidecar_value
+
+PLAN_VERSION = 1
+
+
+def get_acquisition_time_from_plan(group):
+    # the source sidecar is the input of the json operation
+    # it is cached by the sidecars module, so it is not read again when the output sidecar is written
+    for operation in group["operations"]:
+        if operation.get("in_file") is not None and operation["out_file"].endswith(".json"):
+            return get_sidecar_value(operation["in_file"], "AcquisitionTime")
+    raise ValueError("No json sidecar found for {}".format(group["source"]))
+
+
+def rename_group(group, run_value):
+    """
+    Sets the run value of all the outputs of a planned image.
+    :param run_value: The new run value. If None, the run entity is removed from the filenames.
+    """
+    if run_value is None:
+        replacement = "_"
+    else:
+        replacement = "_run-{:02d}_".format(run_value)
+
+    def rename(filename):
+        return os.path.join(os.path.dirname(filename), re.sub(r"_run-\w+_", replacement, os.path.basename(filename)))
+
+    group["output_file"] = rename(group["output_file"])
+    for operation in group["operations"]:
+        operation["out_file"] = rename(operation["out_file"])
+
+
+def number_epi_runs(groups, pe_dirs, sort_by_run_name=False):
+    """
+    Assigns the final BIDS run numbers to the planned spin echo fieldmaps of a subject, so that the epi files are
+    written with their final names (see utils.fix_epi_runs for the equivalent renaming of an existing dataset).
+    The epi runs of each phase encoding direction are numbered according to the acquisition time or, if
+    sort_by_run_name is set, according to the run name.
+    """
+    for dir in pe_dirs:
+        epi_groups = [group for group in groups if group["modality"] == "epi"
+                      and "dir-{}".format(dir) in os.path.basename(group["output_file"])]
+        if len(epi_groups) == 0:
+            continue
+        elif len(epi_groups) == 1:
+            rename_group(epi_groups[0], None)
+            continue
+        elif sort_by_run_name:
+            epi_groups.sort(key=lambda x: re.search(r"run-([a-zA-Z0-9]+)_", x["output_file"]).group(1))
+        else:
+            epi_groups.sort(key=get_acquisition_time_from_plan)
+        for i, group in enumerate(epi_groups):
+            rename_group(group, i + 1)
+
+
+def acquisition_seconds(acquisition_time):
+    hours, minutes, seconds = acquisition_time.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def get_subject_outputs(subject_plan, output_dir):
+    """
+    Indexes the files that the subject will have once the plan is executed: the outputs of the planned images and the
+    outputs of the unchanged images from a previous conversion.
+    :return: dictionary mapping the output paths relative to the subject folder to the planned group of the image or
+    None for unchanged images.
+    """
+    subject_folder = "sub-{}".format(subject_plan["subject_id"])
+    outputs = dict()
+    for entry in subject_plan["unchanged"].values():
+        for output_file in entry["outputs"]:
+            outputs[os.path.relpath(output_file, subject_folder)] = None
+    for group in subject_plan["groups"]:
+        outputs[os.path.relpath(group["output_file"], os.path.join(output_dir, subject_folder))] = group
+    return outputs
+
+
+def get_output_acquisition_time(relative_path, group, output_dir, subject_id):
+    try:
+        if group is not None:
+            return acquisition_seconds(get_acquisition_time_from_plan(group))
+        sidecar = os.path.join(output_dir, "sub-{}".format(subject_id), relative_path.replace(".nii.gz", ".json"))
+        return acquisition_seconds(get_sidecar_value(sidecar, "AcquisitionTime"))
+    except (ValueError, KeyError, OSError):
+        return None
+
+
+def find_closest_output(target, fieldmap_group, outputs, output_dir, subject_id):
+    """
+    Finds the output image of the same type (folder and suffix) as the target that was acquired closest in time to
+    the fieldmap.
+    """
+    fieldmap_time = get_output_acquisition_time(None, fieldmap_group, output_dir, subject_id)
+    if fieldmap_time is None:
+        return None
+    folder, filename = os.path.split(target)
+    suffix = filename.split("_")[-1]
+    candidates = list()
+    for relative_path, group in outputs.items():
+        if os.path.dirname(relative_path) == folder and os.path.basename(relative_path).split("_")[-1] == suffix:
+            candidate_time = get_output_acquisition_time(relative_path, group, output_dir, subject_id)
+            if candidate_time is not None:
+                candidates.append((abs(candidate_time - fieldmap_time), relative_path))
+    if len(candidates) == 0:
+        return None
+    return min(candidates)[1]
+
+
+def resolve_intended_for(subject_plan, output_dir, match_acquisition_time=False):
+    """
+    Checks the IntendedFor fields of the planned sidecars against the files that the subject will actually have, so
+    that every sidecar is written once with its final IntendedFor field.
+    IntendedFor targets that are not converted (e.g. a missing or skipped run) are removed or, for the fieldmaps and if
+    match_acquisition_time is set, replaced with the converted image of the same type that was acquired closest in time
+    to the fieldmap. These targets are listed in the "dropped_intended_for" of the group and recorded in the manifest,
+    so that the image is planned again once they are converted (see find_outdated_intended_for).
+    """
+    outputs = None
+    uri_prefix = "bids::sub-{}/".format(subject_plan["subject_id"])
+    for group in subject_plan["groups"]:
+        for operation in group["operations"]:
+            if operation["action"] != "sidecar" or "IntendedFor" not in operation["fields"]:
+                continue
+            if outputs is None:
+                outputs = get_subject_outputs(subject_plan, output_dir)
+            intended_for = operation["fields"]["IntendedFor"]
+            targets = intended_for if isinstance(intended_for, list) else [intended_for]
+            resolved = list()
+            for target in targets:
+                relative_path = target[len(uri_prefix):] if target.startswith(uri_prefix) else target
+                if relative_path not in outputs:
+                    group.setdefault("dropped_intended_for", list()).append(relative_path)
+                # an SBRef belongs to its own run, only the fieldmaps are matched to other images
+                if relative_path not in outputs and match_acquisition_time and group["modality"] == "epi":
+                    closest = find_closest_output(relative_path, group, outputs, output_dir,
+                                                  subject_plan["subject_id"])
+                    if closest is not None:
+                        logger.info("IntendedFor target %s of %s is not converted. Using %s (closest acquisition "
+                                    "time) instead.", relative_path, operation["out_file"], closest)
+                        relative_path = closest
+                if relative_path in outputs:
+                    resolved.append(uri_prefix + relative_path if target.startswith(uri_prefix) else relative_path)
+                else:
+                    warnings.warn("IntendedFor target {} of {} is not converted. Removing it from the IntendedFor "
+                                  "field.".format(target, operation["out_file"]))
+            if len(resolved) == 0:
+                del operation["fields"]["IntendedFor"]
+            elif isinstance(intended_for, list):
+                operation["fields"]["IntendedFor"] = resolved
+            else:
+                operation["fields"]["IntendedFor"] = resolved[0]
+
+
+def find_outdated_intended_for(subject_plan, output_dir, planned=()):
+    """
+    Finds the unchanged images whose IntendedFor field is missing targets that are planned now, e.g. a run that was
+    filtered out (--task, --modality) or not yet acquired when the image was converted.
+    :param planned: the images that were already planned again; they are not returned.
+    :return: the images that need to be planned again with a complete IntendedFor field.
+    """
+    subject_folder = os.path.join(output_dir, "sub-{}".format(subject_plan["subject_id"]))
+    planned_outputs = {os.path.relpath(group["output_file"], subject_folder) for group in subject_plan["groups"]}
+    return [source for source, entry in subject_plan["unchanged"].items()
+            if source not in planned and any([target in planned_outputs
+                                              for target in entry.get("dropped_intended_for", ())])]
+
+
+def write_plan(plan_file, plan):
+    logger.info("Writing conversion plan: %s", plan_file)
+    with atomic_write(plan_file) as f:
+        json.dump(plan, f, indent=1)
+
+
+def read_plan(plan_file):
+    with open(plan_file, "r") as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError("Unsupported plan version in {}: {}".format(plan_file, plan.get("version")))
+    return plan
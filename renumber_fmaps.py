@@ -0,0 +1,69 @@
+# Renumbers the spin echo fieldmaps (epi runs) of an existing BIDS dataset.
+# The conversion assigns the final run numbers when the fieldmaps are planned, so this is only needed to repair
+# datasets that were converted by older versions or edited by hand. The manifest is updated with the new names, so that
+# the renamed fieldmaps are not converted again when the conversion is rerun. The renames are recorded in a journal, so
+# that an interrupted run is completed when the script is run again instead of leaving only some runs renamed.
+import argparse
+import os
+
+from catalog import CATALOG_FILENAME, Catalog
+from journal import Journal
+from lifespan import get_output_subject_id
+from logs import LOG_LEVELS, logger, setup_logging
+from manifest import load_manifest, rename_outputs, save_manifest
+from shards import read_subject_list
+from utils import complete_renames, fix_epi_runs
+
+RENUMBER_JOURNAL_FILENAME = ".hcp2bids_renumber_journal.jsonl"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bids_dir", type=str, required=True, help="path to the BIDS directory.")
+    parser.add_argument("--pe_dirs", type=str, nargs="+", default=["AP", "PA"],
+                        help="phase encoding directions of the fieldmaps. Use LR RL for HCP-YA. (default: AP PA)")
+    parser.add_argument("--sort_by_run_name", action="store_true",
+                        help="number the runs by their run name instead of the acquisition time (e.g. for HCP-YA, "
+                             "which has no acquisition times).")
+    parser.add_argument("--subject_list", type=str,
+                        help="text file with the subject ids to renumber (one per line). (default: all subjects)")
+    parser.add_argument("--dry_run", action="store_true", help="only print the files that would be renamed.")
+    parser.add_argument("--log_level", type=str, choices=LOG_LEVELS,
+                        help="logging level. (default: INFO or DEBUG for a dry run)")
+    return parser.parse_args()
+
+
+def renumber_fmaps(bids_dir, pe_dirs=("AP", "PA"), sort_by_run_name=False, subject_ids=None, dry_run=False):
+    """
+    :return: dictionary mapping the old filenames to the new filenames.
+    """
+    journal = Journal(os.path.join(bids_dir, RENUMBER_JOURNAL_FILENAME))
+    # the renames of an interrupted run are completed first; the manifest has not been updated for them yet
+    interrupted = complete_renames(journal, dryrun=dry_run)
+    renamed_files = fix_epi_runs(bids_dir, pe_dirs, sort_by_run_name=sort_by_run_name, subject_ids=subject_ids,
+                                 dryrun=dry_run, journal=journal)
+    logger.info("%s %d fieldmap files.", "Would rename" if dry_run else "Renamed", len(renamed_files))
+    if not dry_run:
+        if len(interrupted) > 0 or len(renamed_files) > 0:
+            manifest = rename_outputs(load_manifest(bids_dir), interrupted, bids_dir)
+            manifest = rename_outputs(manifest, renamed_files, bids_dir)
+            save_manifest(bids_dir, manifest)
+            if os.path.exists(os.path.join(bids_dir, CATALOG_FILENAME)):
+                catalog = Catalog(bids_dir)
+                catalog.rebuild(manifest, subject_ids={get_output_subject_id(filename, bids_dir) for filename in
+                                                       list(interrupted) + list(renamed_files)})
+                catalog.close()
+        journal.remove()
+    return renamed_files
+
+
+def main():
+    args = parse_args()
+    setup_logging(args.log_level if args.log_level else ("DEBUG" if args.dry_run else "INFO"))
+    subject_ids = read_subject_list(args.subject_list) if args.subject_list else None
+    renumber_fmaps(args.bids_dir, pe_dirs=args.pe_dirs, sort_by_run_name=args.sort_by_run_name,
+                   subject_ids=subject_ids, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
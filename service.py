@@ -0,0 +1,399 @@
+# Conversion service: a long running process on localhost that converts subjects of HCP Aging, HCP Development and
+# HCP-YA on request, so that adding a few newly released subjects does not pay for starting a new conversion process.
+#   python service.py serve [--port 8765] [--workers 4] [--io_limit 2]
+#   python service.py submit --dataset hcpya --input_dir <hcp_dir> --output_dir <output_dir> --participant_label 100307
+#   python service.py status [--job <job id>]
+# A job is one call of lifespan.run (or hcpya.run_hcpya) with the options of the command line tools. The jobs are run
+# in a pool of worker processes that stay alive between jobs, so the modules, the compiled classification rules and the
+# index of the precompiled sidecar templates are loaded once per worker. The subject folders are walked again for every
+# job, since new data can be released between jobs (use participant_label to avoid listing the whole collection).
+# The jobs are started in the order in which they were submitted, with at most --io_limit jobs at once on the same
+# filesystem (of the input or output directory) and one job at a time per output directory, since the jobs of an output
+# directory share its manifest.
+# The HTTP API (JSON) is:
+#   POST /jobs             submit a job: {"dataset": ..., "input_dir": ..., "output_dir": ..., "options": {...}}
+#   GET  /jobs             list the jobs
+#   GET  /jobs/<job id>    state and statistics of a job (images completed so far while it is running)
+#   GET  /metrics          number of jobs per state, files and bytes converted, and throughput
+# The service only listens on localhost and has no authentication: every local user can submit jobs.
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+
+from classify import get_classifier
+from hcpya import run_hcpya
+from journal import get_journal_filename
+from lifespan import get_nda_wildcard, run
+from logs import LOG_LEVELS, logger, reset_stats, setup_logging
+from sidecars import clear_sidecar_cache, get_sidecar_templates
+
+DEFAULT_PORT = 8765
+DATASETS = ("lifespan", "hcpya")
+# options of lifespan.run and hcpya.run_hcpya that a job can set
+JOB_OPTIONS = ("method", "overwrite", "use_bids_uris", "participant_label", "sessions", "modalities",
+               "exclude_modalities", "tasks", "jobs", "resume", "verify", "validate", "match_acquisition_time",
+               "physio_sampling_frequency", "rules_file", "name", "grad_unwarp", "diffusion")
+HCPYA_OPTIONS = ("grad_unwarp", "diffusion")
+LIFESPAN_OPTIONS = ("name", "physio_sampling_frequency")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the conversion service.")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                              help="port on localhost. (default: {})".format(DEFAULT_PORT))
+    serve_parser.add_argument("--workers", type=int, default=4,
+                              help="number of jobs that are converted at once. (default: 4)")
+    serve_parser.add_argument("--io_limit", type=int, default=2,
+                              help="maximum number of jobs that are converted at once on the same filesystem. "
+                                   "(default: 2)")
+    serve_parser.add_argument("--log_level", type=str, choices=LOG_LEVELS, default="INFO",
+                              help="minimum level of the printed messages. (default: INFO)")
+    submit_parser = subparsers.add_parser("submit", help="submit a job to the conversion service.")
+    submit_parser.add_argument("--dataset", type=str, choices=DATASETS, required=True,
+                               help="'lifespan' for HCP Aging/Development (input_dir is the NDA directory) or "
+                                    "'hcpya' for HCP-YA (input_dir is the HCP directory).")
+    submit_parser.add_argument("--input_dir", type=str, required=True, help="path to the HCP data.")
+    submit_parser.add_argument("--output_dir", type=str, required=True, help="path to the output BIDS directory.")
+    submit_parser.add_argument("--participant_label", type=str, nargs="+", help="only convert these subjects.")
+    submit_parser.add_argument("--options", type=str,
+                               help="JSON object with other options of the conversion, e.g. "
+                                    "'{\"method\": \"copy\", \"validate\": true}'. Allowed options: "
+                                    + ", ".join(JOB_OPTIONS) + ".")
+    submit_parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                               help="port of the service. (default: {})".format(DEFAULT_PORT))
+    status_parser = subparsers.add_parser("status", help="print the jobs and metrics of the conversion service.")
+    status_parser.add_argument("--job", type=str, help="only print this job.")
+    status_parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                               help="port of the service. (default: {})".format(DEFAULT_PORT))
+    return parser.parse_args()
+
+
+def check_job(dataset, input_dir, output_dir, options):
+    if dataset not in DATASETS:
+        raise ValueError("Unknown dataset: {}. Use one of: {}".format(dataset, ", ".join(DATASETS)))
+    unknown = [option for option in options if option not in JOB_OPTIONS]
+    if dataset == "lifespan":
+        unknown.extend([option for option in options if option in HCPYA_OPTIONS])
+    else:
+        unknown.extend([option for option in options if option in LIFESPAN_OPTIONS])
+    if len(unknown) > 0:
+        raise ValueError("Options not supported for {} jobs: {}".format(dataset, ", ".join(sorted(unknown))))
+    if not os.path.isdir(input_dir):
+        raise ValueError("Input directory does not exist: {}".format(input_dir))
+    if not output_dir:
+        raise ValueError("No output directory given.")
+
+
+def setup_job_worker(level):
+    # loaded once per worker process and kept for all the jobs that the worker runs
+    setup_logging(level)
+    get_classifier()
+    get_sidecar_templates()
+
+
+def run_job(dataset, input_dir, output_dir, options):
+    """
+    Runs a job in a worker process.
+    :return: dictionary with the statistics of the job (see logs.py) and the error, if the job failed.
+    """
+    # the source sidecars can change between jobs (e.g. a new release), so they are read again
+    clear_sidecar_cache()
+    reset_stats()
+    result = {"error": None}
+    try:
+        if dataset == "hcpya":
+            run_hcpya(input_dir, output_dir, **options)
+        else:
+            run(get_nda_wildcard(input_dir), output_dir=output_dir, **options)
+    except Exception:
+        result["error"] = traceback.format_exc()
+    result["stats"] = reset_stats()
+    return result
+
+
+def get_device(path):
+    # the output directory may not exist yet, so the device of its closest existing parent is used
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def count_completed_images(output_dir):
+    # the journal of a running conversion has one "source" record per converted image (see journal.py)
+    try:
+        with open(get_journal_filename(output_dir), "rb") as f:
+            return f.read().count(b'"event": "source"')
+    except OSError:
+        return 0
+
+
+class ConversionService(object):
+    """
+    Queue of the conversion jobs and the pool of worker processes that runs them.
+    """
+    def __init__(self, workers=4, io_limit=2, log_level="INFO"):
+        self.workers = workers
+        self.io_limit = io_limit
+        self.log_level = log_level
+        self.executor = self._create_executor()
+        self.jobs = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.running_devices = collections.Counter()
+        self.busy_output_dirs = set()
+        self.start_time = time.time()
+        self._next_id = 1
+        # reentrant, because a future that is already done runs its callback (_finish) in the scheduler thread
+        self._lock = threading.RLock()
+        # the jobs are started by a scheduler thread, which is woken up when a job is submitted or finished
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._scheduler = threading.Thread(target=self._schedule, name="scheduler", daemon=True)
+        self._scheduler.start()
+
+    def _create_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=setup_job_worker,
+                                                      initargs=(self.log_level,))
+
+    def _restart_executor(self):
+        # a pool whose worker was killed is broken and refuses all the jobs, so it is replaced by a new one
+        logger.warning("The worker pool is broken. Starting new workers.")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._create_executor()
+
+    def submit(self, dataset, input_dir, output_dir, options=None):
+        """
+        Adds a job to the queue.
+        :return: the job.
+        """
+        options = dict() if options is None else dict(options)
+        check_job(dataset, input_dir, output_dir, options)
+        input_dir = os.path.abspath(input_dir)
+        output_dir = os.path.abspath(output_dir)
+        with self._lock:
+            job = {"id": str(self._next_id), "dataset": dataset, "input_dir": input_dir, "output_dir": output_dir,
+                   "options": options, "state": "queued", "submitted": time.time(), "started": None,
+                   "finished": None, "error": None, "stats": None,
+                   "devices": sorted({get_device(input_dir), get_device(output_dir)})}
+            self._next_id += 1
+            self.jobs[job["id"]] = job
+            self.queue.append(job)
+            logger.info("Queued job %s: %s %s -> %s", job["id"], dataset, input_dir, output_dir)
+            self._wakeup.notify()
+        return job
+
+    def _can_start(self, job):
+        return (job["output_dir"] not in self.busy_output_dirs
+                and all([self.running_devices[device] < self.io_limit for device in job["devices"]]))
+
+    def _schedule(self):
+        with self._lock:
+            while not self._stopped:
+                self._dispatch()
+                self._wakeup.wait()
+
+    def _dispatch(self):
+        # starts the queued jobs in order, skipping the jobs whose filesystems or output directory are busy
+        n_running = sum([job["state"] == "running" for job in self.jobs.values()])
+        for job in list(self.queue):
+            if n_running >= self.workers:
+                break
+            if not self._can_start(job):
+                continue
+            self.queue.remove(job)
+            job.update(state="running", started=time.time())
+            self.busy_output_dirs.add(job["output_dir"])
+            self.running_devices.update(job["devices"])
+            n_running += 1
+            logger.info("Starting job %s", job["id"])
+            executor = self.executor
+            try:
+                future = executor.submit(run_job, job["dataset"], job["input_dir"], job["output_dir"],
+                                         job["options"])
+            except Exception as error:
+                n_running -= 1
+                self._release(job, {"error": traceback.format_exc(), "stats": None})
+                if isinstance(error, concurrent.futures.BrokenExecutor):
+                    self._restart_executor()
+                continue
+            future.add_done_callback(lambda future, job=job, executor=executor: self._finish(job, future, executor))
+
+    def _finish(self, job, future, executor):
+        broken = False
+        try:
+            result = future.result()
+        except Exception as error:
+            result = {"error": traceback.format_exc(), "stats": None}
+            broken = isinstance(error, concurrent.futures.BrokenExecutor)
+        with self._lock:
+            self._release(job, result)
+            # the other jobs of a broken pool fail as well, but the pool is only replaced once
+            if broken and executor is self.executor and not self._stopped:
+                self._restart_executor()
+            self._wakeup.notify()
+
+    def _release(self, job, result):
+        # marks the job as done or failed and frees its output directory and filesystems for the queued jobs
+        job.update(state="failed" if result["error"] else "done", finished=time.time(), error=result["error"],
+                   stats=result["stats"])
+        self.busy_output_dirs.discard(job["output_dir"])
+        self.running_devices.subtract(job["devices"])
+        logger.info("Job %s %s in %.1f s", job["id"], job["state"], job["finished"] - job["started"])
+        if result["error"]:
+            logger.error("Job %s failed:\n%s", job["id"], result["error"])
+
+    def describe(self, job):
+        description = {key: value for key, value in job.items() if key != "devices"}
+        end = job["finished"] or time.time()
+        description["elapsed"] = end - job["started"] if job["started"] else None
+        if job["state"] == "running":
+            description["images_completed"] = count_completed_images(job["output_dir"])
+        elif job["state"] == "queued":
+            description["queue_position"] = list(self.queue).index(job) + 1
+        if job["stats"] is not None:
+            counters = job["stats"]["counters"]
+            description["files"] = counters.get("files", 0)
+            description["bytes"] = counters.get("bytes", 0)
+            description["bytes_per_second"] = description["bytes"] / description["elapsed"] \
+                if description["elapsed"] else 0.
+        return description
+
+    def list_jobs(self):
+        with self._lock:
+            return [self.describe(job) for job in self.jobs.values()]
+
+    def get_job(self, job_id):
+        with self._lock:
+            if job_id not in self.jobs:
+                return None
+            return self.describe(self.jobs[job_id])
+
+    def metrics(self):
+        with self._lock:
+            states = collections.Counter([job["state"] for job in self.jobs.values()])
+            finished = [job for job in self.jobs.values() if job["stats"] is not None]
+            n_files = sum([job["stats"]["counters"].get("files", 0) for job in finished])
+            n_bytes = sum([job["stats"]["counters"].get("bytes", 0) for job in finished])
+            busy = sum([job["finished"] - job["started"] for job in finished])
+            return {"uptime": time.time() - self.start_time, "workers": self.workers, "io_limit": self.io_limit,
+                    "jobs": {state: states.get(state, 0) for state in ("queued", "running", "done", "failed")},
+                    "files": n_files, "bytes": n_bytes, "job_seconds": busy,
+                    "bytes_per_second": n_bytes / busy if busy else 0.,
+                    "files_per_second": n_files / busy if busy else 0.,
+                    "running_per_filesystem": {str(device): n for device, n in self.running_devices.items() if n}}
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    def send_json(self, status, data):
+        body = json.dumps(data, indent=1, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["jobs"]:
+            self.send_json(200, service.list_jobs())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = service.get_job(parts[1])
+            if job is None:
+                self.send_json(404, {"error": "Unknown job: {}".format(parts[1])})
+            else:
+                self.send_json(200, job)
+        elif parts == ["metrics"]:
+            self.send_json(200, service.metrics())
+        else:
+            self.send_json(404, {"error": "Unknown path: {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "Unknown path: {}".format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.server.service.submit(request.get("dataset"), request.get("input_dir", ""),
+                                             request.get("output_dir", ""), options=request.get("options"))
+        except (ValueError, TypeError, AttributeError) as error:
+            self.send_json(400, {"error": str(error)})
+            return
+        self.send_json(202, self.server.service.describe(job))
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def serve(port=DEFAULT_PORT, workers=4, io_limit=2, log_level="INFO"):
+    service = ConversionService(workers=workers, io_limit=io_limit, log_level=log_level)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), ServiceRequestHandler)
+    server.service = service
+
+    def stop(signum, frame):
+        logger.info("Stopping the conversion service. The running jobs are finished first.")
+        # server.shutdown waits for serve_forever to return, so it cannot be called from the thread that serves
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Conversion service listening on http://127.0.0.1:%d (%d workers, %d jobs per filesystem)",
+                port, workers, io_limit)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def request_service(port, path, data=None):
+    request = urllib.request.Request("http://127.0.0.1:{}{}".format(port, path),
+                                     data=None if data is None else json.dumps(data).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as error:
+        sys.exit(json.load(error).get("error"))
+
+
+def main():
+    args = parse_args()
+    if args.command == "serve":
+        setup_logging(args.log_level)
+        serve(port=args.port, workers=args.workers, io_limit=args.io_limit, log_level=args.log_level)
+    elif args.command == "submit":
+        options = json.loads(args.options) if args.options else dict()
+        if args.participant_label:
+            options["participant_label"] = args.participant_label
+        job = request_service(args.port, "/jobs", {"dataset": args.dataset, "input_dir": args.input_dir,
+                                                   "output_dir": args.output_dir, "options": options})
+        print("Submitted job {}".format(job["id"]))
+    else:
+        if args.job:
+            print(json.dumps(request_service(args.port, "/jobs/{}".format(args.job)), indent=1))
+        else:
+            print(json.dumps({"jobs": request_service(args.port, "/jobs"),
+                              "metrics": request_service(args.port, "/metrics")}, indent=1))
+
+
+if __name__ == "__main__":
+    main()
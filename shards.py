@@ -0,0 +1,50 @@
+# Splitting the subjects of a dataset into shards that can be converted by separate processes or cluster nodes
+# (e.g. SLURM array tasks). Each shard writes a completion report to the output directory instead of writing the
+# dataset level files, and finalize.py merges the reports once all shards are done.
+import glob
+import json
+import os
+import zlib
+
+from journal import atomic_write
+from logs import logger
+
+SHARDS_FOLDER = ".hcp2bids_shards"
+
+
+def get_shard(subject_id, shard_count):
+    # crc32 is stable across processes and python versions, unlike the built-in hash
+    return zlib.crc32(subject_id.encode("utf-8")) % shard_count
+
+
+def select_shard(subject_folders, shard_index, shard_count, get_subject_id):
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index must be between 0 and {}: {}".format(shard_count - 1, shard_index))
+    return [subject_folder for subject_folder in subject_folders
+            if get_shard(get_subject_id(subject_folder), shard_count) == shard_index]
+
+
+def read_subject_list(subject_list_file):
+    # one subject id (or subject folder name) per line
+    with open(subject_list_file, "r") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def get_shard_report_filename(bids_dir, shard_index, shard_count):
+    return os.path.join(bids_dir, SHARDS_FOLDER, "shard-{:04d}-of-{:04d}.json".format(shard_index, shard_count))
+
+
+def write_shard_report(bids_dir, shard_index, shard_count, report):
+    report_file = get_shard_report_filename(bids_dir, shard_index, shard_count)
+    os.makedirs(os.path.dirname(report_file), exist_ok=True)
+    logger.info("Writing shard report: %s", report_file)
+    with atomic_write(report_file) as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+
+def read_shard_reports(bids_dir):
+    reports = list()
+    for report_file in sorted(glob.glob(os.path.join(bids_dir, SHARDS_FOLDER, "shard-*-of-*.json"))):
+        with open(report_file, "r") as f:
+            reports.append(json.load(f))
+    return reports
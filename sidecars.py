@@ -0,0 +1,125 @@
+# In-memory handling of the JSON sidecars.
+# Each output sidecar is built from its source sidecar in memory with all the edits applied (IntendedFor, TaskName, ...)
+# and written once. The parsed source sidecars and precompiled templates are cached, so that a sidecar that is read
+# for planning (e.g. the AcquisitionTime of the fieldmaps) is not read again when it is written.
+# The precompiled HCP-YA templates (hcpya-sidecars) are indexed once per process by their task, phase encoding
+# direction and suffix, so matching an output to its template is a dictionary lookup.
+import copy
+import functools
+import json
+import os
+
+from entities import parse_bids_filename
+from journal import atomic_write
+from logs import count, logger, timed
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hcpya-sidecars")
+
+
+@functools.lru_cache(maxsize=4096)
+def _load_json(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_template(filename):
+    # the templates are part of the package and never change, so they are kept apart from the source sidecars
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def _load_sidecar(filename):
+    filename = os.path.abspath(filename)
+    if os.path.dirname(filename) == TEMPLATES_DIR:
+        return _load_template(filename)
+    return _load_json(filename)
+
+
+def read_sidecar(filename):
+    """
+    Returns a copy of the parsed sidecar that can be edited. Repeated reads of the same file are served from memory.
+    """
+    return copy.deepcopy(_load_sidecar(filename))
+
+
+def get_sidecar_value(filename, key):
+    return _load_sidecar(filename)[key]
+
+
+def clear_sidecar_cache():
+    """
+    Forgets the parsed source sidecars. The parsed templates are kept.
+    """
+    _load_json.cache_clear()
+
+
+def render_sidecar(in_file, fields):
+    """
+    Applies the edits to the source sidecar.
+    :param in_file: The source sidecar. If None, the sidecar is created from the fields only.
+    :param fields: dictionary of the fields to set in the sidecar.
+    :return: the edited sidecar as a dictionary.
+    """
+    data = dict() if in_file is None else read_sidecar(in_file)
+    if "IntendedFor" in fields:
+        data["IntendedFor"] = fields["IntendedFor"]
+        # sidecars with an IntendedFor field have always been written with sorted keys
+        data = json.loads(json.dumps(data, sort_keys=True))
+    for key, value in fields.items():
+        if key != "IntendedFor":
+            data[key] = value
+    return data
+
+
+def write_sidecar(out_file, data):
+    # write to a temporary file first so that an interrupted conversion never leaves a partially written sidecar
+    with atomic_write(out_file) as f:
+        json.dump(data, f, indent=4)
+
+
+def write_sidecars(operations):
+    """
+    Writes the sidecars of the planned sidecar operations (e.g. all the sidecars of a subject) in one batch.
+    :return: set of the sidecars that were written.
+    """
+    written = set()
+    folders = set()
+    with timed("sidecar"):
+        for operation in operations:
+            folder = os.path.dirname(operation["out_file"])
+            if folder not in folders:
+                os.makedirs(folder, exist_ok=True)
+                folders.add(folder)
+            logger.debug("Writing sidecar: %s --> %s (%s)", operation["in_file"], operation["out_file"],
+                         ", ".join(operation["fields"]))
+            write_sidecar(operation["out_file"], render_sidecar(operation["in_file"], operation["fields"]))
+            count("files")
+            written.add(operation["out_file"])
+    return written
+
+
+class SidecarTemplates(object):
+    """
+    The precompiled sidecar templates indexed by their (task, dir, suffix) entities, e.g. task-rest_dir-LR_bold.json
+    is the template of all the LR rest bold runs and T1w.json the template of all T1w images.
+    """
+    def __init__(self, templates_dir=TEMPLATES_DIR):
+        self.templates = dict()
+        for filename in sorted(os.listdir(templates_dir)):
+            if filename.endswith(".json"):
+                name = parse_bids_filename(filename)
+                self.templates[(name.get("task"), name.get("dir"), name["suffix"])] = os.path.join(templates_dir,
+                                                                                                    filename)
+                _load_sidecar(os.path.join(templates_dir, filename))
+
+    def match(self, suffix, task=None, dir=None):
+        """
+        :return: the template file or None if there is no template for these entities.
+        """
+        return self.templates.get((task, dir, suffix))
+
+
+@functools.lru_cache(maxsize=None)
+def get_sidecar_templates(templates_dir=TEMPLATES_DIR):
+    return SidecarTemplates(templates_dir)
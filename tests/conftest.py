@@ -0,0 +1,8 @@
+# the modules of the project and the generator of synthetic trees (benchmarks/synthetic.py) are imported from the
+# repository
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, ROOT)
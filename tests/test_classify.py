@@ -0,0 +1,286 @@
+# The rule table of classification_rules.json must classify the HCP images exactly like the if/elif chain that it
+# replaced. The chain is kept here as the reference, and both are run over known HCP file names, the images of the
+# synthetic trees, and randomly assembled paths. Rules that were added to the table after the chain was replaced (the
+# runs of the dir95-97 HCP-YA diffusion images and their gradient unwarped source) are part of the reference.
+import os
+import random
+import shutil
+import warnings
+
+import pytest
+
+from classify import get_classifier
+from hcpya import SKIP
+from lifespan import plan_subject, set_phase_encoding_direction
+from synthetic import generate_tree
+from utils import generate_intended_for, get_output_files, spin_echo_intended_for
+
+LIFESPAN = "/data/imagingcollection01/HCA6002236_V1_MR/unprocessed/"
+YA = "/data/100307/unprocessed/3T/"
+KNOWN_LIFESPAN_FILES = [LIFESPAN + name for name in (
+    "T1w_MPR_vNav_4e_RMS/HCA6002236_V1_MR_T1w_MPR_vNav_4e_RMS.nii.gz",
+    "T1w_MPR_vNav_4e_RMS/HCA6002236_V1_MR_SpinEchoFieldMap1_AP.nii.gz",
+    "T1w_MPR_vNav_4e_RMS/HCA6002236_V1_MR_SpinEchoFieldMap1_PA.nii.gz",
+    "T2w_SPC_vNav/HCA6002236_V1_MR_T2w_SPC_vNav.nii.gz",
+    "T2w_SPC_vNav/HCA6002236_V1_MR_BIAS_32CH.nii.gz",
+    "rfMRI_REST1_AP/HCA6002236_V1_MR_rfMRI_REST1_AP.nii.gz",
+    "rfMRI_REST1_AP/HCA6002236_V1_MR_rfMRI_REST1_AP_SBRef.nii.gz",
+    "rfMRI_REST1_AP/HCA6002236_V1_MR_SpinEchoFieldMap2_AP.nii.gz",
+    "rfMRI_REST2_PA/HCA6002236_V1_MR_rfMRI_REST2_PA.nii.gz",
+    "rfMRI_REST1a_PA/HCD0001305_V1_MR_rfMRI_REST1a_PA.nii.gz",
+    "rfMRI_REST1b_AP/HCD0001305_V1_MR_rfMRI_REST1b_AP_SBRef.nii.gz",
+    "tfMRI_CARIT_PA/HCA6002236_V1_MR_tfMRI_CARIT_PA.nii.gz",
+    "tfMRI_CARIT_PA/HCA6002236_V1_MR_tfMRI_CARIT_PA_SBRef.nii.gz",
+    "tfMRI_FACENAME_PA/HCA6002236_V1_MR_SpinEchoFieldMap4_PA.nii.gz",
+    "tfMRI_VISMOTOR_PA/HCA6002236_V1_MR_tfMRI_VISMOTOR_PA.nii.gz",
+    "tfMRI_GUESSING_AP/HCD0001305_V1_MR_tfMRI_GUESSING_AP.nii.gz",
+    "tfMRI_EMOTION_PA/HCD0001305_V1_MR_tfMRI_EMOTION_PA.nii.gz",
+    "Diffusion/HCA6002236_V1_MR_dMRI_dir98_AP.nii.gz",
+    "Diffusion/HCA6002236_V1_MR_dMRI_dir99_PA_SBRef.nii.gz",
+    "mbPCASLhr_PA/HCA6002236_V1_MR_mbPCASLhr_PA.nii.gz",
+    "mbPCASLhr_PA/HCA6002236_V1_MR_SpinEchoFieldMap5_AP.nii.gz",
+    "TSE_HiResHp/HCA6002236_V1_MR_TSE_HiResHp.nii.gz",
+    "TSE_HiResHp/HCA6002236_V1_MR_SpinEchoFieldMap6_PA.nii.gz",
+    "OTHER_FILES/HCA6002236_V1_MR_T1w_MPR_vNav_4e_e1e2_mean.nii.gz",
+    "Unknown_Scan/HCA6002236_V1_MR_Localizer.nii.gz")]
+KNOWN_YA_FILES = [YA + name for name in (
+    "T1w_MPR1/100307_3T_T1w_MPR1.nii.gz",
+    "T1w_MPR1/100307_3T_BIAS_BC.nii.gz",
+    "T1w_MPR1/100307_3T_AFI.nii.gz",
+    "T2w_SPC1/100307_3T_T2w_SPC1.nii.gz",
+    "rfMRI_REST1_LR/100307_3T_rfMRI_REST1_LR.nii.gz",
+    "rfMRI_REST1_LR/100307_3T_rfMRI_REST1_LR_SBRef.nii.gz",
+    "rfMRI_REST1_LR/100307_3T_SpinEchoFieldMap_RL.nii.gz",
+    "rfMRI_REST2_RL/100307_3T_rfMRI_REST2_RL.nii.gz",
+    "tfMRI_WM_RL/100307_3T_tfMRI_WM_RL.nii.gz",
+    "tfMRI_LANGUAGE_LR/100307_3T_SpinEchoFieldMap_LR.nii.gz",
+    "Diffusion/100307_3T_DWI_dir95_LR.nii.gz",
+    "Diffusion/100307_3T_DWI_dir96_RL_SBRef.nii.gz",
+    "Diffusion/100307_3T_DWI_dir97_LR.nii.gz")]
+# the parts of the randomly assembled paths
+FOLDER_TOKENS = ("rfMRI", "tfMRI", "REST1", "REST2a", "REST", "rest", "CARIT", "WM", "T1w", "T2w", "MPR1", "SPC",
+                 "SpinEchoFieldMap", "Diffusion", "dMRI", "dir95", "dir98", "dir99", "PCASLhr", "mbPCASLhr", "HiResHp",
+                 "TSE", "SBRef", "BIAS", "AP", "PA", "LR", "RL", "fMRI", "x")
+RANDOM_PATHS = 20000
+
+
+def legacy_fieldmap_intended_for(subject_id, use_bids_uris, basename):
+    intended_for_kwargs = {"subject_id": subject_id, "bids_uris": use_bids_uris}
+    if "fMRI" in basename:
+        intended_for_kwargs["modality"] = "bold"
+        intended_for_kwargs["folder"] = "func"
+        intended_for_kwargs["task"] = basename.split("_")[1].lower()
+        intended_for_kwargs["dir"] = basename.split("_")[2]
+        if "rest" in intended_for_kwargs["task"]:
+            intended_for_kwargs["run"] = intended_for_kwargs["task"].split("rest")[1]
+            intended_for_kwargs["task"] = "rest"
+    elif "PCASL" in basename:
+        intended_for_kwargs["modality"] = "asl"
+        intended_for_kwargs["folder"] = "perf"
+        intended_for_kwargs["dir"] = "PA"
+    elif "T1w" in basename:
+        intended_for_kwargs["modality"] = "T1w"
+        intended_for_kwargs["folder"] = "anat"
+    elif "T2w" in basename or "HiResHp" in basename:
+        intended_for_kwargs["modality"] = "T2w"
+        intended_for_kwargs["folder"] = "anat"
+    else:
+        return None
+    return generate_intended_for(**intended_for_kwargs)
+
+
+def legacy_excluded(image_file, skip_bias=True):
+    return os.path.dirname(image_file).endswith("OTHER_FILES") or (skip_bias and "BIAS" in image_file)
+
+
+def legacy_classify(image_file, subject_id, pe_dirs, use_bids_uris=False, grad_unwarp=False, t1w_use_derived=False,
+                    t2w_use_derived=False):
+    """
+    The if/elif chain of plan_subject and spin_echo_intended_for before the rule table.
+    :return: the image file to convert, modality, folder, entities and IntendedFor field.
+    """
+    kwargs = dict()
+    intended_for = None
+    set_phase_encoding_direction(kwargs, image_file, dirs=pe_dirs)
+    if "SpinEchoFieldMap" in image_file:
+        bids_modality = "epi"
+        folder = "fmap"
+        basename = os.path.basename(os.path.dirname(image_file))
+        run = basename.lower()
+        if "_" in run:
+            run = "".join(run.split("_")[1:]).lower()
+        kwargs["run"] = run
+        intended_for = legacy_fieldmap_intended_for(subject_id, use_bids_uris, basename)
+    elif "T1w" in image_file:
+        folder = "anat"
+        bids_modality = "T1w"
+        if t1w_use_derived:
+            image_file = os.path.join(image_file.split("unprocessed")[0], "T1w", "T1w_acpc_dc.nii.gz")
+    elif "T2w" in image_file:
+        folder = "anat"
+        bids_modality = "T2w"
+        if t2w_use_derived:
+            image_file = os.path.join(image_file.split("unprocessed")[0], "T1w", "T2w_acpc_dc.nii.gz")
+    elif "fMRI" in image_file:
+        if grad_unwarp:
+            image_file = image_file.replace("unprocessed/3T", "gradunwarp")
+        folder = "func"
+        bids_modality = "bold"
+        task = os.path.basename(os.path.dirname(image_file))
+        if "_" in task:
+            task = task.split("_")[1].lower()
+        if "rest" in task:
+            run = task.split("rest")[1]
+            task = "rest"
+            kwargs["run"] = run
+        kwargs["task"] = task
+    elif "Diffusion" in image_file:
+        if grad_unwarp:
+            image_file = image_file.replace("unprocessed/3T", "gradunwarp")
+        folder = "dwi"
+        bids_modality = "dwi"
+        # dir 98 scans are acquired before dir99 scans
+        for run, name in enumerate(("dir98", "dir99"), 1):
+            if name in image_file:
+                kwargs["run"] = str(run)
+                break
+        else:
+            for run, name in enumerate(("dir95", "dir96", "dir97"), 1):
+                if name in image_file:
+                    kwargs["run"] = str(run)
+                    break
+    elif "PCASL" in image_file:
+        bids_modality = "asl"
+        folder = "perf"
+    elif "HiResHp" in image_file:
+        bids_modality = "T2w"
+        folder = "anat"
+        kwargs["acq"] = "highres"
+    else:
+        folder = None
+        bids_modality = None
+
+    if "SBRef" in image_file:
+        if folder is not None:
+            intended_for = generate_intended_for(subject_id=subject_id, modality=bids_modality, folder=folder,
+                                                 bids_uris=use_bids_uris, **kwargs)
+        bids_modality = "sbref"
+    return image_file, bids_modality, folder, kwargs, intended_for
+
+
+def classify(image_file, subject_id, pe_dirs, use_bids_uris=False, **options):
+    # the classification as done by plan_subject
+    classifier = get_classifier()
+    kwargs = dict()
+    set_phase_encoding_direction(kwargs, image_file, dirs=pe_dirs)
+    classification = classifier.classify(image_file, entities=kwargs, options=options)
+    intended_for = None
+    if classification["intended_for"] == "fieldmap":
+        intended_for = spin_echo_intended_for(subject_id, use_bids_uris, os.path.basename(os.path.dirname(image_file)),
+                                              image_file, classifier=classifier)
+    elif classification["intended_for"] == "image" and classification["folder"] is not None:
+        intended_for = generate_intended_for(subject_id=subject_id, modality=classification["image_modality"],
+                                             folder=classification["folder"], bids_uris=use_bids_uris,
+                                             **classification["entities"])
+    return (classification["image_file"], classification["modality"], classification["folder"],
+            classification["entities"], intended_for)
+
+
+def assert_same(image_file, subject_id, pe_dirs, use_bids_uris=False, skip_bias=True, **options):
+    assert get_classifier().excluded(image_file, options={"skip_bias": skip_bias}) == \
+        legacy_excluded(image_file, skip_bias=skip_bias), image_file
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        assert classify(image_file, subject_id, pe_dirs, use_bids_uris=use_bids_uris, **options) == \
+            legacy_classify(image_file, subject_id, pe_dirs, use_bids_uris=use_bids_uris, **options), image_file
+
+
+@pytest.mark.parametrize("use_bids_uris", [False, True])
+def test_known_lifespan_files(use_bids_uris):
+    for image_file in KNOWN_LIFESPAN_FILES:
+        assert_same(image_file, "HCA6002236", ("AP", "PA"), use_bids_uris=use_bids_uris)
+
+
+@pytest.mark.parametrize("use_bids_uris", [False, True])
+def test_known_ya_files(use_bids_uris):
+    for image_file in KNOWN_YA_FILES:
+        assert_same(image_file, "100307", ("LR", "RL"), use_bids_uris=use_bids_uris)
+
+
+def test_synthetic_lifespan_tree(tmp_path):
+    nda_dir = generate_tree(str(tmp_path), dataset="lifespan", subjects=2, physio_rows=10, ev_rows=2)
+    image_files = [os.path.join(root, filename) for root, _, files in os.walk(nda_dir) for filename in files
+                   if filename.endswith(".nii.gz")]
+    assert len(image_files) > 0
+    for image_file in image_files:
+        assert_same(image_file, image_file.split(os.sep)[-4].split("_")[0], ("AP", "PA"))
+
+
+@pytest.mark.parametrize("grad_unwarp", [False, True])
+def test_synthetic_ya_tree(tmp_path, grad_unwarp):
+    hcp_dir = generate_tree(str(tmp_path), dataset="ya", subjects=2, physio_rows=10, ev_rows=2)
+    image_files = [os.path.join(root, filename) for root, _, files in os.walk(hcp_dir) for filename in files
+                   if filename.endswith(".nii.gz") and "unprocessed" in root]
+    assert len(image_files) > 0
+    if grad_unwarp:
+        # the gradient unwarped images are looked up in the gradunwarp folder of each subject
+        for image_file in image_files:
+            gradunwarp_file = image_file.replace("unprocessed/3T", "gradunwarp")
+            os.makedirs(os.path.dirname(gradunwarp_file), exist_ok=True)
+            shutil.copy(image_file, gradunwarp_file)
+    for image_file in image_files:
+        assert_same(image_file, image_file.split(os.sep)[-5], ("LR", "RL"), grad_unwarp=grad_unwarp,
+                    t1w_use_derived=True, t2w_use_derived=True)
+
+
+def random_path(rng):
+    def name():
+        return "_".join([rng.choice(FOLDER_TOKENS) for _ in range(rng.randint(1, 4))])
+    folder = rng.choice([name(), name(), "OTHER_FILES", "Diffusion"])
+    return os.path.join("/data", rng.choice(["HCA6002236_V1_MR/unprocessed", "100307/unprocessed/3T"]), folder,
+                        "S_" + name() + ".nii.gz")
+
+
+def test_random_paths():
+    rng = random.Random(0)
+    compared = 0
+    for _ in range(RANDOM_PATHS):
+        image_file = random_path(rng)
+        try:
+            legacy_classify(image_file, "S", ("AP", "PA"))
+        except IndexError:
+            # the chain failed on fMRI fieldmap folders without a phase encoding direction; nothing to compare
+            continue
+        assert_same(image_file, "S", ("AP", "PA"), skip_bias=rng.random() < 0.5)
+        compared += 1
+    assert compared > RANDOM_PATHS // 2
+
+
+def plan_outputs(subject_folder, output_dir, **kwargs):
+    with warnings.catch_warnings():
+        # the SBRef images of the synthetic HCP-YA tree have no precompiled sidecar template
+        warnings.simplefilter("ignore")
+        subject_plan = plan_subject(subject_folder, output_dir=output_dir, **kwargs)
+    return sorted([os.path.relpath(output_file, output_dir) for group in subject_plan["groups"]
+                   for output_file in get_output_files(group)])
+
+
+@pytest.mark.parametrize("dataset", ["lifespan", "ya"])
+def test_parent_folders(tmp_path, monkeypatch, dataset):
+    # only the path below the unprocessed folder is classified: a project folder whose name contains the keywords of
+    # the rules and skip strings must not change the BIDS names
+    if dataset == "lifespan":
+        subject_folder = os.path.join("data", "imagingcollection01", "HCA6000000_V1_MR")
+        kwargs = dict()
+    else:
+        subject_folder = os.path.join("data", "100000")
+        kwargs = dict(pe_dirs=("LR", "RL"), skip=SKIP, t1w_use_derived=True, t2w_use_derived=True,
+                      use_precompiled_sidecars=True, sort_by_run_name=True)
+    project_dir = tmp_path / "SBRef_7T_SpinEchoFieldMap_BIAS_proj" / "x"
+    for folder in (tmp_path, project_dir):
+        generate_tree(str(folder / "data"), dataset=dataset, subjects=1, physio_rows=10, ev_rows=2)
+    expected = plan_outputs(str(tmp_path / subject_folder), str(tmp_path / "out"), **kwargs)
+    assert len(expected) > 0
+    # the subject folder is given relative to the project folder, as with lifespan.py --nda_dir data
+    monkeypatch.chdir(project_dir)
+    assert plan_outputs(subject_folder, str(tmp_path / "out"), **kwargs) == expected
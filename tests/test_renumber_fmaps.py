@@ -0,0 +1,89 @@
+# Renaming the epi runs must be safe when the new names of some runs are the old names of others (e.g. run-01 and
+# run-02 are swapped), and an interrupted renumbering must be completed by the next run.
+import json
+import os
+
+import pytest
+
+from journal import Journal
+from manifest import load_manifest, save_manifest
+from renumber_fmaps import RENUMBER_JOURNAL_FILENAME, renumber_fmaps
+from utils import complete_renames, get_rename_steps, rename_files, run_rename_steps
+
+
+def write_file(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        f.write(content)
+
+
+def read_file(filename):
+    with open(filename, "r") as f:
+        return f.read()
+
+
+def test_swap(tmp_path):
+    run1, run2 = str(tmp_path / "run-01.nii.gz"), str(tmp_path / "run-02.nii.gz")
+    write_file(run1, "first")
+    write_file(run2, "second")
+    rename_files({run1: run2, run2: run1})
+    assert read_file(run1) == "second"
+    assert read_file(run2) == "first"
+    assert sorted(os.listdir(tmp_path)) == ["run-01.nii.gz", "run-02.nii.gz"]
+
+
+def test_existing_target(tmp_path):
+    run1, run2 = str(tmp_path / "run-01.nii.gz"), str(tmp_path / "run-02.nii.gz")
+    write_file(run1, "first")
+    write_file(run2, "second")
+    with pytest.raises(FileExistsError):
+        rename_files({run1: run2})
+    assert read_file(run1) == "first"
+    assert read_file(run2) == "second"
+
+
+def test_complete_interrupted_swap(tmp_path):
+    run1, run2 = str(tmp_path / "run-01.nii.gz"), str(tmp_path / "run-02.nii.gz")
+    write_file(run1, "first")
+    write_file(run2, "second")
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    renames = {run1: run2, run2: run1}
+    # interrupted after the files were renamed to their temporary names
+    journal.record("rename", renames=renames)
+    run_rename_steps(get_rename_steps(renames)[:1], journal=journal)
+    assert not os.path.exists(run1) and not os.path.exists(run2)
+    assert complete_renames(journal) == renames
+    assert read_file(run1) == "second"
+    assert read_file(run2) == "first"
+    journal.close()
+
+
+def write_fieldmap(bids_dir, run, acquisition_time, content):
+    image_file = os.path.join(bids_dir, "sub-01", "fmap", "sub-01_dir-AP_run-{}_epi.nii.gz".format(run))
+    write_file(image_file, content)
+    with open(image_file.replace(".nii.gz", ".json"), "w") as f:
+        json.dump({"AcquisitionTime": acquisition_time}, f)
+    return os.path.relpath(image_file, bids_dir)
+
+
+def test_renumber_fmaps(tmp_path):
+    bids_dir = str(tmp_path)
+    # run-01 was acquired after run-02, so the runs are swapped
+    outputs = {"/source/late.nii.gz": write_fieldmap(bids_dir, "01", "10:00:00.000000", "late"),
+               "/source/early.nii.gz": write_fieldmap(bids_dir, "02", "09:00:00.000000", "early")}
+    save_manifest(bids_dir, {"version": 1, "subjects": {"01": {"sources": {
+        source: {"outputs": [output, output.replace(".nii.gz", ".json")], "sidecars": dict()}
+        for source, output in outputs.items()}}}})
+
+    renamed = renumber_fmaps(bids_dir, pe_dirs=("AP",))
+
+    assert len(renamed) == 4
+    fmap_folder = os.path.join(bids_dir, "sub-01", "fmap")
+    assert read_file(os.path.join(fmap_folder, "sub-01_dir-AP_run-01_epi.nii.gz")) == "early"
+    assert read_file(os.path.join(fmap_folder, "sub-01_dir-AP_run-02_epi.nii.gz")) == "late"
+    sources = load_manifest(bids_dir)["subjects"]["01"]["sources"]
+    assert sources["/source/early.nii.gz"]["outputs"][0] == "sub-01/fmap/sub-01_dir-AP_run-01_epi.nii.gz"
+    assert sources["/source/late.nii.gz"]["outputs"][1] == "sub-01/fmap/sub-01_dir-AP_run-02_epi.json"
+    assert not os.path.exists(os.path.join(bids_dir, RENUMBER_JOURNAL_FILENAME))
+    # the runs are numbered correctly now
+    assert renumber_fmaps(bids_dir, pe_dirs=("AP",)) == dict()
@@ -0,0 +1,159 @@
+# Transfer strategies for putting the source files into the BIDS directory.
+# "copy" tries the cheapest way to make an independent copy of a file: a reflink (copy-on-write clone on XFS/Btrfs),
+# then an in-kernel copy (os.copy_file_range or os.sendfile), and finally a buffered copy.
+# "auto" first tries a hardlink and falls back to the copy chain when the output is on a different filesystem.
+# The strategy used for each file and the number of bytes copied by each strategy are counted in TRANSFER_STATS. Links
+# and renames do not move any data, so only their files are counted.
+import errno
+import os
+import shutil
+import threading
+
+from journal import temporary_filename
+from logs import count
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# ioctl request number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+TRANSFER_STATS = dict()
+
+
+# the transfers can run in several threads (see pipeline.py)
+_STATS_LOCK = threading.Lock()
+
+
+def record_transfer(strategy, n_bytes=0):
+    with _STATS_LOCK:
+        stats = TRANSFER_STATS.setdefault(strategy, {"files": 0, "bytes": 0})
+        stats["files"] += 1
+        stats["bytes"] += n_bytes
+    count("files")
+    count("bytes", n_bytes)
+
+
+def reset_transfer_stats():
+    with _STATS_LOCK:
+        stats = dict(TRANSFER_STATS)
+        TRANSFER_STATS.clear()
+    return stats
+
+
+def merge_transfer_stats(totals, stats):
+    for strategy, values in stats.items():
+        total = totals.setdefault(strategy, {"files": 0, "bytes": 0})
+        total["files"] += values["files"]
+        total["bytes"] += values["bytes"]
+    return totals
+
+
+def format_transfer_stats(stats):
+    return ", ".join(["{}: {} files".format(strategy, values["files"])
+                      + (" ({:.2f} GB)".format(values["bytes"] / 1024 ** 3) if values["bytes"] else "")
+                      for strategy, values in sorted(stats.items())])
+
+
+def try_reflink(in_file, out_file):
+    if fcntl is None:
+        return False
+    with open(in_file, "rb") as f_in, open(out_file, "wb") as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(out_file)
+    return False
+
+
+def try_kernel_copy(in_file, out_file, size):
+    """
+    Copies the file without moving the data through user space.
+    :param size: the size of the input file.
+    :return: the name of the strategy that was used or None if the in-kernel copy is not supported.
+    """
+    for strategy in ("copy_file_range", "sendfile"):
+        if not hasattr(os, strategy):
+            continue
+        with open(in_file, "rb") as f_in, open(out_file, "wb") as f_out:
+            offset = 0
+            try:
+                while offset < size:
+                    if strategy == "copy_file_range":
+                        n = os.copy_file_range(f_in.fileno(), f_out.fileno(), size - offset)
+                    else:
+                        n = os.sendfile(f_out.fileno(), f_in.fileno(), offset, size - offset)
+                    if n == 0:
+                        break
+                    offset += n
+            except OSError as error:
+                if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                offset = -1
+        if offset == size:
+            return strategy
+        os.remove(out_file)
+    return None
+
+
+def copy_file(in_file, out_file):
+    """
+    Copies the file using the cheapest available strategy. The copy is made under a temporary name and renamed when it
+    is complete.
+    :return: the name of the strategy that was used.
+    """
+    tmp_file = temporary_filename(out_file)
+    count("stat")
+    size = os.path.getsize(in_file)
+    try:
+        if try_reflink(in_file, tmp_file):
+            strategy = "reflink"
+        else:
+            strategy = try_kernel_copy(in_file, tmp_file, size)
+            if strategy is None:
+                shutil.copyfile(in_file, tmp_file)
+                strategy = "buffered"
+        shutil.copymode(in_file, tmp_file)
+    except BaseException:
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, out_file)
+    record_transfer(strategy, size)
+    return strategy
+
+
+def auto_transfer(in_file, out_file):
+    """
+    Hardlinks the file or copies it if the hardlink fails (e.g. when the output is on a different filesystem).
+    :return: the name of the strategy that was used.
+    """
+    try:
+        os.link(in_file, out_file)
+        record_transfer("hardlink")
+        return "hardlink"
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+    return copy_file(in_file, out_file)
+
+
+def move_file(in_file, out_file):
+    """
+    Renames the file or copies and removes it if the output is on a different filesystem.
+    :return: the name of the strategy that was used.
+    """
+    try:
+        os.rename(in_file, out_file)
+        record_transfer("rename")
+        return "rename"
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+    strategy = copy_file(in_file, out_file)
+    os.remove(in_file)
+    return strategy
@@ -1,12 +1,21 @@
+import fnmatch
 import glob
 import json
 import os
 import re
-import shutil
 import warnings
 
+from classify import get_classifier
+from entities import bids_name
+from events import write_events_file
+from fsindex import file_exists, glob_files
+from logs import count, logger, timed
+from physio import convert_physio_file, read_physio_header
+from sidecars import get_sidecar_templates, render_sidecar, write_sidecar
+from transfer import auto_transfer, copy_file, move_file, record_transfer
 
-def fix_epi_runs(bids_dir, pe_dirs, sort_by_run_name=False):
+
+def fix_epi_runs(bids_dir, pe_dirs, sort_by_run_name=False, subject_ids=None, dryrun=False, journal=None):
     """
     The epi runs must be renamed to match the BIDS standard
     The BIDS standard requires that the epi runs be named run-01, run-02, etc.
@@ -18,13 +27,28 @@ def fix_epi_runs(bids_dir, pe_dirs, sort_by_run_name=False):
     :param pe_dirs: The phase encoding directions for the dataset
     :param sort_by_run_name: For the HCPYA dataset, we do not have acquisition times. This option will sort the runs by
     their task/run name instead.
-    :return:
+    :param subject_ids: Only rename the epi runs of these subjects. By default, all subjects are renamed.
+    :param dryrun: Only return the files that would be renamed.
+    :param journal: Journal in which the renames are recorded (see rename_files).
+    :return: dictionary mapping the old filenames to the new filenames.
+
+    The conversion names the epi runs correctly when they are planned (see plan.number_epi_runs). This function is
+    kept to repair existing datasets (see renumber_fmaps.py).
     """
 
-    fmap_folders = glob.glob(os.path.join(bids_dir, "sub-*", "fmap"))
+    renamed_files = dict()
+    if subject_ids is None:
+        fmap_folders = glob.glob(os.path.join(bids_dir, "sub-*", "fmap"))
+    else:
+        fmap_folders = [os.path.join(bids_dir, "sub-{}".format(subject_id), "fmap") for subject_id in subject_ids]
     for fmap_folder in fmap_folders:
+        if not os.path.isdir(fmap_folder):
+            continue
+        # list the folder once and select the epi runs for each direction from memory
+        fmap_files = sorted(os.listdir(fmap_folder))
         for dir in pe_dirs:  # this is a bit of a hack to just get the epi runs for the same direction
-            epi_runs = glob.glob(os.path.join(fmap_folder, "*dir-{}*epi.nii.gz".format(dir)))
+            epi_runs = [os.path.join(fmap_folder, f)
+                        for f in fnmatch.filter(fmap_files, "*dir-{}*epi.nii.gz".format(dir))]
             new_runs = list()
             if len(epi_runs) == 0:
                 continue
@@ -46,281 +70,389 @@ def fix_epi_runs(bids_dir, pe_dirs, sort_by_run_name=False):
                     # use regular expression to replace the run value from the filename
                     new_file_name = re.sub(r"_run-\w+_", "_run-{:02d}_".format(i + 1), epi_run)
                     new_runs.append(new_file_name)
+            renames = dict()
             for old_run, new_run in zip(epi_runs, new_runs):
-                print("Renaming {} to {}".format(old_run, new_run))
-                shutil.move(old_run, new_run)
-                old_json = old_run.replace(".nii.gz", ".json")
-                new_json = new_run.replace(".nii.gz", ".json")
-                print("Renaming {} to {}".format(old_json, new_json))
-                shutil.move(old_json, new_json)
-
-
-def generate_output_filename(subject_id, modality, folder, extension=".nii.gz", **kwargs):
-    args = ["sub-{}".format(subject_id)]
-    # Makes sure the arguments are added in the correct order
-    # fix run if it has 1a, 1b, 2a, 2b
-    if "run" in kwargs:
-        if kwargs["run"] == "1a":
-            kwargs["run"] = 1
-        elif kwargs["run"] == "1b":
-            kwargs["run"] = 2
-        elif kwargs["run"] == "2a":
-            kwargs["run"] = 3
-        elif kwargs["run"] == "2b":
-            kwargs["run"] = 4
-
-    for key in ("ses", "task", "acq", "ce", "rec", "dir", "run", "recording", "echo", "part"):
-        if key in kwargs:
-            value = kwargs[key]
-            args.append("{}-{}".format(key, value))
-    args.append(modality)
-    return os.path.join(folder, "_".join(args) + extension)
-
-
-def generate_full_output_filename(bids_dir, subject_id, modality, folder, extension=".nii.gz", **kwargs):
-    return os.path.join(bids_dir, "sub-{}".format(subject_id),
-                        generate_output_filename(subject_id, modality, folder, extension=extension, **kwargs))
+                if old_run != new_run:
+                    renames[old_run] = new_run
+                    renames[old_run.replace(".nii.gz", ".json")] = new_run.replace(".nii.gz", ".json")
+            rename_files(renames, dryrun=dryrun, journal=journal)
+            renamed_files.update(renames)
+    return renamed_files
 
 
-def generate_intended_for(subject_id, modality, folder, bids_uris=False, **kwargs):
-    if bids_uris:
-        return "bids::sub-{}/{}".format(subject_id, generate_output_filename(subject_id, modality, folder, **kwargs))
-    else:
-        return generate_output_filename(subject_id, modality, folder, **kwargs)
+def rename_files(renames, dryrun=False, journal=None):
+    """
+    Renames files within a folder with os.rename (a single metadata operation per file).
+    If some of the new names are currently used by other files that are renamed as well (e.g. when run-01 and run-02
+    are swapped), the files are first renamed to temporary names.
+    :param renames: dictionary mapping the old filenames to the new filenames.
+    :param journal: Journal in which the renames are recorded, so that they can be completed by complete_renames if
+    they are interrupted.
+    """
+    for new_file in renames.values():
+        if new_file not in renames and os.path.lexists(new_file):
+            raise FileExistsError("Cannot rename to {}: the file already exists.".format(new_file))
+    if journal is not None and not dryrun:
+        journal.record("rename", renames=renames)
+    run_rename_steps(get_rename_steps(renames), dryrun=dryrun, journal=journal)
 
 
-def add_intended_for_to_json(json_file, intended_for):
-    if os.path.exists(json_file):
-        print("Adding IntendedFor to {}".format(json_file))
-        with open(json_file, "r") as f:
-            json_dict = json.load(f)
-    else:
-        print("Adding IntendedFor to new JSON file: {}".format(json_file))
-        json_dict = dict()
-    json_dict["IntendedFor"] = intended_for
-    with open(json_file, "w") as f:
-        json.dump(json_dict, f, indent=4, sort_keys=True)
+def get_rename_steps(renames):
+    if not any([new_file in renames for new_file in renames.values()]):
+        return [renames]
+    temporary = {old_file: old_file + ".renaming" for old_file in renames}
+    return [temporary, {temporary[old_file]: new_file for old_file, new_file in renames.items()}]
+
+
+def run_rename_steps(steps, dryrun=False, journal=None, start=0):
+    # files that no longer have their old name were already renamed before an interruption
+    for i, step in enumerate(steps[start:], start):
+        for old_file, new_file in step.items():
+            logger.debug("Renaming %s to %s", old_file, new_file)
+            if not dryrun and os.path.lexists(old_file):
+                os.rename(old_file, new_file)
+        if journal is not None and not dryrun:
+            journal.record("renamed", step=i)
+
+
+def complete_renames(journal, dryrun=False):
+    """
+    Completes the renames recorded in the journal that were interrupted.
+    :return: dictionary mapping the old filenames to the new filenames of all the renames in the journal.
+    """
+    renamed_files = dict()
+    renames, completed_steps = None, 0
+    for record in journal.read():
+        if record["event"] == "rename":
+            renames, completed_steps = record["renames"], 0
+            renamed_files.update(renames)
+        elif record["event"] == "renamed":
+            completed_steps = record["step"] + 1
+    if renames is not None and completed_steps < len(get_rename_steps(renames)):
+        logger.info("Completing %d interrupted renames from %s", len(renames), journal.filename)
+        run_rename_steps(get_rename_steps(renames), dryrun=dryrun, journal=journal, start=completed_steps)
+    return renamed_files
+
+
+def generate_intended_for(subject_id, modality, folder, bids_uris=False, **kwargs):
+    return bids_name(subject_id, modality, folder, **kwargs).intended_for(bids_uris)
 
 
-def move_to_bids(image_file, bids_dir, subject_id, modality, folder, orig_image_file, method="hardlink",
-                 overwrite=False, dryrun=False, intended_for=None, exists_ok=True, use_precompiled_sidecars=False,
-                 **kwargs):
-    output_file = generate_full_output_filename(bids_dir, subject_id, modality, folder, **kwargs)
-    in_files = [image_file]
-    out_files = [output_file]
+def plan_move_to_bids(image_file, bids_dir, subject_id, modality, folder, orig_image_file, method="hardlink",
+                      intended_for=None, use_precompiled_sidecars=False, index=None, physio_sampling_frequency=None,
+                      unmatched_sidecars=None, **kwargs):
+    """
+    Plans the operations needed to put the image file and its sidecar and auxiliary files into the BIDS directory.
+    No files are written. The plan can be applied with execute_operations.
+    :param index: SubjectIndex of the subject folder used to look up the source files without listing directories.
+    :param unmatched_sidecars: list to which the output sidecars without a precompiled template are added, so that
+    they can be reported together. Otherwise, each of them is reported with a warning.
+    :param physio_sampling_frequency: Sampling frequency (Hz) of the Lifespan physio csv files. If set, the csv files
+    are converted to BIDS _physio.tsv.gz files. Otherwise, they are copied as is.
+    :return: dictionary with the source image, the main output file, and the list of operations.
+    """
+    name = bids_name(subject_id, modality, folder, **kwargs)
+    output_file = name.full_path(bids_dir)
+    operations = [transfer_operation(image_file, output_file, method)]
 
     if use_precompiled_sidecars:
         # use predefined json sidecar files from this project
         # the sidcare files can be found under the "hcpya-sidecars" directory
-        json_sidecar = match_json_sidecar(output_file)
+        entities = dict(name.entities)
+        json_sidecar = get_sidecar_templates().match(modality, task=entities.get("task"), dir=entities.get("dir"))
     else:
         json_sidecar = image_file.replace(".nii.gz", ".json")
 
     output_json_sidecar = output_file.replace(".nii.gz", ".json")
 
-    if json_sidecar is not None and os.path.exists(json_sidecar):
-        in_files.append(json_sidecar)
-        out_files.append(output_json_sidecar)
+    # fields that are added to the json sidecar
+    sidecar_fields = dict()
+    if intended_for is not None:
+        sidecar_fields["IntendedFor"] = intended_for
+    if "task-" in os.path.basename(output_file):
+        # add task name to json sidecar
+        # get task name from filename using regular expression
+        sidecar_fields["TaskName"] = re.search("task-([a-zA-Z0-9]+)_", os.path.basename(output_file)).group(1)
+
+    if use_precompiled_sidecars and json_sidecar is not None:
+        # the templates are rendered with the fields of this output instead of being copied
+        operations.append(sidecar_operation(json_sidecar, output_json_sidecar, sidecar_fields))
+    elif json_sidecar is not None and file_exists(json_sidecar, index):
+        if len(sidecar_fields) > 0:
+            operations.append(sidecar_operation(json_sidecar, output_json_sidecar, sidecar_fields))
+        else:
+            operations.append(transfer_operation(json_sidecar, output_json_sidecar, method))
     else:
-        warnings.warn("JSON sidecar file does not exist: {}".format(json_sidecar))
+        if use_precompiled_sidecars and unmatched_sidecars is not None:
+            unmatched_sidecars.append(output_json_sidecar)
+        else:
+            warnings.warn("JSON sidecar file does not exist: {}".format(json_sidecar))
+        if len(sidecar_fields) > 0:
+            operations.append(sidecar_operation(None, output_json_sidecar, sidecar_fields))
 
     if modality == "dwi":
         # check for bval and bvec files
-        bval_file = image_file.replace(".nii.gz", ".bval")
-        bvec_file = image_file.replace(".nii.gz", ".bvec")
-        if os.path.exists(bval_file):
-            in_files.append(bval_file)
-            out_files.append(output_file.replace(".nii.gz", ".bval"))
+        # these are taken from the original unprocessed image, since the gradient unwarping does not change them
+        bval_file = orig_image_file.replace(".nii.gz", ".bval")
+        bvec_file = orig_image_file.replace(".nii.gz", ".bvec")
+        if file_exists(bval_file, index):
+            operations.append(transfer_operation(bval_file, output_file.replace(".nii.gz", ".bval"), method))
         else:
-            warnings.warn("No bval file found for {}".format(image_file))
-        if os.path.exists(bvec_file):
-            in_files.append(bvec_file)
-            out_files.append(output_file.replace(".nii.gz", ".bvec"))
+            warnings.warn("No bval file found for {}".format(orig_image_file))
+        if file_exists(bvec_file, index):
+            operations.append(transfer_operation(bvec_file, output_file.replace(".nii.gz", ".bvec"), method))
         else:
-            warnings.warn("No bvec file found for {}".format(image_file))
+            warnings.warn("No bvec file found for {}".format(orig_image_file))
     elif modality == "bold":
         # check for auxiliary fMRI files such as events, physiological, and eye movement files
         # these files will be based on the original unprocessed image file
-        in_files, out_files = add_bold_auxiliary_files(orig_image_file, bids_dir, subject_id, folder, in_files, out_files,
-                                                       output_file, overwrite=overwrite, dryrun=dryrun, **kwargs)
+        add_bold_auxiliary_files(orig_image_file, bids_dir, name, operations, output_file, method=method, index=index,
+                                 physio_sampling_frequency=physio_sampling_frequency)
+
+    return {"source": orig_image_file, "output_file": output_file, "modality": modality, "operations": operations}
+
+
+def transfer_operation(in_file, out_file, method):
+    if in_file[-5:] == ".json":
+        # We want to copy the json sidecar files
+        # Otherwise, we end up editing the original json sidecar file or linking to the sidecar template
+        method = "copy"
+    return {"action": "transfer", "method": method, "in_file": in_file, "out_file": out_file}
+
+
+def sidecar_operation(in_file, out_file, fields):
+    # the sidecar is rendered in memory from the source sidecar with all the fields applied and written once
+    return {"action": "sidecar", "in_file": in_file, "out_file": out_file, "fields": fields}
+
+
+def get_output_files(group):
+    output_files = list()
+    for operation in group["operations"]:
+        if operation["out_file"] not in output_files:
+            output_files.append(operation["out_file"])
+    return output_files
 
-    if os.path.exists(output_file):
+
+def get_input_files(group):
+    """
+    :return: the files that the operations of the group read, other than the source image (sidecars, EV and physio
+    files, sidecar templates, and the preprocessed/derived file that replaces the source image).
+    """
+    input_files = list()
+    for operation in group["operations"]:
+        for in_file in operation.get("in_files", [operation.get("in_file")]):
+            if in_file is not None and in_file != group["source"] and in_file not in input_files:
+                input_files.append(in_file)
+    return input_files
+
+
+def prepare_outputs(group, overwrite=False, dryrun=False, exists_ok=True):
+    """
+    Removes the existing outputs of a group that are written again (outputs of an interrupted conversion that were not
+    completed, or all the outputs with overwrite).
+    :return: False if the output file already exists and the group is skipped.
+    """
+    output_file = group["output_file"]
+    out_files = get_output_files(group)
+    completed = group.get("completed")
+
+    count("stat")
+    if completed is not None:
+        for file in out_files:
+            if file not in completed and os.path.lexists(file):
+                logger.debug("Removing output of the interrupted conversion: %s", file)
+                if not dryrun:
+                    os.remove(file)
+    elif os.path.exists(output_file):
         if exists_ok and not overwrite:
             warnings.warn("File already exists: {}".format(output_file))
-            return
+            return False
         elif not overwrite:
             raise FileExistsError("File already exists: {}".format(output_file))
         elif overwrite:
-            print("Overwriting file: {}".format(output_file))
+            logger.debug("Overwriting file: %s", output_file)
             if not dryrun:
                 for file in out_files:
                     if os.path.exists(file):
                         os.remove(file)
+    return True
+
 
-    print_text = "\n".join(["{} --> {}".format(in_file, out_file) for in_file, out_file in zip(in_files, out_files)])
+def get_pending_sidecars(group):
+    # the sidecar operations of the group that were not completed by an interrupted conversion
+    completed = group.get("completed", ())
+    return [operation for operation in group["operations"]
+            if operation["action"] == "sidecar" and operation["out_file"] not in completed]
+
+
+def execute_operations(group, overwrite=False, dryrun=False, exists_ok=True, on_complete=None, prepared=None,
+                       written=()):
+    """
+    Applies the operations planned by plan_move_to_bids.
+    If the group lists the "completed" output files of an interrupted conversion (see journal.py), the operations
+    that wrote these files are skipped and any other existing output of the group is written again.
+    :param on_complete: function that is called with each output file once it has been written completely.
+    :param prepared: the result of prepare_outputs if it was already called for the group.
+    :param written: the sidecars of the group that were already written in a batch (see sidecars.write_sidecars).
+    :return: list of the output files that were written. Empty if the output file already exists.
+    """
+    output_file = group["output_file"]
+    out_files = get_output_files(group)
+    completed = group.get("completed")
+
+    if prepared is None:
+        prepared = prepare_outputs(group, overwrite=overwrite, dryrun=dryrun, exists_ok=exists_ok)
+    if not prepared:
+        return list()
 
     if not dryrun:
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    move_files(in_files, out_files, method=method, dryrun=dryrun, print_text=print_text)
-
-    if intended_for is not None and not dryrun:
-        add_intended_for_to_json(output_json_sidecar, intended_for)
+    # an output file is complete after the last operation that writes it
+    last_operations = {operation["out_file"]: i for i, operation in enumerate(group["operations"])}
+    for i, operation in enumerate(group["operations"]):
+        if completed is not None and operation["out_file"] in completed:
+            logger.debug("Skipping completed operation: %s", operation["out_file"])
+            continue
+        elif operation["action"] == "transfer":
+            with timed("transfer"):
+                move_files([operation["in_file"]], [operation["out_file"]], method=operation["method"],
+                           dryrun=dryrun)
+        elif operation["action"] == "physio":
+            if dryrun:
+                logger.debug("Converting physio file: %s --> %s", operation["in_file"], operation["out_file"])
+            else:
+                with timed("physio"):
+                    count("bytes", convert_physio_file(operation["in_file"], operation["out_file"],
+                                                       delimiter=operation["delimiter"],
+                                                       skip_header=operation["skip_header"]))
+                count("files")
+        elif operation["action"] == "events":
+            if not dryrun and (overwrite or not os.path.exists(operation["out_file"])):
+                with timed("events"):
+                    write_events_file(operation["in_files"], operation["out_file"])
+                count("files")
+        elif operation["action"] == "sidecar" and operation["out_file"] in written:
+            # written in a batch with the other sidecars of the subject
+            pass
+        elif operation["action"] == "sidecar":
+            logger.debug("Writing sidecar: %s --> %s (%s)", operation["in_file"], operation["out_file"],
+                         ", ".join(operation["fields"]))
+            if not dryrun:
+                with timed("sidecar"):
+                    write_sidecar(operation["out_file"], render_sidecar(operation["in_file"], operation["fields"]))
+                count("files")
+        else:
+            raise ValueError("Unknown action: {}".format(operation["action"]))
+        if on_complete is not None and not dryrun and last_operations[operation["out_file"]] == i:
+            on_complete(operation["out_file"])
 
-    if "task-" in os.path.basename(output_file) and not dryrun:
-        # add task name to json sidecar
-        # get task name from filename using regular expression
-        task_name = re.search("task-([a-zA-Z0-9]+)_", os.path.basename(output_file)).group(1)
-        add_task_name_to_json(output_json_sidecar, task_name)
+    return out_files
 
 
-def move_files(in_files, out_files, method="hardlink", dryrun=False, print_text=""):
+def move_files(in_files, out_files, method="hardlink", dryrun=False):
     for in_file, out_file in zip(in_files, out_files):
         if method == "copy" or in_file[-5:] == ".json":
             # We want to copy the json sidecar files
             # Otherwise, we end up editing the original json sidecar file or linking to the sidecar template
-            print("Copying file: {}".format(print_text))
+            logger.debug("Copying file: %s --> %s", in_file, out_file)
             if not dryrun:
-                shutil.copy(in_file, out_file)
+                copy_file(in_file, out_file)
         elif method == "hardlink":
-            print("Creating hardlink: {}".format(print_text))
+            logger.debug("Creating hardlink: %s --> %s", in_file, out_file)
             if not dryrun:
                 os.link(in_file, out_file)
+                record_transfer("hardlink")
+        elif method == "auto":
+            logger.debug("Linking or copying file: %s --> %s", in_file, out_file)
+            if not dryrun:
+                auto_transfer(in_file, out_file)
         elif method == "symlink":
-            print("Creating symlink: {}".format(print_text))
+            logger.debug("Creating symlink: %s --> %s", in_file, out_file)
             if not dryrun:
                 os.symlink(in_file, out_file)
+                record_transfer("symlink")
         elif method == "move":
-            print("Moving file: {}".format(print_text))
+            logger.debug("Moving file: %s --> %s", in_file, out_file)
             if not dryrun:
-                shutil.move(in_file, out_file)
+                move_file(in_file, out_file)
         else:
             raise ValueError("Unknown method: {}".format(method))
 
 
-def generate_events_file(bids_dir, image_file, subject_id, folder, overwrite=False, dryrun=False, skip=("Sync.txt",),
-                         task_software="*", **kwargs):
+def find_events_files(image_file, skip=("Sync.txt",), task_software="*", index=None):
     # check for events files
     wildcard = os.path.join(os.path.dirname(image_file), "LINKED_DATA", task_software, "EVs", "*.txt")
-    print("Searching for events files: {}".format(wildcard))
-    events_files = glob.glob(wildcard)
-    print("Found {} events files for {}".format(len(events_files), image_file))
-    print("Events files: ", events_files)
-    # combine all events files into one tsv file
-    tsv_output_file = generate_full_output_filename(bids_dir, subject_id, modality="events", folder=folder,
-                                                    extension=".tsv", **kwargs)
-    tsv_header = ["onset", "duration", "value", "trial_type"]
-    if len(events_files) > 0 and not dryrun and (overwrite or not os.path.exists(tsv_output_file)):
-        print("Combining events files into {}".format(tsv_output_file))
-        with open(tsv_output_file, "w") as output_file:
-            output_file.write("\t".join(tsv_header) + "\n")
-            rows = list()
-            for events_file in events_files:
-                if os.path.basename(events_file) in skip:
-                    continue
-                trial_type = os.path.basename(events_file).replace(".txt", "")
-                with open(events_file, "r") as input_file:
-                    for line in input_file.readlines():
-                        if "\t" in line:
-                            rows.append(line.strip().split("\t") + [trial_type])
-                        else:
-                            rows.append(line.strip().split(" ") + [trial_type])
-            # sort the rows by onset
-            rows.sort(key=lambda x: float(x[0]))
-            for row in rows:
-                output_file.write("\t".join(row) + "\n")
-
-
-def add_bold_auxiliary_files(image_file, bids_dir, subject_id, folder, in_files, out_files, output_file,
-                             overwrite=False, dryrun=False, **kwargs):
+    logger.debug("Searching for events files: %s", wildcard)
+    events_files = glob_files(wildcard, index)
+    logger.debug("Found %d events files for %s: %s", len(events_files), image_file, events_files)
+    return [events_file for events_file in events_files if os.path.basename(events_file) not in skip]
+
+
+def add_bold_auxiliary_files(image_file, bids_dir, name, operations, output_file, method="hardlink", index=None,
+                             physio_sampling_frequency=None):
+    """
+    :param name: the BIDSName of the bold image. The auxiliary files are named after it.
+    """
     # add physio, eye tracking, and events files
     # check for physio files
-    convert_physio_files(image_file, output_file, in_files, out_files, dryrun=dryrun)
+    convert_physio_files(image_file, output_file, operations, method=method, index=index,
+                         physio_sampling_frequency=physio_sampling_frequency)
 
     # check for eye tracking file
-    eye_tracking_files = glob.glob(os.path.join(os.path.dirname(image_file), "LINKED_DATA", "PSYCHOPY", "*.mp4"))
+    eye_tracking_files = glob_files(os.path.join(os.path.dirname(image_file), "LINKED_DATA", "PSYCHOPY", "*.mp4"),
+                                    index)
     if len(eye_tracking_files) == 1:
-        in_files.append(eye_tracking_files[0])
-        out_files.append(generate_full_output_filename(bids_dir, subject_id, modality="physio", folder=folder,
-                                                       recording="eyetracking", extension=".mp4", **kwargs))
+        operations.append(transfer_operation(
+            eye_tracking_files[0],
+            name.replace(modality="physio", extension=".mp4", recording="eyetracking").full_path(bids_dir), method))
     elif len(eye_tracking_files) > 1:
         warnings.warn("Found multiple eye tracking files for {}. Skipping.".format(image_file))
 
-    generate_events_file(bids_dir, image_file, subject_id, folder, overwrite=overwrite, dryrun=dryrun, **kwargs)
+    # combine all events files into one tsv file
+    events_files = find_events_files(image_file, index=index)
+    if len(events_files) > 0:
+        tsv_output_file = name.replace(modality="events", extension=".tsv").full_path(bids_dir)
+        operations.append({"action": "events", "in_files": events_files, "out_file": tsv_output_file})
 
-    return in_files, out_files
+    return operations
 
 
-def convert_physio_files(image_file, output_file, in_files, out_files, dryrun=False):
+def convert_physio_files(image_file, output_file, operations, method="hardlink", index=None,
+                         physio_sampling_frequency=None):
     # For HPCPYA the physio file is in .txt format with tab separated values (no headers)
     # For Lifespan the physio file is in csv format (with headers)
     # BIDS requires no headers along with a JSON sidecar file
     # https://bids-specification.readthedocs.io/en/stable/modality-specific-files/physiological-and-other-continuous-recordings.html
 
-    output_physio_file = output_file.replace("_bold.nii.gz", "_physio.csv")
-    physio_csv_files = glob.glob(os.path.join(os.path.dirname(image_file), "LINKED_DATA", "PHYSIO", "*.csv"))
-    if len(physio_csv_files) == 1:
-        # TODO: convert physio files to tsv.gz compatible with BIDS
-        in_files.append(physio_csv_files[0])
-        out_files.append(output_physio_file)
+    output_physio_file = output_file.replace("_bold.nii.gz", "_physio.tsv.gz")
+    output_json_sidecar = output_physio_file.replace(".tsv.gz", ".json")
+    physio_csv_files = glob_files(os.path.join(os.path.dirname(image_file), "LINKED_DATA", "PHYSIO", "*.csv"), index)
+    if len(physio_csv_files) == 1 and physio_sampling_frequency is None:
+        # without the sampling frequency the csv file cannot be described in BIDS, so it is copied as is
+        operations.append(transfer_operation(physio_csv_files[0],
+                                             output_file.replace("_bold.nii.gz", "_physio.csv"), method))
+    elif len(physio_csv_files) == 1:
+        # the header is moved into the Columns field of the sidecar
+        operations.append({"action": "physio", "in_file": physio_csv_files[0], "out_file": output_physio_file,
+                           "delimiter": ",", "skip_header": True})
+        operations.append(sidecar_operation(None, output_json_sidecar,
+                                            {"SamplingFrequency": physio_sampling_frequency, "StartTime": 0,
+                                             "Columns": read_physio_header(physio_csv_files[0])}))
     elif len(physio_csv_files) > 1:
         warnings.warn("Found multiple physio files for {}. Skipping.".format(image_file))
     else:
         # search for physio files in txt format (HCPYA)
-        physio_txt_files = glob.glob(os.path.join(os.path.dirname(image_file), "LINKED_DATA", "PHYSIO", "*.txt"))
-        output_physio_file = output_file.replace("_bold.nii.gz", "_physio.tsv.gz")
-        if not dryrun and len(physio_txt_files) == 1:
-            os.makedirs(os.path.dirname(output_physio_file), exist_ok=True)
-            # gunzip the text file
-            import gzip
-            with open(physio_txt_files[0], "rb") as f_in:
-                with gzip.open(output_physio_file, "wb") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            # copy the json sidecar file
-            output_json_sidecar = output_physio_file.replace(".tsv.gz", ".json")
-            json_sidecar = os.path.abspath(os.path.join(os.path.dirname(__file__), "hcpya-sidecars", "physio.json"))
-            in_files.append(json_sidecar)
-            out_files.append(output_json_sidecar)
-
-
-def match_json_sidecar(image_file):
-    # get the task name from the filename
-    try:
-        task_name = re.search("task-([a-zA-Z0-9]+)_", image_file).group(1)
-    except AttributeError:
-        task_name = None
-
-    # get the acquisition direction
-    try:
-        acq_dir = re.search("dir-([a-zA-Z0-9]+)_", image_file).group(1)
-    except AttributeError:
-        acq_dir = None
-
-    # get the modality
-    modality = image_file.split("_")[-1].split(".")[0]
-
-    # find a matching sidecar file
-    sidecar_basename = f"{modality}.json"
-    if acq_dir is not None:
-        sidecar_basename = f"dir-{acq_dir}_{sidecar_basename}"
-    if task_name is not None:
-        sidecar_basename = f"task-{task_name}_{sidecar_basename}"
-    sidecar_filename = os.path.abspath(os.path.join(os.path.dirname(__file__), "hcpya-sidecars", sidecar_basename))
-
-    if os.path.exists(sidecar_filename):
-        return sidecar_filename
-
-
-def add_task_name_to_json(json_file, task_name):
-    print("Adding task name {} to {}".format(task_name, json_file))
-    if os.path.exists(json_file):
-        with open(json_file, "r") as f:
-            data = json.load(f)
-    else:
-        data = dict()
-    data["TaskName"] = task_name
-    with open(json_file, "w") as f:
-        json.dump(data, f, indent=4)
+        physio_txt_files = glob_files(os.path.join(os.path.dirname(image_file), "LINKED_DATA", "PHYSIO", "*.txt"),
+                                      index)
+        if len(physio_txt_files) == 1:
+            # compress the text file
+            operations.append({"action": "physio", "in_file": physio_txt_files[0], "out_file": output_physio_file,
+                               "delimiter": "\t", "skip_header": False})
+            # render the json sidecar from its template
+            operations.append(sidecar_operation(get_sidecar_templates().match("physio"), output_json_sidecar,
+                                                dict()))
+    return operations
 
 
 def get_acquisition_time(image_file):
@@ -332,34 +464,14 @@ def get_acquisition_time(image_file):
     return data["AcquisitionTime"]
 
 
-def spin_echo_intended_for(subject_id, use_bids_uris, basename, image_file):
-    # figure out the IntendedFor filename
-    intended_for_kwargs = {"subject_id": subject_id, "bids_uris": use_bids_uris}
-    set_intended_for = True
-    if "fMRI" in basename:
-        intended_for_kwargs["modality"] = "bold"
-        intended_for_kwargs["folder"] = "func"
-        intended_for_kwargs["task"] = basename.split("_")[1].lower()
-        intended_for_kwargs["dir"] = basename.split("_")[2]
-        if "rest" in intended_for_kwargs["task"]:
-            intended_for_kwargs["run"] = intended_for_kwargs["task"].split("rest")[1]
-            intended_for_kwargs["task"] = "rest"
-    elif "PCASL" in basename:
-        intended_for_kwargs["modality"] = "asl"
-        intended_for_kwargs["folder"] = "perf"
-        intended_for_kwargs["dir"] = "PA"
-    elif "T1w" in basename:
-        intended_for_kwargs["modality"] = "T1w"
-        intended_for_kwargs["folder"] = "anat"
-    elif "T2w" in basename or "HiResHp" in basename:
-        intended_for_kwargs["modality"] = "T2w"
-        intended_for_kwargs["folder"] = "anat"
-    else:
+def spin_echo_intended_for(subject_id, use_bids_uris, basename, image_file, classifier=None):
+    # figure out the IntendedFor filename from the name of the folder that contains the fieldmap
+    if classifier is None:
+        classifier = get_classifier()
+    target = classifier.classify_fieldmap_target(basename)
+    if target is None:
         warnings.warn("Unknown IntendedFor modality: {}. "
                       "Not setting IntendedFor field for {}".format(basename, image_file))
-        set_intended_for = False
-    if set_intended_for:
-        return generate_intended_for(**intended_for_kwargs)
-    else:
         return None
-
+    return generate_intended_for(subject_id=subject_id, modality=target["modality"], folder=target["folder"],
+                                 bids_uris=use_bids_uris, **target["entities"])
@@ -0,0 +1,259 @@
+# Validation of the converted BIDS outputs and an index of their NIfTI headers.
+# Only the NIfTI-1 header (the first 348 bytes) of each image is decompressed from the gzip stream, so validating an
+# image reads a few kilobytes no matter how large it is. The checks are:
+#   * the header is a valid NIfTI-1 header and the number of dimensions fits the suffix (e.g. 4D _bold, 3D _T1w).
+#   * the TR of the header (pixdim[4]) matches the RepetitionTime of the sidecar.
+#   * the events of a run start before the end of the run (number of volumes * TR).
+#   * the sidecars have the fields that BIDS requires for their suffix.
+#   * the IntendedFor targets of the sidecars exist.
+# The header values and the issues are stored in an SQLite database (.hcp2bids_validation.db) in the BIDS directory
+# that can be queried later, e.g. "SELECT path, nt FROM headers WHERE suffix = 'bold' AND nt < 100".
+# The subjects are validated in parallel worker processes and the results are written to the database by the main
+# process. The conversion validates each subject as soon as it is converted with --validate. The shards of a sharded
+# conversion do not write to the database: their results are stored in the shard reports and written by finalize.py,
+# so the database never has several writers (which SQLite does not support on network filesystems).
+# Usage: python validate.py --bids_dir <output_dir> [--jobs 8]
+import argparse
+import concurrent.futures
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import struct
+import sys
+import time
+
+from logs import LOG_LEVELS, add_time, count, logger, setup_logging
+
+VALIDATION_DB_FILENAME = ".hcp2bids_validation.db"
+NIFTI_HEADER_SIZE = 348
+# seconds per unit of the time code of xyzt_units
+TIME_UNITS = {8: 1., 16: 1e-3, 24: 1e-6}
+# number of dimensions of the images of each suffix
+EXPECTED_DIMENSIONS = {"bold": (4,), "dwi": (4,), "asl": (4,), "sbref": (3,), "T1w": (3,), "T2w": (3,), "epi": (3, 4)}
+# sidecar fields that BIDS requires for each suffix
+REQUIRED_FIELDS = {"bold": ("RepetitionTime", "TaskName"), "epi": ("PhaseEncodingDirection", "TotalReadoutTime")}
+TR_TOLERANCE = 1e-3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    path TEXT PRIMARY KEY, subject TEXT NOT NULL, suffix TEXT NOT NULL, ndim INTEGER, nx INTEGER, ny INTEGER,
+    nz INTEGER, nt INTEGER, datatype INTEGER, bitpix INTEGER, dx REAL, dy REAL, dz REAL, tr REAL);
+CREATE INDEX IF NOT EXISTS headers_subject ON headers (subject);
+CREATE INDEX IF NOT EXISTS headers_suffix ON headers (suffix);
+CREATE TABLE IF NOT EXISTS issues (
+    path TEXT NOT NULL, subject TEXT NOT NULL, level TEXT NOT NULL, check_name TEXT NOT NULL, message TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS issues_subject ON issues (subject);
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bids_dir", type=str, required=True, help="path to the BIDS directory.")
+    parser.add_argument("--participant_label", type=str, nargs="+",
+                        help="only validate these subjects. (default: all subjects)")
+    parser.add_argument("--jobs", type=int,
+                        help="number of subjects to validate in parallel. (default: number of CPUs)")
+    parser.add_argument("--log_level", type=str, choices=LOG_LEVELS, default="INFO",
+                        help="minimum level of the printed messages. (default: INFO)")
+    return parser.parse_args()
+
+
+def read_nifti_header(image_file):
+    """
+    Reads the NIfTI-1 header of a (gzipped) image. Only the header is decompressed.
+    :return: dictionary with the header values or None if the file is not a NIfTI-1 image.
+    """
+    opener = gzip.open if image_file.endswith(".gz") else open
+    with opener(image_file, "rb") as f:
+        data = f.read(NIFTI_HEADER_SIZE)
+    count("bytes_validated", len(data))
+    if len(data) < NIFTI_HEADER_SIZE or data[344:347] not in (b"n+1", b"ni1"):
+        return None
+    endian = "<" if struct.unpack("<i", data[:4])[0] == NIFTI_HEADER_SIZE else ">"
+    dim = struct.unpack(endian + "8h", data[40:56])
+    datatype, bitpix = struct.unpack(endian + "2h", data[70:74])
+    pixdim = struct.unpack(endian + "8f", data[76:108])
+    ndim = dim[0]
+    if not 1 <= ndim <= 7:
+        return None
+    shape = [dim[i] if i <= ndim else 1 for i in range(1, 5)]
+    return {"ndim": ndim, "nx": shape[0], "ny": shape[1], "nz": shape[2], "nt": shape[3], "datatype": datatype,
+            "bitpix": bitpix, "dx": pixdim[1], "dy": pixdim[2], "dz": pixdim[3],
+            "tr": pixdim[4] * TIME_UNITS.get(data[123] & 0x38, 1.) if ndim >= 4 else None}
+
+
+def get_suffix(filename):
+    return os.path.basename(filename).split(".")[0].split("_")[-1]
+
+
+def read_json(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def read_event_onsets(events_file):
+    with open(events_file, "r") as f:
+        return [float(row["onset"]) for row in csv.DictReader(f, delimiter="\t")]
+
+
+def intended_for_target(target, bids_dir, subject_dir):
+    if target.startswith("bids::"):
+        return os.path.join(bids_dir, target[len("bids::"):])
+    return os.path.join(subject_dir, target)
+
+
+def validate_image(image_file, header, issue):
+    suffix = get_suffix(image_file)
+    expected = EXPECTED_DIMENSIONS.get(suffix)
+    if expected is not None and header["ndim"] not in expected:
+        issue("error", "dimensions", "{}D image, expected {}D".format(
+            header["ndim"], " or ".join([str(ndim) for ndim in expected])))
+    if min(header["nx"], header["ny"], header["nz"], header["nt"]) < 1:
+        issue("error", "dimensions", "empty dimension: {}x{}x{}x{}".format(
+            header["nx"], header["ny"], header["nz"], header["nt"]))
+    sidecar_file = image_file.replace(".nii.gz", ".json")
+    if suffix == "bold" and header["tr"] is not None and os.path.exists(sidecar_file):
+        repetition_time = read_json(sidecar_file).get("RepetitionTime")
+        if isinstance(repetition_time, (int, float)) and abs(repetition_time - header["tr"]) > TR_TOLERANCE:
+            issue("error", "repetition_time", "header TR {:.4f} s does not match RepetitionTime {} s".format(
+                header["tr"], repetition_time))
+    events_file = image_file.replace("_bold.nii.gz", "_events.tsv")
+    if suffix == "bold" and header["tr"] and os.path.exists(events_file):
+        onsets = read_event_onsets(events_file)
+        run_duration = header["nt"] * header["tr"]
+        if len(onsets) > 0 and max(onsets) >= run_duration:
+            issue("error", "events", "event onset {} s after the end of the run ({} volumes, {:.2f} s)".format(
+                max(onsets), header["nt"], run_duration))
+
+
+def validate_sidecar(sidecar_file, bids_dir, subject_dir, issue):
+    try:
+        data = read_json(sidecar_file)
+    except ValueError as error:
+        issue("error", "sidecar", "invalid JSON: {}".format(error))
+        return
+    for field in REQUIRED_FIELDS.get(get_suffix(sidecar_file), ()):
+        if field not in data:
+            issue("error", "required_fields", "missing required field {}".format(field))
+    intended_for = data.get("IntendedFor", list())
+    for target in intended_for if isinstance(intended_for, list) else [intended_for]:
+        count("stat")
+        if not os.path.lexists(intended_for_target(target, bids_dir, subject_dir)):
+            issue("error", "intended_for", "IntendedFor target does not exist: {}".format(target))
+
+
+def validate_subject(bids_dir, subject_id):
+    """
+    Validates the outputs of a subject.
+    :return: dictionary with the "headers" and the "issues" of the subject (rows of the validation database).
+    """
+    start = time.perf_counter()
+    subject_dir = os.path.join(bids_dir, "sub-{}".format(subject_id))
+    headers = list()
+    issues = list()
+    for root, _, files in os.walk(subject_dir):
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            relative_path = os.path.relpath(path, bids_dir)
+
+            def issue(level, check, message):
+                issues.append((relative_path, subject_id, level, check, message))
+
+            if filename.endswith(".nii.gz") or filename.endswith(".nii"):
+                header = read_nifti_header(path)
+                if header is None:
+                    issue("error", "header", "not a NIfTI-1 image")
+                    continue
+                headers.append(dict(header, path=relative_path, subject=subject_id, suffix=get_suffix(filename)))
+                validate_image(path, header, issue)
+            elif filename.endswith(".json"):
+                validate_sidecar(path, bids_dir, subject_dir, issue)
+    add_time("validate", time.perf_counter() - start)
+    return {"subject": subject_id, "headers": headers, "issues": issues}
+
+
+class ValidationDatabase(object):
+    """
+    SQLite database with the NIfTI headers and the validation issues of the outputs.
+    """
+    def __init__(self, bids_dir):
+        self.filename = os.path.join(bids_dir, VALIDATION_DB_FILENAME)
+        os.makedirs(bids_dir, exist_ok=True)
+        self.connection = sqlite3.connect(self.filename)
+        # the default rollback journal instead of WAL, which needs shared memory and does not work on network
+        # filesystems (databases written by older versions are switched back)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.executescript(SCHEMA)
+
+    def replace_subject(self, result):
+        columns = ("path", "subject", "suffix", "ndim", "nx", "ny", "nz", "nt", "datatype", "bitpix", "dx", "dy",
+                   "dz", "tr")
+        with self.connection:
+            self.connection.execute("DELETE FROM headers WHERE subject = ?", (result["subject"],))
+            self.connection.execute("DELETE FROM issues WHERE subject = ?", (result["subject"],))
+            self.connection.executemany("INSERT INTO headers ({}) VALUES ({})".format(
+                ", ".join(columns), ", ".join(["?"] * len(columns))),
+                [tuple([header[column] for column in columns]) for header in result["headers"]])
+            self.connection.executemany("INSERT INTO issues VALUES (?, ?, ?, ?, ?)", result["issues"])
+
+    def close(self):
+        self.connection.close()
+
+
+def log_validation_results(results):
+    issues = [issue for result in results for issue in result["issues"]]
+    logger.info("Validated %d subjects: %d images, %d issues.", len(results),
+                sum([len(result["headers"]) for result in results]), len(issues))
+    for path, _, level, check, message in issues:
+        (logger.error if level == "error" else logger.warning)("Validation %s (%s): %s: %s", level, check, path,
+                                                               message)
+    return issues
+
+
+def find_subject_ids(bids_dir):
+    return sorted([name[len("sub-"):] for name in os.listdir(bids_dir)
+                   if name.startswith("sub-") and os.path.isdir(os.path.join(bids_dir, name))])
+
+
+def write_validation_results(bids_dir, results):
+    database = ValidationDatabase(bids_dir)
+    try:
+        for result in results:
+            database.replace_subject(result)
+    finally:
+        database.close()
+
+
+def validate(bids_dir, participant_label=None, jobs=None):
+    """
+    Validates the subjects in parallel and stores the results in the validation database.
+    :return: list of the issues found.
+    """
+    subject_ids = find_subject_ids(bids_dir) if participant_label is None else participant_label
+    results = list()
+    database = ValidationDatabase(bids_dir)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            futures = [executor.submit(validate_subject, bids_dir, subject_id) for subject_id in subject_ids]
+            # the results are written as the subjects finish, so the database fills up while the workers run
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                database.replace_subject(result)
+                results.append(result)
+    finally:
+        database.close()
+    return log_validation_results(sorted(results, key=lambda result: result["subject"]))
+
+
+def main():
+    args = parse_args()
+    setup_logging(args.log_level)
+    issues = validate(args.bids_dir, participant_label=args.participant_label, jobs=args.jobs)
+    if any([issue[2] == "error" for issue in issues]):
+        sys.exit("Validation found {} issues. See {}.".format(len(issues), VALIDATION_DB_FILENAME))
+
+
+if __name__ == "__main__":
+    main()
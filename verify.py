@@ -0,0 +1,181 @@
+# Verifies that the BIDS outputs match the source files they were transferred from and records their checksums.
+# The outputs of each source image are taken from the manifest. Outputs that are the source file itself (hardlinks,
+# symlinks, or a source that was moved by a rename) are identified by their inode and are not read. The other outputs
+# (copies) are hashed together with their sources, and every output that was hashed gets its checksum recorded in the
+# manifest and in a b2sum compatible checksum file (check with `b2sum -c .hcp2bids_b2sums` from the BIDS directory).
+# Outputs whose source no longer exists (moved to another filesystem) are compared against their recorded checksum.
+# The files are hashed with BLAKE2b (hashlib) in large sequential reads into a reused buffer. hashlib releases the GIL
+# while hashing, so the files are hashed in a thread pool and the throughput scales with the number of cores.
+# Usage: python verify.py --bids_dir <output_dir> [--jobs 8]
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import sys
+import time
+
+from journal import atomic_write
+from logs import LOG_LEVELS, add_time, count, logger, setup_logging
+from manifest import load_manifest, save_manifest
+
+CHUNK_SIZE = 8 * 1024 * 1024
+HASH_NAME = "blake2b"
+CHECKSUMS_FILENAME = ".hcp2bids_b2sums"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bids_dir", type=str, required=True, help="path to the BIDS directory.")
+    parser.add_argument("--participant_label", type=str, nargs="+",
+                        help="only verify these subjects. (default: all subjects in the manifest)")
+    parser.add_argument("--jobs", type=int, help="number of files to hash in parallel. (default: number of CPUs)")
+    parser.add_argument("--log_level", type=str, choices=LOG_LEVELS, default="INFO",
+                        help="minimum level of the printed messages. (default: INFO)")
+    return parser.parse_args()
+
+
+def hash_file_chunked(filename, chunk_size=CHUNK_SIZE):
+    """
+    :return: the BLAKE2b hex digest of the file and the number of bytes read.
+    """
+    digest = hashlib.blake2b()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    n_bytes = 0
+    with open(filename, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+            n_bytes += n
+    return digest.hexdigest(), n_bytes
+
+
+def is_source_file(output_file, source_file, source_inode=None):
+    """
+    Returns True if the inode shows that the output is the source file: a hardlink, a symlink to the source, or the
+    source itself after it was moved by a rename (source_inode is the inode that the source had before the move).
+    """
+    try:
+        count("stat")
+        output_stat = os.stat(output_file)
+    except FileNotFoundError:
+        return False
+    try:
+        count("stat")
+        source_stat = os.stat(source_file)
+    except FileNotFoundError:
+        return source_inode is not None and output_stat.st_ino == source_inode
+    return (output_stat.st_dev, output_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino)
+
+
+def hash_files(filenames, jobs=None):
+    """
+    Hashes the files in parallel.
+    :return: dictionary mapping the filenames to their hex digests and the total number of bytes read.
+    """
+    start = time.perf_counter()
+    digests = dict()
+    n_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        for filename, (digest, size) in zip(filenames, executor.map(hash_file_chunked, filenames)):
+            digests[filename] = digest
+            n_bytes += size
+    add_time("verify", time.perf_counter() - start)
+    count("bytes_hashed", n_bytes)
+    return digests, n_bytes
+
+
+def verify_manifest(manifest, bids_dir, subject_ids=None, jobs=None, recheck=True):
+    """
+    Verifies the outputs in the manifest and records their checksums in the manifest entries.
+    :param subject_ids: only verify these subjects (default: all subjects).
+    :param recheck: also verify the entries that already have checksums. Otherwise only new entries are verified.
+    :return: list of the problems found.
+    """
+    start = time.perf_counter()
+    checks = list()
+    to_hash = set()
+    n_identical = 0
+    for subject_id, subject in manifest["subjects"].items():
+        if subject_ids is not None and subject_id not in subject_ids:
+            continue
+        for source, entry in subject["sources"].items():
+            if not recheck and "checksums" in entry:
+                continue
+            copied_from = entry.get("copied_from", dict())
+            entry.setdefault("checksums", dict())
+            for output in entry["outputs"]:
+                output_file = os.path.join(bids_dir, output)
+                source_file = copied_from.get(output)
+                source_inode = entry.get("inode") if source_file == source else None
+                if source_file is not None and is_source_file(output_file, source_file, source_inode):
+                    n_identical += 1
+                    continue
+                if not os.path.exists(output_file):
+                    checks.append((entry, output, None, "missing"))
+                    continue
+                to_hash.add(output_file)
+                if source_file is not None and os.path.exists(source_file):
+                    to_hash.add(source_file)
+                checks.append((entry, output, source_file, None))
+
+    digests, n_bytes = hash_files(sorted(to_hash), jobs=jobs)
+    problems = list()
+    for entry, output, source_file, problem in checks:
+        if problem is not None:
+            problems.append("{}: {}".format(problem, output))
+            continue
+        checksum = "{}:{}".format(HASH_NAME, digests[os.path.join(bids_dir, output)])
+        recorded = entry["checksums"].get(output)
+        if source_file in digests and digests[source_file] != digests[os.path.join(bids_dir, output)]:
+            problems.append("differs from {}: {}".format(source_file, output))
+        elif recorded is not None and recorded != checksum:
+            problems.append("changed since it was verified: {}".format(output))
+        entry["checksums"][output] = checksum
+
+    elapsed = time.perf_counter() - start
+    logger.info("Verified %d outputs (%d identical to their source by inode, %d files hashed): %.2f GB in %.1f s "
+                "(%.2f GB/s).", n_identical + len(checks), n_identical, len(digests), n_bytes / 1024 ** 3, elapsed,
+                n_bytes / 1024 ** 3 / elapsed if elapsed > 0 else 0.)
+    for problem in problems:
+        logger.error("Verification failed: %s", problem)
+    return problems
+
+
+def write_checksums_file(bids_dir, manifest):
+    """
+    Writes the recorded checksums in the format of b2sum.
+    """
+    lines = list()
+    for subject in manifest["subjects"].values():
+        for entry in subject["sources"].values():
+            for output, checksum in entry.get("checksums", dict()).items():
+                lines.append("{}  {}\n".format(checksum.split(":", 1)[1], output))
+    with atomic_write(os.path.join(bids_dir, CHECKSUMS_FILENAME)) as f:
+        f.writelines(sorted(lines, key=lambda line: line.split("  ", 1)[1]))
+
+
+def verify(bids_dir, participant_label=None, jobs=None):
+    manifest = load_manifest(bids_dir)
+    if len(manifest["subjects"]) == 0:
+        raise ValueError("No converted subjects found in the manifest of {}".format(bids_dir))
+    problems = verify_manifest(manifest, bids_dir, subject_ids=participant_label, jobs=jobs)
+    save_manifest(bids_dir, manifest)
+    write_checksums_file(bids_dir, manifest)
+    return problems
+
+
+def main():
+    args = parse_args()
+    setup_logging(args.log_level)
+    problems = verify(args.bids_dir, participant_label=args.participant_label, jobs=args.jobs)
+    if len(problems) > 0:
+        sys.exit("Verification failed for {} outputs.".format(len(problems)))
+
+
+if __name__ == "__main__":
+    main()